@@ -0,0 +1,352 @@
+"""
+Reading and writing the member's Fitbit archive (fitbit-data.json, or
+fitbit-data.json.gz when FITBIT_ARCHIVE_FORMAT is 'json.gz').
+
+The archive can hold many years of data, so it is never handled as one
+document: it is downloaded to disk in chunks, read one slice (an
+endpoint, or one period of an endpoint) at a time, merged with new
+slices by copying the untouched ones verbatim, and serialized slice by
+slice.
+"""
+import gzip
+import hashlib
+import json
+import re
+
+from django.conf import settings
+from fitbit.sessions import session
+
+from .fetch import PERIODS
+
+CHUNK_SIZE = 64 * 1024
+
+ARCHIVE_FILENAMES = {
+    'json': 'fitbit-data.json',
+    'json.gz': 'fitbit-data.json.gz',
+}
+# Archives are uploaded as e.g. fitbit-data-3fa9c2e1b0d4.json.gz, named
+# after the start of their digest, so a new one can be uploaded next to
+# the old one before that is deleted.
+ARCHIVE_NAME = re.compile(r'^fitbit-data(-[0-9a-f]{12})?\.json(\.gz)?$')
+VERSION_LENGTH = 12
+
+_DECODER = json.JSONDecoder()
+_SCALAR = re.compile(r'[^,:\]}\s]+')
+_WHITESPACE = re.compile(r'\s*')
+
+
+class _Scanner(object):
+    """
+    Walk the JSON text of a file one value at a time, keeping at most the
+    value being read (and the rest of its chunk) in memory.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self):
+        """
+        Drop what was consumed and read more, at least doubling what is
+        left so a large value takes few attempts. Returns False at EOF.
+        """
+        chunk = self.fh.read(max(CHUNK_SIZE, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        """
+        Return the next non-whitespace character, or '' at EOF.
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {!r} in archive'.format(char))
+        self.pos += 1
+
+    def read(self):
+        """
+        Consume the next value and return it parsed and as JSON text.
+        """
+        char = self.peek()
+        while True:
+            end = None
+            if char in '{["':
+                try:
+                    value, end = _DECODER.raw_decode(self.buf, self.pos)
+                except ValueError:
+                    # Most likely the value continues past what was read
+                    pass
+            else:
+                match = _SCALAR.match(self.buf, self.pos)
+                if match and match.end() < len(self.buf):
+                    end = match.end()
+            if end is not None:
+                break
+            if not self._fill():
+                if char in '{["' or self.pos == len(self.buf):
+                    raise ValueError('Unexpected end of archive')
+                end = len(self.buf)
+                break
+        raw = self.buf[self.pos:end]
+        self.pos = end
+        if char not in '{["':
+            value = json.loads(raw)
+        return value, raw
+
+    def value(self):
+        return self.read()[0]
+
+    def raw(self):
+        return self.read()[1]
+
+    def keys(self):
+        """
+        Iterate over the keys of the object at the current position. The
+        caller has to consume each key's value before asking for the next.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError('Expected \',\' or \'}\' in archive')
+
+
+def _is_periodic(name, scanner):
+    return PERIODS.get(name) is not None and scanner.peek() == '{'
+
+
+def iter_archive_slices(fh):
+    """
+    Yield (name, period, data) for every slice of the archive in fh,
+    parsing one slice at a time. period is '' for endpoints stored whole.
+    """
+    scanner = _Scanner(fh)
+    for name in scanner.keys():
+        if _is_periodic(name, scanner):
+            for key in scanner.keys():
+                yield name, key, scanner.value()
+        else:
+            yield name, '', scanner.value()
+
+
+def read_archive_index(fh):
+    """
+    Return the profile stored in the archive in fh (None if it has none)
+    and, for every endpoint stored by period, the set of periods present.
+    Nothing else is loaded.
+    """
+    scanner = _Scanner(fh)
+    profile = None
+    index = {}
+    for name in scanner.keys():
+        if name == 'profile':
+            profile = scanner.value()
+        elif _is_periodic(name, scanner):
+            index[name] = set()
+            for key in scanner.keys():
+                index[name].add(key)
+                scanner.read()
+        else:
+            scanner.read()
+    return profile, index
+
+
+def _iter_entry_json(name, value):
+    if PERIODS.get(name) is None or not isinstance(value, dict):
+        yield '{}: {}'.format(json.dumps(name), json.dumps(value))
+        return
+    yield '{}: {{'.format(json.dumps(name))
+    for j, (key, data) in enumerate(value.items()):
+        if j:
+            yield ', '
+        yield '{}: {}'.format(json.dumps(key), json.dumps(data))
+    yield '}'
+
+
+def iter_archive_json(fitbit_data):
+    """
+    Yield the JSON of fitbit_data in pieces of at most one slice each.
+    The pieces join up to exactly json.dumps(fitbit_data).
+    """
+    yield '{'
+    for i, (name, value) in enumerate(fitbit_data.items()):
+        if i:
+            yield ', '
+        for piece in _iter_entry_json(name, value):
+            yield piece
+    yield '}'
+
+
+def write_archive(fitbit_data, fh):
+    """
+    Write fitbit_data as JSON to the text file fh, slice by slice.
+    """
+    for piece in iter_archive_json(fitbit_data):
+        fh.write(piece)
+
+
+def merge_archive(existing, fitbit_data, fh):
+    """
+    Write the archive in the text file existing, with the slices in
+    fitbit_data added or replacing the stored ones, to the text file fh.
+    Untouched slices are copied verbatim without being parsed.
+    """
+    scanner = _Scanner(existing)
+    merged = set()
+    fh.write('{')
+    for i, name in enumerate(scanner.keys()):
+        if i:
+            fh.write(', ')
+        merged.add(name)
+        value = fitbit_data.get(name)
+        if _is_periodic(name, scanner) and isinstance(value or {}, dict):
+            updates = dict(value or {})
+            fh.write('{}: {{'.format(json.dumps(name)))
+            written = 0
+            for key in scanner.keys():
+                if written:
+                    fh.write(', ')
+                if key in updates:
+                    scanner.read()
+                    fh.write('{}: {}'.format(json.dumps(key),
+                                             json.dumps(updates.pop(key))))
+                else:
+                    fh.write('{}: {}'.format(json.dumps(key), scanner.raw()))
+                written += 1
+            for key, data in updates.items():
+                if written:
+                    fh.write(', ')
+                fh.write('{}: {}'.format(json.dumps(key), json.dumps(data)))
+                written += 1
+            fh.write('}')
+        elif name in fitbit_data:
+            scanner.read()
+            for piece in _iter_entry_json(name, value):
+                fh.write(piece)
+        else:
+            fh.write('{}: {}'.format(json.dumps(name), scanner.raw()))
+    for name, value in fitbit_data.items():
+        if name not in merged:
+            if merged:
+                fh.write(', ')
+            merged.add(name)
+            for piece in _iter_entry_json(name, value):
+                fh.write(piece)
+    fh.write('}')
+
+
+class DigestWriter(object):
+    """
+    Text file wrapper computing the SHA-256 of what is written through it,
+    before any compression, so equal archives have equal digests in
+    either format. The digest starts from the file's name, so switching
+    formats still changes it.
+    """
+
+    def __init__(self, fh, name):
+        self.fh = fh
+        self.digest = hashlib.sha256(name.encode('utf-8'))
+
+    def write(self, text):
+        self.digest.update(text.encode('utf-8'))
+        return self.fh.write(text)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def archive_filename(archive_hash=None):
+    """
+    Name of the archive uploaded in the configured format, versioned by
+    its digest if given.
+    """
+    filename = ARCHIVE_FILENAMES[settings.FITBIT_ARCHIVE_FORMAT]
+    if not archive_hash:
+        return filename
+    return filename.replace('fitbit-data', 'fitbit-data-{}'.format(
+        archive_hash[:VERSION_LENGTH]), 1)
+
+
+def archive_filenames(archive_hash=None):
+    """
+    Every name the archive with the given digest can have on Open Humans,
+    in either format, including the unversioned ones.
+    """
+    filenames = list(ARCHIVE_FILENAMES.values())
+    if archive_hash:
+        version = 'fitbit-data-{}'.format(archive_hash[:VERSION_LENGTH])
+        filenames += [filename.replace('fitbit-data', version, 1)
+                      for filename in ARCHIVE_FILENAMES.values()]
+    return filenames
+
+
+def is_archive_name(basename):
+    return bool(ARCHIVE_NAME.match(basename or ''))
+
+
+def newest_files(data_files):
+    """
+    Keep the newest of the Open Humans data files sharing a name, which
+    there can be while a file is being replaced.
+    """
+    newest = {}
+    for dfile in data_files:
+        basename = dfile.get('basename')
+        if (basename not in newest or
+                dfile.get('id', 0) > newest[basename].get('id', 0)):
+            newest[basename] = dfile
+    return list(newest.values())
+
+
+def find_archive_file(data_files):
+    """
+    Pick the member's archive among their Open Humans data files,
+    preferring compressed ones, then the newest. Returns None if there
+    is none.
+    """
+    archives = [dfile for dfile in data_files
+                if 'Fitbit' in dfile['metadata']['tags'] and
+                is_archive_name(dfile.get('basename'))]
+    if not archives:
+        return None
+    return max(archives, key=lambda dfile: (
+        dfile['basename'].endswith('.gz'), dfile.get('id', 0)))
+
+
+def open_archive(path, mode='r'):
+    """
+    Open the archive at path as text, gzipped if its name ends in .gz.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8',
+                         compresslevel=settings.FITBIT_ARCHIVE_COMPRESSLEVEL)
+    return open(path, mode)
+
+
+def download_archive(url, path):
+    """
+    Stream the archive at url to path without holding it in memory.
+    """
+    with session.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as fh:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                fh.write(chunk)
@@ -36,14 +36,26 @@ app.conf.update({
     'CELERY_RESULT_BACKEND': CELERY_BROKER_URL,
     'CELERY_SEND_EVENTS': False,
     'CELERY_EVENT_QUEUE_EXPIRES': 60,
+    # Sign-ups don't wait behind fetches, see the Procfile
+    'CELERY_ROUTES': {
+        'main.tasks.complete_oh_signup': {'queue': 'signups'},
+        'main.tasks.complete_fitbit_signup': {'queue': 'signups'},
+    },
 })
 
 # Set up Celery Beat (periodic/timed tasks)
-# Commented out until we are sure of if we want to use celery beat
-# @app.on_after_configure.connect
-# def setup_periodic_tasks(sender, **kwargs):
-#     # Calls test('hello') every 10 seconds.
-#     sender.add_periodic_task(10.0, test.s('hello'), name='add every 10')
+@app.on_after_configure.connect
+def setup_periodic_tasks(sender, **kwargs):
+    # Hands out the Fitbit budget to stale members' syncs
+    sender.add_periodic_task(
+        settings.FITBIT_SCHEDULE_EVERY,
+        sender.signature('datauploader.tasks.schedule_fitbit_syncs'),
+        name='schedule fitbit syncs')
+    # Keeps tokens valid so syncs don't have to refresh them
+    sender.add_periodic_task(
+        settings.FITBIT_TOKEN_REFRESH_EVERY,
+        sender.signature('datauploader.tasks.refresh_fitbit_tokens'),
+        name='refresh expiring tokens')
 
 # Using a string here means the worker will not have to
 # pickle the object when using Windows.
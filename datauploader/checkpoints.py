@@ -0,0 +1,150 @@
+"""
+Per-slice sync checkpoints.
+
+A slice is one period of one endpoint (or a whole endpoint without
+periods). Each checkpoint holds a hash of the slice as stored on Open
+Humans and when it was fetched, so a sync can plan its requests and tell
+whether anything changed without downloading the member's archive.
+"""
+import hashlib
+import json
+import operator
+from datetime import timedelta
+from functools import reduce
+
+import arrow
+from django.db import transaction
+from django.db.models import Q
+from main.models import FitbitSyncCheckpoint
+
+from .fetch import PERIOD_FORMATS, PERIODS
+
+# Trackers can sync days after the fact, so a period only counts as
+# complete once it was fetched this long after it ended.
+CLOSED_PERIOD_GRACE = timedelta(days=7)
+
+
+def slice_hash(data):
+    return hashlib.sha256(json.dumps(
+        data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    ).hexdigest()
+
+
+def iter_slices(fitbit_data):
+    """
+    Yield (endpoint, period, data) for every slice in fitbit_data; the
+    period is '' for endpoints without periods and for the profile.
+    """
+    for name, value in fitbit_data.items():
+        if PERIODS.get(name) is None:
+            yield name, '', value
+        else:
+            for key, data in value.items():
+                yield name, key, data
+
+
+def is_closed(endpoint, period, fetched_at):
+    """
+    Whether a slice fetched at fetched_at can't change anymore.
+    """
+    period_type = PERIODS.get(endpoint)
+    if period_type is None:
+        return False
+    period_end = arrow.get(period, PERIOD_FORMATS[period_type]).ceil(
+        period_type)
+    return arrow.get(fetched_at) >= period_end + CLOSED_PERIOD_GRACE
+
+
+def complete_slices(checkpoints):
+    """
+    Return the set of (endpoint, period) that never need fetching again.
+    """
+    return {key for key, checkpoint in checkpoints.items()
+            if is_closed(key[0], key[1], checkpoint.fetched_at)}
+
+
+def stale_days(checkpoints):
+    """
+    Return {(endpoint, period): day} for the stored periods that can still
+    change, day ('YYYY-MM-DD') being the first that may have changed since
+    the period was fetched.
+    """
+    return {key: (arrow.get(checkpoint.fetched_at) -
+                  CLOSED_PERIOD_GRACE).format('YYYY-MM-DD')
+            for key, checkpoint in checkpoints.items()
+            if PERIODS.get(key[0]) is not None and
+            not is_closed(key[0], key[1], checkpoint.fetched_at)}
+
+
+def load_checkpoints(fitbit_member):
+    """
+    Return {(endpoint, period): checkpoint} for the member.
+    """
+    return {(c.endpoint, c.period): c
+            for c in FitbitSyncCheckpoint.objects.filter(
+                fitbit_member=fitbit_member)}
+
+
+def seed_checkpoints(fitbit_member, slices):
+    """
+    Create checkpoints describing an archive synced before checkpoints
+    existed, given as (endpoint, period, data) slices. The last present
+    period of each endpoint is left out, as it might have been incomplete
+    when fetched.
+    """
+    now = arrow.now().datetime
+    hashes = [(name, period, slice_hash(data))
+              for name, period, data in slices]
+    last_present = {}
+    for name, period, _ in hashes:
+        if period > last_present.get(name, ''):
+            last_present[name] = period
+    checkpoints = [
+        FitbitSyncCheckpoint(fitbit_member=fitbit_member, endpoint=name,
+                             period=period, content_hash=content_hash,
+                             fetched_at=now)
+        for name, period, content_hash in hashes
+        if not period or period != last_present[name]]
+    FitbitSyncCheckpoint.objects.bulk_create(checkpoints)
+    return load_checkpoints(fitbit_member)
+
+
+def changed_slices(checkpoints, fitbit_data):
+    """
+    List (endpoint, period) of the slices in fitbit_data that differ from
+    what the checkpoints say is stored.
+    """
+    changed = []
+    for name, period, data in iter_slices(fitbit_data):
+        checkpoint = checkpoints.get((name, period))
+        if checkpoint is None or checkpoint.content_hash != slice_hash(data):
+            changed.append((name, period))
+    return changed
+
+
+def save_checkpoints(fitbit_member, fitbit_data, fetched_at, merged=None):
+    """
+    Record the slices in fitbit_data as stored, fetched at fetched_at.
+    merged maps the slices that only had some of their days fetched to
+    their checkpoints. They keep their fetched_at, as the days since may
+    not have been fetched, or get no checkpoint if they had none.
+    """
+    merged = merged or {}
+    checkpoints = []
+    for name, period, data in iter_slices(fitbit_data):
+        slice_fetched_at = fetched_at
+        if (name, period) in merged:
+            if merged[(name, period)] is None:
+                continue
+            slice_fetched_at = merged[(name, period)].fetched_at
+        checkpoints.append(FitbitSyncCheckpoint(
+            fitbit_member=fitbit_member, endpoint=name, period=period,
+            content_hash=slice_hash(data), fetched_at=slice_fetched_at))
+    if not checkpoints:
+        return
+    with transaction.atomic():
+        FitbitSyncCheckpoint.objects.filter(
+            reduce(operator.or_, [Q(endpoint=c.endpoint, period=c.period)
+                                  for c in checkpoints]),
+            fitbit_member=fitbit_member).delete()
+        FitbitSyncCheckpoint.objects.bulk_create(checkpoints)
@@ -0,0 +1,374 @@
+"""
+Fitbit endpoint definitions and the concurrent engine that fetches them.
+
+The per-endpoint/per-period requests of a member are independent, so they
+are issued concurrently (bounded by FITBIT_FETCH_CONCURRENCY) on the pooled
+session, each going through the rate limiter for both the global Fitbit
+realm and the member's own realm. Wall-clock time per member is then bound
+by the rate limits rather than by network latency.
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import arrow
+from django.conf import settings
+from fitbit.settings import rr
+from requests_respectful import RequestsRespectfulRateLimitedError
+
+logger = logging.getLogger(__name__)
+
+FITBIT_API_BASE_URL = 'https://api.fitbit.com/1/user'
+
+# Fitbit allows 150 requests per member and hour
+MEMBER_MAX_REQUESTS = 150
+
+# Keys under which each period of a time series is stored
+PERIOD_FORMATS = {'year': 'YYYY', 'month': 'YYYY-MM'}
+
+# Time series are stored per 'period', while 'max_days' is the longest date
+# range a single request may cover: Fitbit allows 1095 days for most
+# series and 31 for weight logs.
+fitbit_urls = [
+    # Requires the 'settings' scope, which we haven't asked for
+    # {'name': 'devices', 'url': '/-/devices.json', 'period': None},
+
+    {'name': 'activities-overview',
+     'url': '/{user_id}/activities.json',
+     'period': None},
+    # interday timeline data
+    {'name': 'heart',
+     'url': '/{user_id}/activities/heart/date/{start_date}/{end_date}.json',
+     'period': 'month',
+     'max_days': 31},
+    # MPB 2016-12-12: Although docs allowed for 'year' for this endpoint,
+    # switched to 'month' bc/ req for full year started resulting in 504.
+    {'name': 'tracker-activity-calories',
+     'url': '/{user_id}/activities/tracker/activityCalories/date/{start_date}/{end_date}.json',
+     'period': 'month',
+     'max_days': 31},
+    {'name': 'tracker-calories',
+     'url': '/{user_id}/activities/tracker/calories/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'tracker-distance',
+     'url': '/{user_id}/activities/tracker/distance/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'tracker-elevation',
+     'url': '/{user_id}/activities/tracker/elevation/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'tracker-floors',
+     'url': '/{user_id}/activities/tracker/floors/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'tracker-minutes-fairly-active',
+     'url': '/{user_id}/activities/tracker/minutesFairlyActive/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'tracker-minutes-lightly-active',
+     'url': '/{user_id}/activities/tracker/minutesLightlyActive/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'tracker-minutes-sedentary',
+     'url': '/{user_id}/activities/tracker/minutesSedentary/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'tracker-minutes-very-active',
+     'url': '/{user_id}/activities/tracker/minutesVeryActive/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'tracker-steps',
+     'url': '/{user_id}/activities/tracker/steps/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'weight-log',
+     'url': '/{user_id}/body/log/weight/date/{start_date}/{end_date}.json',
+     'period': 'month',
+     'max_days': 31},
+    {'name': 'weight',
+     'url': '/{user_id}/body/weight/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'sleep-awakenings',
+     'url': '/{user_id}/sleep/awakeningsCount/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'sleep-efficiency',
+     'url': '/{user_id}/sleep/efficiency/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'sleep-minutes-after-wakeup',
+     'url': '/{user_id}/sleep/minutesAfterWakeup/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'sleep-minutes',
+     'url': '/{user_id}/sleep/minutesAsleep/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'awake-minutes',
+     'url': '/{user_id}/sleep/minutesAwake/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'minutes-to-sleep',
+     'url': '/{user_id}/sleep/minutesToFallAsleep/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'sleep-start-time',
+     'url': '/{user_id}/sleep/startTime/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+    {'name': 'time-in-bed',
+     'url': '/{user_id}/sleep/timeInBed/date/{start_date}/{end_date}.json',
+     'period': 'year',
+     'max_days': 1095},
+]
+
+# Period of each endpoint, None for endpoints stored whole
+PERIODS = {url['name']: url['period'] for url in fitbit_urls}
+
+
+def empty_fitbit_data():
+    fitbit_data = {}
+    for url in fitbit_urls:
+        fitbit_data[url['name']] = {}
+    return fitbit_data
+
+
+def last_device_sync(headers, realms):
+    """
+    Return when the member's trackers last synced with Fitbit, as the
+    latest lastSyncTime of their devices, or None if that can't be told
+    (no devices, no access to them, or the realms are rate-limited).
+    """
+    try:
+        response = rr.get(url=FITBIT_API_BASE_URL + '/-/devices.json',
+                          headers=headers, realms=realms)
+    except RequestsRespectfulRateLimitedError:
+        logger.info('Could not get devices: rate-limited')
+        return None
+    if response.status_code != 200:
+        logger.info('Could not get devices: status {}'.format(
+            response.status_code))
+        return None
+    sync_times = [device['lastSyncTime'] for device in response.json()
+                  if device.get('lastSyncTime')]
+    return max(sync_times) if sync_times else None
+
+
+def period_bounds(period, key):
+    """
+    First and last day, as 'YYYY-MM-DD', of the period with the given key.
+    """
+    period_date = arrow.get(key, PERIOD_FORMATS[period])
+    return (period_date.floor(period).format('YYYY-MM-DD'),
+            period_date.ceil(period).format('YYYY-MM-DD'))
+
+
+def last_day():
+    # Members ahead of UTC can already have data for tomorrow
+    return arrow.get().shift(days=1).format('YYYY-MM-DD')
+
+
+def whole_slice(url, user_id):
+    return {'name': url['name'],
+            'key': None,
+            'keys': [],
+            'url': FITBIT_API_BASE_URL + url['url'].format(user_id=user_id)}
+
+
+def plan_ranges(url, needed, user_id):
+    """
+    Cover needed, the sorted (period key, first day, last day) of one
+    endpoint, with as few requests as its max_days allows. A request only
+    spans successive periods, so periods that aren't needed are never
+    fetched again.
+    """
+    period = url['period']
+    unit = {'{}s'.format(period): 1}
+    ranges = []
+    for key, first, last in needed:
+        if ranges:
+            previous = ranges[-1]
+            span = (arrow.get(last) - arrow.get(previous['start_date'])).days
+            next_key = arrow.get(previous['keys'][-1], PERIOD_FORMATS[
+                period]).shift(**unit).format(PERIOD_FORMATS[period])
+            if key == next_key and span < url['max_days']:
+                previous['keys'].append(key)
+                previous['end_date'] = last
+                continue
+        ranges.append({'name': url['name'], 'key': key, 'keys': [key],
+                       'start_date': first, 'end_date': last})
+    for data_slice in ranges:
+        data_slice['url'] = FITBIT_API_BASE_URL + url['url'].format(
+            user_id=user_id, start_date=data_slice['start_date'],
+            end_date=data_slice['end_date'])
+    return ranges
+
+
+def plan_slices(complete, user_id, start_date, stale=None):
+    """
+    List the requests needed to bring a member's data up to date.
+    complete is the set of (endpoint name, period key) that are stored and
+    can't change anymore; everything else is (re-)fetched. stale maps the
+    stored periods that can still change to the first day that may have,
+    and only the days from there on are requested for them. Successive
+    periods of an endpoint share a request as far as its max_days allows.
+    """
+    stale = stale or {}
+    end = last_day()
+    slices = []
+    for period in [None, 'year', 'month']:
+        for url in [u for u in fitbit_urls if u['period'] == period]:
+            if period is None:
+                # Only ever complete when resuming a sync that fetched it
+                if (url['name'], '') not in complete:
+                    slices.append(whole_slice(url, user_id))
+                continue
+
+            needed = []
+            for period_date in arrow.Arrow.range(
+                    period, start_date.floor(period), arrow.get()):
+                key = period_date.format(PERIOD_FORMATS[period])
+                if (url['name'], key) in complete:
+                    logger.debug('Skip retrieval {}: {}'.format(
+                        url['name'], key))
+                    continue
+                first, last = period_bounds(period, key)
+                first = max(first, stale.get((url['name'], key), first))
+                needed.append((key, first, min(last, end)))
+            slices.extend(plan_ranges(url, needed, user_id))
+    return slices
+
+
+def plan_day_slices(days, user_id, whole=()):
+    """
+    List the requests for just some days of some endpoints. days maps
+    endpoint names to 'YYYY-MM-DD' dates, and the days of each period are
+    requested from the first to the last. Periods in whole, as (endpoint
+    name, period key), and endpoints without periods are requested in full.
+    """
+    end = last_day()
+    slices = []
+    for url in fitbit_urls:
+        if url['name'] not in days:
+            continue
+        period = url['period']
+        if period is None:
+            slices.append(whole_slice(url, user_id))
+            continue
+
+        by_key = {}
+        for day in sorted(days[url['name']]):
+            key = arrow.get(day, 'YYYY-MM-DD').format(PERIOD_FORMATS[period])
+            by_key.setdefault(key, []).append(day)
+        needed = []
+        for key, period_days in sorted(by_key.items()):
+            if (url['name'], key) in whole:
+                first, last = period_bounds(period, key)
+                needed.append((key, first, min(last, end)))
+            else:
+                needed.append((key, period_days[0], period_days[-1]))
+        slices.extend(plan_ranges(url, needed, user_id))
+    return slices
+
+
+def _item_date(item):
+    # Time series entries have a dateTime, logs (e.g. weight) a date
+    return item.get('dateTime') or item.get('date') or ''
+
+
+def merge_days(stored, fetched, start_date, end_date):
+    """
+    Return the stored response for a period with the days from start_date
+    to end_date replaced by fetched, the response for just those days.
+    """
+    merged = dict(stored)
+    for key, items in fetched.items():
+        if not isinstance(items, list):
+            merged[key] = items
+            continue
+        kept = [item for item in stored.get(key, [])
+                if not start_date <= _item_date(item) <= end_date]
+        merged[key] = sorted(kept + items, key=_item_date)
+    return merged
+
+
+def period_part(data, first, last):
+    """
+    Return the part of a response from first to last.
+    """
+    return {key: [item for item in items
+                  if first <= _item_date(item) <= last]
+            if isinstance(items, list) else items
+            for key, items in data.items()}
+
+
+def store_slice(fitbit_data, data_slice, data, stored=None):
+    """
+    Store the response to a planned request in fitbit_data, split into the
+    periods it covers. Periods in stored ({(endpoint name, period key):
+    data}) only get the requested days replaced.
+    """
+    name = data_slice['name']
+    if data_slice['key'] is None:
+        fitbit_data[name] = data
+        return
+    for key in data_slice['keys']:
+        first, last = period_bounds(PERIODS[name], key)
+        first = max(first, data_slice['start_date'])
+        last = min(last, data_slice['end_date'])
+        part = data
+        if len(data_slice['keys']) > 1:
+            part = period_part(data, first, last)
+        if stored and (name, key) in stored:
+            part = merge_days(stored[(name, key)], part, first, last)
+        fitbit_data.setdefault(name, {})[key] = part
+
+
+def fetch_slices(slices, headers, realms, fitbit_data, stored=None):
+    """
+    Fetch all slices concurrently and store the responses in fitbit_data,
+    merging them into the periods in stored as store_slice does.
+    If a request fails, e.g. because a realm is rate-limited, no further
+    requests are started, the ones in flight are completed and the error
+    (RequestsRespectfulRateLimitedError for rate limits) is raised once
+    everything fetched so far is stored.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        failures = loop.run_until_complete(_fetch_slices(
+            loop, slices, headers, realms, fitbit_data, stored))
+    finally:
+        loop.close()
+    if failures:
+        raise failures[0]
+
+
+async def _fetch_slices(loop, slices, headers, realms, fitbit_data, stored):
+    concurrency = settings.FITBIT_FETCH_CONCURRENCY
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = []
+
+    def get_json(data_slice):
+        logger.info('Retrieving %s: %s', data_slice['name'], data_slice['key'])
+        return rr.get(url=data_slice['url'], headers=headers,
+                      realms=realms).json()
+
+    async def fetch(data_slice):
+        async with semaphore:
+            if failures:
+                return
+            try:
+                data = await loop.run_in_executor(
+                    executor, functools.partial(get_json, data_slice))
+            except Exception as e:
+                failures.append(e)
+                return
+            store_slice(fitbit_data, data_slice, data, stored)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*[fetch(s) for s in slices])
+    return failures
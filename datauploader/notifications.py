@@ -0,0 +1,158 @@
+"""
+Fitbit Subscriber notifications.
+
+Instead of polling every member, Fitbit tells the subscriber endpoint
+which collection (activities, body, foods, sleep) of which member changed
+on which date. Notifications are signed with the app's client secret and
+often come in bursts, so they are collected per member in Redis and one
+fetch of just the notified slices is queued for the end of a short
+window.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import re
+
+from django.conf import settings
+from fitbit.sessions import session
+from fitbit.settings import rr
+
+from .fetch import FITBIT_API_BASE_URL, fitbit_urls
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATIONS_KEY = 'fitbit-notifications:{}'
+SCHEDULED_KEY = 'fitbit-notifications:{}:scheduled'
+
+# Collection of each endpoint, from the first part of its URL
+COLLECTIONS = {url['name']: re.match(r'/\{user_id\}/([a-z]+)',
+                                     url['url']).group(1)
+               for url in fitbit_urls}
+
+
+def signature(body):
+    """
+    The X-Fitbit-Signature of a notification body.
+    """
+    key = '{}&'.format(settings.FITBIT_CLIENT_SECRET).encode('utf-8')
+    return base64.b64encode(
+        hmac.new(key, body, hashlib.sha1).digest()).decode('ascii')
+
+
+def verify_signature(body, header):
+    return bool(header) and hmac.compare_digest(signature(body), header)
+
+
+def queue_notifications(owner_id, notifications, countdown=None):
+    """
+    Add (collection, date) pairs to the member's pending notifications and
+    queue a fetch for them, unless one is already queued.
+    """
+    from .tasks import process_fitbit_notifications
+
+    if countdown is None:
+        countdown = settings.FITBIT_NOTIFICATION_DELAY
+    pipe = rr.redis.pipeline()
+    pipe.sadd(NOTIFICATIONS_KEY.format(owner_id),
+              *[json.dumps(notification) for notification in notifications])
+    # Expires in case the queued task got lost
+    pipe.set(SCHEDULED_KEY.format(owner_id), 1, nx=True,
+             ex=int(countdown) + 3600)
+    _, scheduled = pipe.execute()
+    if scheduled:
+        process_fitbit_notifications.apply_async(args=[owner_id],
+                                                 countdown=countdown)
+    return bool(scheduled)
+
+
+def receive_notifications(payload):
+    """
+    Queue the notifications of a verified Subscriber request body. Returns
+    the number of members a fetch was queued for.
+    """
+    by_owner = {}
+    for notification in payload:
+        if (notification.get('collectionType') not in COLLECTIONS.values() or
+                not notification.get('ownerId') or
+                not notification.get('date')):
+            logger.info('Ignoring {} notification for {}'.format(
+                notification.get('collectionType'),
+                notification.get('ownerId')))
+            continue
+        by_owner.setdefault(notification['ownerId'], []).append(
+            [notification['collectionType'], notification['date']])
+    return sum(queue_notifications(owner_id, notifications)
+               for owner_id, notifications in by_owner.items())
+
+
+def pop_notifications(owner_id):
+    """
+    Take all pending (collection, date) pairs of a member, allowing the
+    next notification to queue a new fetch.
+    """
+    pipe = rr.redis.pipeline()
+    pipe.smembers(NOTIFICATIONS_KEY.format(owner_id))
+    pipe.delete(NOTIFICATIONS_KEY.format(owner_id),
+                SCHEDULED_KEY.format(owner_id))
+    members, _ = pipe.execute()
+    return sorted(tuple(json.loads(member)) for member in members)
+
+
+def collection_endpoints(collections):
+    """
+    Names of the endpoints in the given collections; endpoint names can be
+    given as well.
+    """
+    return [url['name'] for url in fitbit_urls
+            if url['name'] in collections or
+            COLLECTIONS[url['name']] in collections]
+
+
+def notified_days(notifications):
+    """
+    Return {endpoint: dates} for the notified (collection, date) pairs.
+    """
+    days = {}
+    for collection, date in notifications:
+        for name in collection_endpoints([collection]):
+            days.setdefault(name, set()).add(date)
+    return days
+
+
+def subscription_url(fitbit_member):
+    return '{}/-/apiSubscriptions/{}.json'.format(FITBIT_API_BASE_URL,
+                                                  fitbit_member.id)
+
+
+def subscribe(fitbit_member, access_token):
+    """
+    Subscribe to notifications for all of the member's collections.
+    Does nothing if no subscriber is configured.
+    """
+    if not settings.FITBIT_SUBSCRIBER_ID:
+        return False
+    response = session.post(
+        subscription_url(fitbit_member),
+        headers={'Authorization': 'Bearer {}'.format(access_token),
+                 'X-Fitbit-Subscriber-Id': settings.FITBIT_SUBSCRIBER_ID})
+    # 409 means the subscription already exists
+    if response.status_code not in (200, 201, 409):
+        logger.warning('Could not subscribe {}: status {}'.format(
+            fitbit_member.userid, response.status_code))
+        return False
+    return True
+
+
+def unsubscribe(fitbit_member):
+    if not settings.FITBIT_SUBSCRIBER_ID:
+        return
+    response = session.delete(
+        subscription_url(fitbit_member),
+        headers={'Authorization': 'Bearer {}'.format(
+                     fitbit_member.get_access_token()),
+                 'X-Fitbit-Subscriber-Id': settings.FITBIT_SUBSCRIBER_ID})
+    if response.status_code not in (204, 404):
+        logger.warning('Could not unsubscribe {}: status {}'.format(
+            fitbit_member.userid, response.status_code))
@@ -0,0 +1,154 @@
+"""
+Cohort-wide scheduling of syncs.
+
+All members share the global Fitbit budget, so instead of queueing every
+stale member at once, schedule_syncs runs periodically and only hands out
+what is free of the current window. Pending members are ranked by how
+long they have waited per request their sync is expected to cost, so a
+cheap daily sync goes before a large backfill until the backfill has
+waited long enough, and syncs are dispatched in that order for as long as
+they fit. A sync is charged at most a member's hourly limit; whatever is
+left of it resumes once its own earlier requests leave the window.
+"""
+import logging
+from collections import namedtuple
+from datetime import timedelta
+
+import arrow
+from django.conf import settings
+from fitbit.settings import rr
+from main.models import FitbitMember
+
+from .checkpoints import complete_slices, load_checkpoints, stale_days
+from .fetch import MEMBER_MAX_REQUESTS, PERIOD_FORMATS, PERIODS, plan_slices
+
+logger = logging.getLogger(__name__)
+
+DISPATCHED_KEY = 'fitbit-scheduler:dispatched:{}'
+
+# Members without checkpoints are assumed to have this many years of data
+NEW_MEMBER_YEARS = 3
+
+# A sync that was to resume this long ago is assumed lost (its task was
+# revoked, or the run failed) and is scheduled again
+RESUME_GRACE = timedelta(minutes=30)
+
+PendingSync = namedtuple('PendingSync', ['member_id', 'staleness', 'cost'])
+
+
+def charge(cost):
+    """
+    Requests a sync of the given cost can use of the current window.
+    """
+    return min(cost, MEMBER_MAX_REQUESTS)
+
+
+def sync_priority(pending):
+    return pending.staleness / max(pending.cost, 1)
+
+
+def plan_dispatch(pending, budget):
+    """
+    Choose the pending syncs to start with budget requests: the highest
+    priority ones, up to the first that doesn't fit, which then waits for
+    the next run rather than being overtaken indefinitely.
+    """
+    dispatched = []
+    for sync in sorted(pending, key=sync_priority, reverse=True):
+        if charge(sync.cost) > budget:
+            break
+        dispatched.append(sync)
+        budget -= charge(sync.cost)
+    return dispatched
+
+
+def estimate_cost(fitbit_member, now):
+    """
+    Number of Fitbit requests the member's next sync is expected to make,
+    including the devices and profile requests.
+    """
+    checkpoints = load_checkpoints(fitbit_member)
+    periods = [arrow.get(period, PERIOD_FORMATS[PERIODS[name]])
+               for name, period in checkpoints if PERIODS.get(name)]
+    if periods:
+        start_date = min(periods)
+    else:
+        start_date = now.shift(years=-NEW_MEMBER_YEARS)
+    slices = plan_slices(complete_slices(checkpoints), fitbit_member.userid,
+                         start_date, stale=stale_days(checkpoints))
+    return len(slices) + 2
+
+
+def pending_syncs(now):
+    """
+    List the members due for a sync that aren't queued already, neither
+    by an earlier run nor to resume after a rate limit.
+    """
+    cutoff = now.shift(hours=-settings.FITBIT_SYNC_INTERVAL).datetime
+    members = list(FitbitMember.objects.filter(
+        last_updated__lt=cutoff).exclude(
+            sync_state__resume_at__gt=(now - RESUME_GRACE).datetime))
+    if not members:
+        return []
+    dispatched = rr.redis.mget([DISPATCHED_KEY.format(member.id)
+                                for member in members])
+    return [PendingSync(member.id,
+                        (now - arrow.get(member.last_updated)).total_seconds(),
+                        estimate_cost(member, now))
+            for member, key in zip(members, dispatched) if key is None]
+
+
+def committed_requests():
+    """
+    Requests that syncs dispatched by earlier runs may still make.
+    Rate-limited syncs aren't counted: they resume once their own earlier
+    requests leave the window.
+    """
+    member_ids = list(FitbitMember.objects.values_list('id', flat=True))
+    if not member_ids:
+        return 0
+    charges = rr.redis.mget([DISPATCHED_KEY.format(member_id)
+                             for member_id in member_ids])
+    return sum(int(value) for value in charges if value is not None)
+
+
+def available_budget():
+    """
+    Requests of the global Fitbit realm that scheduled syncs can use now,
+    leaving FITBIT_SCHEDULER_RESERVE of it to notifications and new
+    members.
+    """
+    max_requests = rr.realm_max_requests('Fitbit')
+    reserve = int(max_requests * settings.FITBIT_SCHEDULER_RESERVE)
+    return (max_requests - reserve -
+            rr.realm_requests_in_timespan('Fitbit') -
+            committed_requests())
+
+
+def schedule_syncs():
+    """
+    Dispatch the pending syncs that fit in the free budget. Returns the
+    dispatched PendingSyncs.
+    """
+    from .tasks import fetch_fitbit_data
+
+    now = arrow.now()
+    budget = available_budget()
+    pending = pending_syncs(now)
+    dispatched = plan_dispatch(pending, budget) if budget > 0 else []
+    logger.info('Dispatching {} of {} pending syncs with a budget of {} '
+                'requests'.format(len(dispatched), len(pending), budget))
+    timespan = rr.realm_timespan('Fitbit')
+    for sync in dispatched:
+        rr.redis.set(DISPATCHED_KEY.format(sync.member_id),
+                     charge(sync.cost), ex=timespan)
+        fitbit_member = FitbitMember.objects.get(id=sync.member_id)
+        fetch_fitbit_data.delay(fitbit_member.id, fitbit_member.access_token)
+    return dispatched
+
+
+def release_sync(fitbit_member_id):
+    """
+    Return what is left of a finished sync's charge to the budget.
+    """
+    rr.redis.delete(DISPATCHED_KEY.format(fitbit_member_id))
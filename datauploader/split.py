@@ -0,0 +1,60 @@
+"""
+Split archive layout, used when FITBIT_ARCHIVE_LAYOUT is 'split'.
+
+Instead of one fitbit-data.json, every endpoint gets one file per year on
+Open Humans (e.g. fitbit-heart-2024.json, holding that year's months),
+and endpoints without periods one file each (e.g. fitbit-profile.json).
+A sync then only replaces the few files its new slices fall in.
+"""
+import json
+
+from django.conf import settings
+
+from .archive import ARCHIVE_FILENAMES, is_archive_name, open_archive
+from .fetch import PERIODS
+
+
+def split_basename(name, period):
+    """
+    Name of the file the slice of endpoint name for period belongs in.
+    """
+    suffix = ARCHIVE_FILENAMES[settings.FITBIT_ARCHIVE_FORMAT][
+        len('fitbit-data'):]
+    if not period:
+        return 'fitbit-{}{}'.format(name, suffix)
+    return 'fitbit-{}-{}{}'.format(name, period[:4], suffix)
+
+
+def is_split_file(dfile):
+    """
+    Whether an Open Humans data file belongs to the split layout.
+    """
+    return ('Fitbit' in dfile['metadata']['tags'] and
+            dfile['basename'].startswith('fitbit-') and
+            not is_archive_name(dfile['basename']))
+
+
+def split_slices(slices):
+    """
+    Group (endpoint, period, data) slices by the file they belong in.
+    Returns {basename: (endpoint, content)}, where content is {period:
+    data} for endpoints with periods and the data itself otherwise.
+    """
+    files = {}
+    for name, period, data in slices:
+        basename = split_basename(name, period)
+        if PERIODS.get(name) is None:
+            files[basename] = (name, data)
+        else:
+            files.setdefault(basename, (name, {}))[1][period] = data
+    return files
+
+
+def write_split_file(path, content):
+    with open_archive(path, 'w') as fh:
+        json.dump(content, fh, sort_keys=True)
+
+
+def read_split_file(path):
+    with open_archive(path) as fh:
+        return json.load(fh)
@@ -9,15 +9,35 @@ import os
 import json
 import shutil
 import tempfile
-import requests
+import time
 import arrow
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from celery import shared_task
 from django.conf import settings
 from open_humans.models import OpenHumansMember
 from datetime import datetime
 from fitbit.settings import rr
-from main.models import FitbitMember
-from ohapi import api
+from fitbit.sessions import session, connection_stats
+from main.helpers import get_member_data, invalidate_member_data
+from main.models import FitbitArchiveFile, FitbitMember, FitbitSyncState
+from .archive import (ARCHIVE_FILENAMES, DigestWriter, archive_filename,
+                      archive_filenames, download_archive, find_archive_file,
+                      iter_archive_slices, merge_archive, newest_files,
+                      open_archive, read_archive_index, write_archive)
+from .checkpoints import (changed_slices, complete_slices,
+                          iter_slices, load_checkpoints, save_checkpoints,
+                          seed_checkpoints, slice_hash, stale_days)
+from .notifications import (collection_endpoints, notified_days,
+                            pop_notifications, queue_notifications)
+from .scheduler import release_sync, schedule_syncs
+from .tokens import refresh_expiring_tokens
+from .uploads import count_upload, upload_counts
+from .fetch import (MEMBER_MAX_REQUESTS, PERIODS, empty_fitbit_data,
+                    last_device_sync, plan_day_slices, plan_slices,
+                    fetch_slices)
+from .split import (is_split_file, read_split_file, split_basename,
+                    split_slices, write_split_file)
 from requests_respectful import (RespectfulRequester,
                                  RequestsRespectfulRateLimitedError)
 
@@ -41,80 +61,6 @@ def fetch_fitbit_data(fitbit_member_id, access_token):
     '''
     Fetches all of the fitbit data for a given user
     '''
-    fitbit_urls = [
-        # Requires the 'settings' scope, which we haven't asked for
-        # {'name': 'devices', 'url': '/-/devices.json', 'period': None},
-
-        {'name': 'activities-overview',
-         'url': '/{user_id}/activities.json',
-         'period': None},
-        # interday timeline data
-        {'name': 'heart',
-         'url': '/{user_id}/activities/heart/date/{start_date}/{end_date}.json',
-         'period': 'month'},
-        # MPB 2016-12-12: Although docs allowed for 'year' for this endpoint,
-        # switched to 'month' bc/ req for full year started resulting in 504.
-        {'name': 'tracker-activity-calories',
-         'url': '/{user_id}/activities/tracker/activityCalories/date/{start_date}/{end_date}.json',
-         'period': 'month'},
-        {'name': 'tracker-calories',
-         'url': '/{user_id}/activities/tracker/calories/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'tracker-distance',
-         'url': '/{user_id}/activities/tracker/distance/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'tracker-elevation',
-         'url': '/{user_id}/activities/tracker/elevation/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'tracker-floors',
-         'url': '/{user_id}/activities/tracker/floors/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'tracker-minutes-fairly-active',
-         'url': '/{user_id}/activities/tracker/minutesFairlyActive/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'tracker-minutes-lightly-active',
-         'url': '/{user_id}/activities/tracker/minutesLightlyActive/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'tracker-minutes-sedentary',
-         'url': '/{user_id}/activities/tracker/minutesSedentary/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'tracker-minutes-very-active',
-         'url': '/{user_id}/activities/tracker/minutesVeryActive/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'tracker-steps',
-         'url': '/{user_id}/activities/tracker/steps/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'weight-log',
-         'url': '/{user_id}/body/log/weight/date/{start_date}/{end_date}.json',
-         'period': 'month'},
-        {'name': 'weight',
-         'url': '/{user_id}/body/weight/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'sleep-awakenings',
-         'url': '/{user_id}/sleep/awakeningsCount/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'sleep-efficiency',
-         'url': '/{user_id}/sleep/efficiency/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'sleep-minutes-after-wakeup',
-         'url': '/{user_id}/sleep/minutesAfterWakeup/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'sleep-minutes',
-         'url': '/{user_id}/sleep/minutesAsleep/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'awake-minutes',
-         'url': '/{user_id}/sleep/minutesAwake/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'minutes-to-sleep',
-         'url': '/{user_id}/sleep/minutesToFallAsleep/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'sleep-start-time',
-         'url': '/{user_id}/sleep/startTime/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-        {'name': 'time-in-bed',
-         'url': '/{user_id}/sleep/timeInBed/date/{start_date}/{end_date}.json',
-         'period': 'year'},
-    ]
     print("entered function")
 
     # Get Fitbit member object
@@ -125,239 +71,567 @@ def fetch_fitbit_data(fitbit_member_id, access_token):
     # Get user again so we have updated tokens and not the original ones
     # fitbit_member = FitbitMember.objects.get(id=fitbit_member_id)
 
-    oh_access_token = fitbit_member.user.get_access_token()
     fitbit_access_token = fitbit_member.get_access_token()
 
-    # Get existing data as currently stored on OH
-    fitbit_data = get_existing_fitbit(oh_access_token, fitbit_urls)
-
     # Set up user realm since rate limiting is per-user
     print(fitbit_member.user)
-    user_realm = 'fitbit-{}'.format(fitbit_member.user.oh_id)
-    rr.register_realm(user_realm, max_requests=150, timespan=3600)
-    rr.update_realm(user_realm, max_requests=150, timespan=3600)
+    user_realm = register_user_realm(fitbit_member)
 
-    # Get initial information about user from Fitbit
-    print("Creating header and going to get user profile")
     headers = {'Authorization': "Bearer %s" % fitbit_access_token}
-    query_result = requests.get('https://api.fitbit.com/1/user/-/profile.json', headers=headers).json()
+
+    # Slices fetched so far in this sync, including ones fetched before an
+    # earlier run of it was rate-limited
+    state, _ = FitbitSyncState.objects.get_or_create(fitbit_member=fitbit_member)
+    fitbit_data = state.get_pending_data()
+    if 'profile' in fitbit_data:
+        logger.info('Resuming sync for {} with {} slices fetched'.format(
+            fitbit_member.user.oh_id, len(list(iter_slices(fitbit_data)))))
+    else:
+        # Nothing new can be on Fitbit if no tracker synced since the last
+        # completed sync, so don't spend any of the member's requests
+        device_sync = last_device_sync(headers, ["Fitbit", user_realm])
+        if (device_sync is not None and
+                device_sync == fitbit_member.last_device_sync):
+            logger.info('No tracker sync for {} since {}, skipping'.format(
+                fitbit_member.user.oh_id, device_sync))
+            # Their data is up to date, so the scheduler doesn't dispatch
+            # them again before the next interval
+            fitbit_member.last_updated = arrow.now().format()
+            fitbit_member.save(update_fields=['last_updated'])
+            release_sync(fitbit_member_id)
+            return
+        state.device_sync = device_sync or ''
+
+        # Get initial information about user from Fitbit
+        print("Creating header and going to get user profile")
+        fitbit_data['profile'] = get_fitbit_profile(headers)
+        state.started_at = arrow.now().datetime
 
     # Store the user ID since it's used in all future queries
-    user_id = query_result['user']['encodedId']
-    member_since = query_result['user']['memberSince']
-    start_date = arrow.get(member_since, 'YYYY-MM-DD')
-    # if not fitbit_data:
-    #     start_date = arrow.get(member_since, 'YYYY-MM-DD')
+    user_id = fitbit_data['profile']['encodedId']
+    start_date = arrow.get(fitbit_data['profile']['memberSince'], 'YYYY-MM-DD')
 
-    print(query_result)
+    # Checkpoints tell what is already stored on OH. Members synced before
+    # checkpoints existed get them from their existing archive once.
+    tmp_directory = tempfile.mkdtemp()
+    checkpoints = load_checkpoints(fitbit_member)
+    existing_archive = None
+    if not checkpoints:
+        existing_archive = get_existing_fitbit(fitbit_member.user,
+                                               tmp_directory)
+        if archive_user_id(existing_archive) == user_id:
+            with open_archive(existing_archive) as fh:
+                checkpoints = seed_checkpoints(fitbit_member,
+                                               iter_archive_slices(fh))
 
-    # fitbit_data = {}
-    # print(fitbit_data)
+    print("entering try block")
+    rate_limited = None
+    fetched = False
+    try:
+        complete = complete_slices(checkpoints)
+        complete.update((name, period) for name, period, _ in iter_slices(fitbit_data))
+        # Stored periods that can still change are only fetched from the
+        # first day that may have, and merged into what's stored
+        stale = {key: day for key, day in stale_days(checkpoints).items()
+                 if key not in complete}
+        stored = {}
+        if stale:
+            stored, existing_archive = get_stored_slices(
+                fitbit_member, set(stale), tmp_directory,
+                existing_archive=existing_archive)
+        slices = plan_slices(complete, user_id, start_date,
+                             stale={key: stale[key] for key in stored})
+        logger.info('{} requests planned for {}, {} slices complete'.format(
+            len(slices), fitbit_member.user.oh_id, len(complete)))
+        fetch_slices(slices, headers, ["Fitbit", user_realm], fitbit_data,
+                     stored=stored)
 
-    # Refresh token if the result is 401
-    # TODO: update this so it just checks the expired field.
-    # if query_result.status_code == 401:
-    #     fitbit_member._refresh_tokens()
+        # Update the last updated date if the data successfully completes
+        fitbit_member.last_updated = arrow.now().format()
+        # Only this field: the tokens may have been refreshed meanwhile
+        fitbit_member.save(update_fields=['last_updated'])
+        fetched = True
 
-    if not fitbit_data:
-        print("empty data")
-        # fitbit_data = {}
-        # return
+    except RequestsRespectfulRateLimitedError as e:
+        logging.info('Requests-respectful reports rate limit hit.')
+        rate_limited = e
+    finally:
+        try:
+            if rate_limited is None:
+                print("calling finally")
+                synced = sync_fitbit(fitbit_member, fitbit_data, checkpoints,
+                                     state.started_at, tmp_directory,
+                                     existing_archive=existing_archive)
+                if fetched and synced:
+                    fitbit_member.last_device_sync = state.device_sync
+                    fitbit_member.save(update_fields=['last_device_sync'])
+                state.reset()
+                if not synced:
+                    fetch_fitbit_data.delay(fitbit_member_id,
+                                            fitbit_access_token)
+        finally:
+            if rate_limited is None and state.resume_at is not None:
+                # A resumed sync failed and nothing will resume it again,
+                # so the scheduler picks it up; pending_data is kept
+                state.resume_at = None
+                state.save(update_fields=['resume_at'])
+            shutil.rmtree(tmp_directory)
+            release_sync(fitbit_member_id)
+        logger.info('HTTP connection reuse: {}'.format(connection_stats()))
+        logger.info('Uploads so far: {}'.format(upload_counts()))
+
+    if rate_limited is not None:
+        resume_later(state, fitbit_data, rate_limited.retry_at,
+                     args=[fitbit_member_id, fitbit_access_token])
 
-    # Reset data if user account ID has changed.
-    print("reset data if user account ID changed")
-    if 'profile' in fitbit_data:
-        if fitbit_data['profile']['encodedId'] != user_id:
-            logging.info(
-                'User ID changed from {} to {}. Resetting all data.'.format(
-                    fitbit_data['profile']['encodedId'], user_id))
-            fitbit_data = {}
-            for url in fitbit_urls:
-                fitbit_data[url['name']] = {}
-        else:
-            logging.debug('User ID ({}) matches old data.'.format(user_id))
 
-    fitbit_data['profile'] = {
+@shared_task
+def schedule_fitbit_syncs():
+    """
+    Start the syncs of stale members that fit in the free part of the
+    global Fitbit budget, run periodically by Celery beat.
+    """
+    return len(schedule_syncs())
+
+
+@shared_task
+def refresh_fitbit_tokens(within=None):
+    """
+    Refresh the Fitbit and Open Humans tokens expiring within the given
+    number of seconds (FITBIT_TOKEN_REFRESH_AHEAD by default), run
+    periodically by Celery beat.
+    """
+    if within is None:
+        within = settings.FITBIT_TOKEN_REFRESH_AHEAD
+    return refresh_expiring_tokens(within)
+
+
+def register_user_realm(fitbit_member):
+    user_realm = 'fitbit-{}'.format(fitbit_member.user.oh_id)
+    rr.register_realm(user_realm, max_requests=MEMBER_MAX_REQUESTS,
+                      timespan=3600)
+    rr.update_realm(user_realm, max_requests=MEMBER_MAX_REQUESTS,
+                    timespan=3600)
+    return user_realm
+
+
+def get_fitbit_profile(headers):
+    query_result = session.get('https://api.fitbit.com/1/user/-/profile.json', headers=headers).json()
+    return {
         'averageDailySteps': query_result['user']['averageDailySteps'],
-        'encodedId': user_id,
+        'encodedId': query_result['user']['encodedId'],
         'height': query_result['user']['height'],
-        'memberSince': member_since,
+        'memberSince': query_result['user']['memberSince'],
         'strideLengthRunning': query_result['user']['strideLengthRunning'],
         'strideLengthWalking': query_result['user']['strideLengthWalking'],
         'weight': query_result['user']['weight']
     }
 
-    print("entering try block")
+
+@shared_task
+def process_fitbit_notifications(owner_id):
+    """
+    Fetch and upload only the days Fitbit sent notifications for since the
+    last run, for the member with Fitbit user ID owner_id.
+    """
+    notifications = pop_notifications(owner_id)
+    fitbit_member = FitbitMember.objects.filter(userid=owner_id).first()
+    if not notifications or fitbit_member is None:
+        return
+    logger.info('{} notifications for {}'.format(
+        len(notifications), fitbit_member.user.oh_id))
     try:
-        # Some block about if the period is none
-        print("period none")
-        for url in [u for u in fitbit_urls if u['period'] is None]:
-            if not user_id and 'profile' in fitbit_data:
-                user_id = fitbit_data['profile']['user']['encodedId']
-
-            # Build URL
-            fitbit_api_base_url = 'https://api.fitbit.com/1/user'
-            final_url = fitbit_api_base_url + url['url'].format(user_id=user_id)
-            # Fetch the data
-            print(final_url)
-            r = rr.get(url=final_url,
-                    headers=headers,
-                    realms=["Fitbit", 'fitbit-{}'.format(fitbit_member.user.oh_id)])
-            print(r.text)
-
-            # print(fitbit_data)
-            fitbit_data[url['name']] = r.json()
-
-        #Period year URLs
-        print("period year")
-        # print(fitbit_data)
-        for url in [u for u in fitbit_urls if u['period'] == 'year']:
-            # print("LOOPED OVER A URL" + str(url))
-            print("attempting to print the latest YEAR that data is present")
-            if len(list(fitbit_data[url['name']].keys())) > 0:
-                print(sorted(fitbit_data[url['name']].keys())[-1])
-                last_present_year = sorted(fitbit_data[url['name']].keys())[-1]
-            else:
-                print('no prior data')
-                last_present_year = ""
-
-            years = arrow.Arrow.range('year', start_date.floor('year'),
-                                    arrow.get())
-            # print(years)
-            for year_date in years:
-                # print(year_date)
-                year = year_date.format('YYYY')
-
-                if year in fitbit_data[url['name']] and year != last_present_year:
-                    logger.info('Skip retrieval {}: {}'.format(url['name'], year))
-                    continue
-
-                logger.info('Retrieving %s: %s', url['name'], year)
-                # Build URL
-                fitbit_api_base_url = 'https://api.fitbit.com/1/user'
-                final_url = fitbit_api_base_url + url['url'].format(user_id=user_id,
-                                                                    start_date=year_date.floor('year').format('YYYY-MM-DD'),
-                                                                    end_date=year_date.ceil('year').format('YYYY-MM-DD'))
-                # Fetch the data
-                print(final_url)
-                r = rr.get(url=final_url,
-                        headers=headers,
-                        realms=["Fitbit", 'fitbit-{}'.format(fitbit_member.user.oh_id)])
-
-                # print([url['name']]['blah'])
-                # print([str(year)])
-                fitbit_data[url['name']][str(year)] = r.json()
-
-        # Month period URLs/fetching
-        # print(fitbit_data)
-        print("period month")
-        for url in [u for u in fitbit_urls if u['period'] == 'month']:
-            # get the last time there was data
-            print("attempting to print the latest month that data is present")
-            if len(list(fitbit_data[url['name']].keys())) > 0:
-                print(sorted(fitbit_data[url['name']].keys())[-1])
-                last_present_month = sorted(fitbit_data[url['name']].keys())[-1]
-            else:
-                print('no prior month')
-                last_present_month = ""
-
-            months = arrow.Arrow.range('month', start_date.floor('month'),
-                                    arrow.get())
-            for month_date in months:
-                month = month_date.format('YYYY-MM')
-
-                # print("in month loop, here is the json data")
-                # print(fitbit_data[url['name']][month])
-
-                if month in fitbit_data[url['name']] and month != last_present_month:
-                    print("skipping month, data is there")
-                    print(month)
-                    logger.info('Skip retrieval {}: {}'.format(url['name'], month))
-                    continue
-
-                logger.info('Retrieving %s: %s', url['name'], month)
-                # Build URL
-                fitbit_api_base_url = 'https://api.fitbit.com/1/user'
-                final_url = fitbit_api_base_url + url['url'].format(user_id=user_id,
-                                                                    start_date=month_date.floor('month').format('YYYY-MM-DD'),
-                                                                    end_date=month_date.ceil('month').format('YYYY-MM-DD'))
-                # Fetch the data
-                print(final_url)
-                r = rr.get(url=final_url,
-                        headers=headers,
-                        realms=["Fitbit", 'fitbit-{}'.format(fitbit_member.user.oh_id)])
-
-                fitbit_data[url['name']][month] = r.json()
+        refresh_days(fitbit_member, notified_days(notifications))
+    except RequestsRespectfulRateLimitedError as e:
+        countdown = (retry_time(e.retry_at) - arrow.now()).total_seconds()
+        queue_notifications(owner_id, notifications,
+                            countdown=max(countdown, 0))
 
-        # Update the last updated date if the data successfully completes
-        fitbit_member.last_updated = arrow.now().format()
-        fitbit_member.save()
 
-    except RequestsRespectfulRateLimitedError:
-        logging.info('Requests-respectful reports rate limit hit.')
-        print("hit requests respectful rate limit, going to requeue")
-        fetch_fitbit_data.apply_async(args=[fitbit_member_id, fitbit_access_token], countdown=3600)
-        # raise RateLimitException()
+@shared_task
+def refresh_fitbit_day(fitbit_member_id, collections, date):
+    """
+    Fetch only the given day of the given collections (e.g. 'activities',
+    'sleep') or endpoints of a member, and merge it into their data on OH.
+    date is a 'YYYY-MM-DD' date or a list of them.
+    """
+    fitbit_member = FitbitMember.objects.get(id=fitbit_member_id)
+    dates = [date] if isinstance(date, str) else list(date)
+    days = {name: set(dates) for name in collection_endpoints(collections)}
+    try:
+        refresh_days(fitbit_member, days)
+    except RequestsRespectfulRateLimitedError as e:
+        refresh_fitbit_day.apply_async(
+            args=[fitbit_member_id, collections, date],
+            eta=retry_time(e.retry_at).datetime)
+
+
+def refresh_days(fitbit_member, days):
+    """
+    Fetch just the given days ({endpoint: dates}) of a member and merge
+    them into the slices stored on OH. A slice that isn't stored yet is
+    fetched whole, so no partial slice is ever stored. Nothing is uploaded
+    if a rate limit is hit.
+    """
+    fitbit_access_token = fitbit_member.get_access_token()
+    user_realm = register_user_realm(fitbit_member)
+    headers = {'Authorization': "Bearer %s" % fitbit_access_token}
+    user_id = fitbit_member.userid
+
+    tmp_directory = tempfile.mkdtemp()
+    try:
+        wanted = {(s['name'], key) for s in plan_day_slices(days, user_id)
+                  for key in s['keys']}
+        stored, existing_archive = get_stored_slices(
+            fitbit_member, wanted, tmp_directory)
+        whole = wanted - set(stored)
+        slices = plan_day_slices(days, user_id, whole=whole)
+        logger.info('Refreshing {} slices ({} whole) for {}'.format(
+            len(slices), len(whole), fitbit_member.user.oh_id))
+
+        fetched_at = arrow.now().datetime
+        checkpoints = load_checkpoints(fitbit_member)
+        fitbit_data = {}
+        fetch_slices(slices, headers, ["Fitbit", user_realm], fitbit_data,
+                     stored=stored)
+        # Stored periods only got the given days, so they keep the time
+        # they were last fetched whole or up to
+        if not sync_fitbit(fitbit_member, fitbit_data, checkpoints,
+                           fetched_at, tmp_directory,
+                           existing_archive=existing_archive,
+                           merged=set(stored)):
+            fetch_fitbit_data.delay(fitbit_member.id, fitbit_access_token)
     finally:
-        print("calling finally")
-        # print(fitbit_data)
-        replace_fitbit(fitbit_member.user, fitbit_data)
+        shutil.rmtree(tmp_directory)
+
+
+def get_stored_slices(fitbit_member, wanted, tmp_directory,
+                      existing_archive=None):
+    """
+    Return {(endpoint, period): data} for the wanted slices that are
+    stored on OH, and the path of the single-file archive if it was read
+    (a downloaded one can be passed as existing_archive).
+    """
+    stored = {}
+    if (settings.FITBIT_ARCHIVE_LAYOUT == 'split' and
+            fitbit_member.archive_files.exists()):
+        member_files = newest_files(
+            get_member_data(fitbit_member.user)['data'])
+        data_files = {dfile['basename']: dfile for dfile in member_files
+                      if is_split_file(dfile)}
+        names = {split_basename(name, key): name for name, key in wanted}
+        for basename, name in names.items():
+            if basename not in data_files:
+                continue
+            path = os.path.join(tmp_directory, 'existing-' + basename)
+            download_archive(data_files[basename]['download_url'], path)
+            for key, data in read_split_file(path).items():
+                if (name, key) in wanted:
+                    stored[(name, key)] = data
+        return stored, existing_archive
+
+    if existing_archive is None:
+        existing_archive = get_existing_fitbit(fitbit_member.user,
+                                               tmp_directory)
+    if archive_user_id(existing_archive) == fitbit_member.userid:
+        with open_archive(existing_archive) as fh:
+            for name, key, data in iter_archive_slices(fh):
+                if (name, key) in wanted:
+                    stored[(name, key)] = data
+    return stored, existing_archive
+
+
+def retry_time(retry_at):
+    """
+    When to retry after a rate limit that lifts at retry_at (a timestamp,
+    or None if unknown).
+    """
+    if retry_at is None:
+        return arrow.now().shift(hours=1)
+    return arrow.get(retry_at).shift(seconds=1)
+
 
-    # return fitbit_data
+def resume_later(state, fitbit_data, retry_at, args):
+    """
+    Keep the slices fetched so far, which the resumed sync doesn't fetch
+    again, and requeue it for when the rate limiter has room again.
+    """
+    resume_at = retry_time(retry_at)
+    state.pending_data = json.dumps(fitbit_data)
+    state.resume_at = resume_at.datetime
+    state.save()
+    print("hit requests respectful rate limit, requeueing for {}".format(
+        resume_at))
+    fetch_fitbit_data.apply_async(args=args, eta=resume_at.datetime)
 
 
-def get_existing_fitbit(oh_access_token, fitbit_urls):
+def sync_fitbit(fitbit_member, fitbit_data, checkpoints, fetched_at,
+                tmp_directory, existing_archive=None, merged=()):
+    """
+    Merge newly fetched slices into the archive on OH, downloading and
+    replacing it only if any slice differs from its checkpoint. Slices in
+    merged, as (endpoint, period), only had some days fetched and keep
+    the fetched_at of their checkpoint.
+    Returns False without uploading anything if the archive the
+    checkpoints describe is gone from OH; the checkpoints are then
+    deleted and the member needs a full sync.
+    """
+    changed = changed_slices(checkpoints, fitbit_data)
+    if (changed and checkpoints and existing_archive is None and
+            not fitbit_member.archive_files.exists()):
+        existing_archive = get_existing_fitbit(fitbit_member.user,
+                                               tmp_directory)
+        if existing_archive is None:
+            # Uploading only this sync's slices would lose the periods
+            # the checkpoints have as complete for good
+            logger.warning('Archive of {} is missing on OH, refetching '
+                           'all data'.format(fitbit_member.user.oh_id))
+            fitbit_member.checkpoints.all().delete()
+            # So the full sync isn't skipped for lack of tracker syncs
+            fitbit_member.last_device_sync = ''
+            fitbit_member.save(update_fields=['last_device_sync'])
+            return False
+    if changed and settings.FITBIT_ARCHIVE_LAYOUT == 'split':
+        logger.info('{} changed slices for {}'.format(
+            len(changed), fitbit_member.user.oh_id))
+        replace_fitbit_files(fitbit_member, fitbit_data, tmp_directory,
+                             existing_archive=existing_archive)
+    elif changed:
+        logger.info('{} changed slices for {}'.format(
+            len(changed), fitbit_member.user.oh_id))
+        if existing_archive is None:
+            existing_archive = get_existing_fitbit(fitbit_member.user,
+                                                   tmp_directory)
+
+        # Reset data if user account ID has changed.
+        user_id = fitbit_user_id(fitbit_member, fitbit_data)
+        existing_id = archive_user_id(existing_archive)
+        if existing_id is not None:
+            if existing_id != user_id:
+                logging.info(
+                    'User ID changed from {} to {}. Resetting all data.'.format(
+                        existing_id, user_id))
+                existing_archive = None
+                fitbit_member.checkpoints.all().delete()
+            else:
+                logging.debug('User ID ({}) matches old data.'.format(user_id))
+
+        if existing_archive is None:
+            new_data = empty_fitbit_data()
+            new_data.update(fitbit_data)
+            fitbit_data = new_data
+        replace_fitbit(fitbit_member, fitbit_data,
+                       existing_archive=existing_archive)
+    else:
+        logger.info('No changes for {}, skipping upload'.format(
+            fitbit_member.user.oh_id))
+        count_upload(False)
+    save_checkpoints(fitbit_member, fitbit_data, fetched_at,
+                     merged={key: checkpoints.get(key) for key in merged})
+    if changed:
+        # Cached again for the dashboard, the upload invalidated it
+        try:
+            get_member_data(fitbit_member.user)
+        except Exception as e:
+            logger.warning('Could not cache the files of {}: {}'.format(
+                fitbit_member.user.oh_id, e))
+    return True
+
+
+def fitbit_user_id(fitbit_member, fitbit_data):
+    # Refreshes of some days don't fetch the profile
+    if 'profile' in fitbit_data:
+        return fitbit_data['profile']['encodedId']
+    return fitbit_member.userid
+
+
+def get_existing_fitbit(oh_member, tmp_directory):
+    """
+    Download the member's archive on OH into tmp_directory, in chunks.
+    Returns its path, or None if the member has no archive yet.
+    """
     print("entered get_existing_fitbit")
-    member = api.exchange_oauth2_member(oh_access_token)
-    for dfile in member['data']:
-        if 'Fitbit' in dfile['metadata']['tags']:
-            print("got inside fitbit if")
-            # get file here and read the json into memory
-            tf_in = tempfile.NamedTemporaryFile(suffix='.json')
-            tf_in.write(requests.get(dfile['download_url']).content)
-            tf_in.flush()
-            fitbit_data = json.load(open(tf_in.name))
-            print("fetched existing data from OH")
-            # print(fitbit_data)
-            return fitbit_data
-    fitbit_data = {}
-    for url in fitbit_urls:
-        fitbit_data[url['name']] = {}
-    return fitbit_data
-
-
-def replace_fitbit(oh_member, fitbit_data):
+    member = get_member_data(oh_member)
+    dfile = find_archive_file(member['data'])
+    if dfile is None:
+        return None
+    print("got inside fitbit if")
+    if dfile.get('basename', '').endswith('.gz'):
+        filename = ARCHIVE_FILENAMES['json.gz']
+    else:
+        filename = ARCHIVE_FILENAMES['json']
+    path = os.path.join(tmp_directory, 'existing-' + filename)
+    download_archive(dfile['download_url'], path)
+    print("fetched existing data from OH")
+    return path
+
+
+def archive_user_id(path):
+    """
+    Return the Fitbit user ID of the archive at path, reading only its
+    profile, or None if there is no archive or it has no profile.
+    """
+    if path is None:
+        return None
+    with open_archive(path) as fh:
+        profile, _ = read_archive_index(fh)
+    return (profile or {}).get('encodedId')
+
+
+def replace_fitbit(fitbit_member, fitbit_data, existing_archive=None):
+    """
+    Replace the member's archive on OH with fitbit_data, merged into the
+    downloaded archive at existing_archive if given. Nothing is deleted
+    or uploaded if the result is the archive that is already there.
+    """
     print("replace function started")
+    oh_member = fitbit_member.user
     # delete old file and upload new to open humans
-    tmp_directory = tempfile.mkdtemp()
     metadata = {
         'description':
         'Fitbit data.',
         'tags': ['Fitbit', 'activity', 'steps'],
         'updated_at': str(datetime.utcnow()),
         }
-    out_file = os.path.join(tmp_directory, 'fitbit-data.json')
-    logger.debug('deleted old file for {}'.format(oh_member.oh_id))
-    deleter = api.delete_file(oh_member.access_token,
-                    oh_member.oh_id,
-                    file_basename="fitbit-data.json")
-    print("delete response")
-    print(deleter)
-    print("trying to write to file")
-    with open(out_file, 'w') as json_file:
-        print("inside open file")
-        # json.dump(fitbit_data, json_file)
-        json_file.write(json.dumps(fitbit_data))
-        # print(json.dump(fitbit_data, json_file))
-        print("dumped, trying to flush")
-        json_file.flush()
-    print("attempting add response")
-    addr = api.upload_aws(out_file, metadata,
-                   oh_member.access_token,
-                   project_member_id=oh_member.oh_id)
-    print("add response")
-    print(addr)
-    logger.debug('uploaded new file for {}'.format(oh_member.oh_id))
+    tmp_directory = tempfile.mkdtemp()
+    try:
+        written_file = os.path.join(tmp_directory, archive_filename())
+        print("trying to write to file")
+        with open_archive(written_file, 'w') as json_file:
+            writer = DigestWriter(json_file, archive_filename())
+            # Written slice by slice, never as one string
+            if existing_archive is None:
+                write_archive(fitbit_data, writer)
+            else:
+                with open_archive(existing_archive) as existing:
+                    merge_archive(existing, fitbit_data, writer)
+        archive_hash = writer.hexdigest()
+        # Without an existing archive there is nothing on OH to keep
+        if (existing_archive is not None and
+                archive_hash == fitbit_member.archive_hash):
+            count_upload(False)
+            logger.info('Archive of {} unchanged, skipping upload'.format(
+                oh_member.oh_id))
+            return
+        # Uploaded next to the old archive, which is only deleted once the
+        # new one is complete, so the member always has one
+        out_file = os.path.join(tmp_directory, archive_filename(archive_hash))
+        os.rename(written_file, out_file)
+        print("attempting add response")
+        upload_file_with_retries(oh_member, out_file, metadata)
+        old_filenames = archive_filenames(fitbit_member.archive_hash)
+        fitbit_member.archive_hash = archive_hash
+        fitbit_member.save(update_fields=['archive_hash'])
+        count_upload(True)
+        logger.debug('uploaded new file for {}'.format(oh_member.oh_id))
+        # Also removes the archive in the other format after a switch
+        for filename in old_filenames:
+            if filename != os.path.basename(out_file):
+                delete_oh_file_by_name(oh_member, filename=filename)
+        logger.debug('deleted old file for {}'.format(oh_member.oh_id))
+    finally:
+        shutil.rmtree(tmp_directory)
+
+
+def replace_fitbit_files(fitbit_member, fitbit_data, tmp_directory,
+                         existing_archive=None):
+    """
+    Upload the files of the split layout whose content fitbit_data changes
+    and leave the others on OH untouched. On a member's first sync in this
+    layout their single-file archive is split up, then removed.
+    """
+    oh_member = fitbit_member.user
+    member_files = [dfile for dfile in get_member_data(oh_member)['data']
+                    if is_split_file(dfile)]
+    data_files = {dfile['basename']: dfile
+                  for dfile in newest_files(member_files)}
+    stored = {f.basename: f for f in fitbit_member.archive_files.all()}
+    files = split_slices(iter_slices(fitbit_data))
+
+    # Reset data if user account ID has changed.
+    user_id = fitbit_user_id(fitbit_member, fitbit_data)
+    profile_file = data_files.get(split_basename('profile', ''))
+    if profile_file is not None:
+        path = os.path.join(tmp_directory,
+                            'existing-' + profile_file['basename'])
+        download_archive(profile_file['download_url'], path)
+        existing_id = read_split_file(path).get('encodedId')
+        if existing_id != user_id:
+            logging.info(
+                'User ID changed from {} to {}. Resetting all data.'.format(
+                    existing_id, user_id))
+            for basename in data_files:
+                delete_oh_file_by_name(oh_member, filename=basename)
+            data_files = {}
+            stored = {}
+            fitbit_member.archive_files.all().delete()
+            fitbit_member.checkpoints.all().delete()
+
+    legacy_archive = None
+    if not stored:
+        legacy_archive = existing_archive or get_existing_fitbit(
+            oh_member, tmp_directory)
+    if legacy_archive is not None:
+        if archive_user_id(legacy_archive) == user_id:
+            # Split up once, so this holds the history in memory
+            with open_archive(legacy_archive) as fh:
+                legacy_files = split_slices(iter_archive_slices(fh))
+            for basename, (name, content) in legacy_files.items():
+                if basename not in files:
+                    files[basename] = (name, content)
+                elif PERIODS.get(name) is not None:
+                    content.update(files[basename][1])
+                    files[basename] = (name, content)
+        else:
+            fitbit_member.checkpoints.all().delete()
+
+    uploads = {}
+    for basename, (name, content) in sorted(files.items()):
+        # A month is only part of its year's file
+        if PERIODS.get(name) == 'month' and basename in data_files:
+            path = os.path.join(tmp_directory, 'existing-' + basename)
+            download_archive(data_files[basename]['download_url'], path)
+            existing = read_split_file(path)
+            existing.update(content)
+            content = existing
+        content_hash = slice_hash(content)
+        if basename in stored and stored[basename].content_hash == content_hash:
+            count_upload(False)
+            continue
+        path = os.path.join(tmp_directory, basename)
+        write_split_file(path, content)
+        metadata = {
+            'description': 'Fitbit {} data.'.format(name),
+            'tags': ['Fitbit', name],
+            'updated_at': str(datetime.utcnow()),
+            }
+        uploads[path] = (basename, content_hash, metadata)
+
+    uploaded = 0
+    for path, oh_file_id in upload_files(
+            oh_member, [(path, metadata)
+                        for path, (_, _, metadata) in uploads.items()]):
+        basename, content_hash, _ = uploads[path]
+        FitbitArchiveFile.objects.update_or_create(
+            fitbit_member=fitbit_member, basename=basename,
+            defaults={'content_hash': content_hash, 'oh_file_id': oh_file_id,
+                      'uploaded_at': arrow.now().datetime})
+        count_upload(True)
+        uploaded += 1
+        # The versions it replaces, now that it is complete
+        old_ids = {dfile['id'] for dfile in member_files
+                   if dfile['basename'] == basename}
+        if basename in stored and stored[basename].oh_file_id:
+            old_ids.add(stored[basename].oh_file_id)
+        for file_id in old_ids - {oh_file_id}:
+            delete_oh_file_by_id(oh_member, file_id)
+    if legacy_archive is not None:
+        for filename in archive_filenames(fitbit_member.archive_hash):
+            delete_oh_file_by_name(oh_member, filename=filename)
+        fitbit_member.archive_hash = ''
+        fitbit_member.save(update_fields=['archive_hash'])
+    logger.info('Uploaded {} of {} touched files for {}'.format(
+        uploaded, len(files), oh_member.oh_id))
 
 
 @shared_task
@@ -429,12 +703,71 @@ def delete_oh_file_by_name(oh_member, filename):
     API options here:
     https://www.openhumans.org/direct-sharing/oauth2-data-upload/#deleting-files
     """
-    req = requests.post(
+    req = session.post(
         settings.OH_DELETE_FILES,
         params={'access_token': oh_member.get_access_token()},
         data={'project_member_id': oh_member.oh_id,
               'file_basename': filename})
     req.raise_for_status()
+    invalidate_member_data(oh_member)
+
+
+def delete_oh_file_by_id(oh_member, file_id):
+    """
+    Delete one project file of this Open Humans member by its ID.
+    """
+    req = session.post(
+        settings.OH_DELETE_FILES,
+        params={'access_token': oh_member.get_access_token()},
+        data={'project_member_id': oh_member.oh_id,
+              'file_id': file_id})
+    req.raise_for_status()
+    invalidate_member_data(oh_member)
+
+
+def upload_file_with_retries(oh_member, filepath, metadata):
+    """
+    Upload a file with upload_file_to_oh, starting over with a new S3
+    target after a failure up to HTTP_MAX_RETRIES times, with backoff.
+    The file is already on disk, so nothing is fetched again.
+    """
+    for attempt in range(settings.HTTP_MAX_RETRIES + 1):
+        try:
+            return upload_file_to_oh(oh_member, filepath, metadata)
+        except requests.RequestException as e:
+            if attempt == settings.HTTP_MAX_RETRIES:
+                raise
+            delay = settings.HTTP_BACKOFF_FACTOR * 2 ** attempt
+            logger.warning('Upload of {} for {} failed ({}), retrying in '
+                           '{} s'.format(os.path.basename(filepath),
+                                         oh_member.oh_id, e, delay))
+            time.sleep(delay)
+
+
+def upload_files(oh_member, uploads, concurrency=None):
+    """
+    Upload (filepath, metadata) pairs with up to FITBIT_UPLOAD_CONCURRENCY
+    of them in flight, each with upload_file_with_retries, yielding
+    (filepath, file ID) as each completes. If any fails, the others are
+    still completed and yielded before the first error is raised.
+    """
+    concurrency = concurrency or settings.FITBIT_UPLOAD_CONCURRENCY
+    # Refreshed once here if needed, not by all uploads at once
+    oh_member.get_access_token()
+    failures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(upload_file_with_retries, oh_member,
+                                   filepath, metadata): filepath
+                   for filepath, metadata in uploads}
+        for future in as_completed(futures):
+            try:
+                oh_file_id = future.result()
+            except Exception as e:
+                failures.append(e)
+                continue
+            yield futures[future], oh_file_id
+    if failures:
+        raise failures[0]
 
 
 def upload_file_to_oh(oh_member, filepath, metadata):
@@ -449,7 +782,7 @@ def upload_file_to_oh(oh_member, filepath, metadata):
     # Get the S3 target from Open Humans.
     upload_url = '{}?access_token={}'.format(
         settings.OH_DIRECT_UPLOAD, oh_member.get_access_token())
-    req1 = requests.post(
+    req1 = session.post(
         upload_url,
         data={'project_member_id': oh_member.oh_id,
               'filename': os.path.basename(filepath),
@@ -458,17 +791,19 @@ def upload_file_to_oh(oh_member, filepath, metadata):
 
     # Upload to S3 target.
     with open(filepath, 'rb') as fh:
-        req2 = requests.put(url=req1.json()['url'], data=fh)
+        req2 = session.put(url=req1.json()['url'], data=fh)
     req2.raise_for_status()
 
     # Report completed upload to Open Humans.
     complete_url = ('{}?access_token={}'.format(
         settings.OH_DIRECT_UPLOAD_COMPLETE, oh_member.get_access_token()))
-    req3 = requests.post(
+    req3 = session.post(
         complete_url,
         data={'project_member_id': oh_member.oh_id,
               'file_id': req1.json()['id']})
     req3.raise_for_status()
+    invalidate_member_data(oh_member)
 
     logger.debug('Upload done: "{}" for member {}.'.format(
             os.path.basename(filepath), oh_member.oh_id))
+    return req1.json()['id']
@@ -0,0 +1,703 @@
+from django.conf import settings
+from django.test import TestCase, override_settings
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from urllib.parse import parse_qs
+import arrow
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+from main.models import FitbitMember, FitbitSyncState
+from open_humans.models import OpenHumansMember
+from requests_respectful import RequestsRespectfulRateLimitedError
+
+from .archive import (find_archive_file, iter_archive_slices, merge_archive,
+                      open_archive, read_archive_index, write_archive)
+from .checkpoints import (changed_slices, complete_slices, iter_slices,
+                          load_checkpoints, save_checkpoints, seed_checkpoints,
+                          slice_hash)
+from .fetch import (PERIOD_FORMATS, fitbit_urls, last_device_sync,
+                    merge_days, plan_day_slices, plan_slices, store_slice)
+from .scheduler import PendingSync, pending_syncs, plan_dispatch
+from .split import is_split_file, split_slices
+from .tasks import (fetch_fitbit_data, refresh_days, replace_fitbit,
+                    upload_files)
+from .tokens import refresh_expiring_tokens
+from .upload_stub import UploadStub
+from .uploads import reset_upload_counts, upload_counts
+
+
+class PlanSlicesTestCase(TestCase):
+    """
+    Test which requests are planned for a member's Fitbit data
+    """
+
+    def test_empty_data_requests_every_period(self):
+        start_date = arrow.get().shift(years=-4)
+        slices = plan_slices(set(), 'ABC123', start_date)
+        for url in fitbit_urls:
+            planned = [s for s in slices if s['name'] == url['name']]
+            self.assertTrue(all('ABC123' in s['url'] for s in planned))
+            if url['period'] is None:
+                self.assertEqual(len(planned), 1)
+                continue
+            periods = [p.format(PERIOD_FORMATS[url['period']])
+                       for p in arrow.Arrow.range(
+                           url['period'], start_date.floor(url['period']),
+                           arrow.get())]
+            self.assertEqual([key for s in planned for key in s['keys']],
+                             periods)
+            for data_slice in planned:
+                span = arrow.get(data_slice['end_date']) - arrow.get(
+                    data_slice['start_date'])
+                self.assertLess(span.days, url['max_days'])
+            # Years are coalesced up to the 1095 days allowed
+            if url['period'] == 'year':
+                self.assertLess(len(planned), len(periods))
+
+    def test_complete_periods_are_skipped(self):
+        start_date = arrow.get('2016-01-01')
+        complete = {('tracker-steps', '2016')}
+        slices = plan_slices(complete, 'ABC123', start_date)
+        keys = [key for s in slices if s['name'] == 'tracker-steps'
+                for key in s['keys']]
+        self.assertNotIn('2016', keys)
+        self.assertIn('2017', keys)
+        self.assertIn(arrow.get().format('YYYY'), keys)
+
+    def test_stale_periods_only_request_new_days(self):
+        this_month = arrow.get().floor('month')
+        last_month = this_month.shift(months=-1)
+        start_date = last_month.shift(months=-2)
+        complete = {('heart', start_date.format('YYYY-MM')),
+                    ('heart', start_date.shift(months=1).format('YYYY-MM'))}
+        stale = {('heart', last_month.format('YYYY-MM')):
+                 last_month.shift(days=25).format('YYYY-MM-DD')}
+        slices = [s for s in plan_slices(complete, 'ABC123', start_date,
+                                         stale=stale)
+                  if s['name'] == 'heart']
+        self.assertEqual(len(slices), 1)
+        self.assertEqual(slices[0]['keys'], [last_month.format('YYYY-MM'),
+                                             this_month.format('YYYY-MM')])
+        self.assertEqual(slices[0]['start_date'],
+                         last_month.shift(days=25).format('YYYY-MM-DD'))
+        self.assertEqual(slices[0]['end_date'],
+                         arrow.get().shift(days=1).format('YYYY-MM-DD'))
+
+    def test_day_slices(self):
+        days = {'tracker-steps': {'2016-12-30', '2016-12-31', '2017-01-02'},
+                'heart': {'2017-01-02'}}
+        slices = plan_day_slices(days, 'ABC123', whole={('heart', '2017-01')})
+        self.assertEqual(
+            [(s['name'], s['keys'], s['url'].split('/date/')[1])
+             for s in slices],
+            [('heart', ['2017-01'], '2017-01-01/2017-01-31.json'),
+             ('tracker-steps', ['2016', '2017'],
+              '2016-12-30/2017-01-02.json')])
+
+    def test_store_coalesced_slice(self):
+        data_slice = plan_day_slices(
+            {'tracker-steps': {'2016-12-31', '2017-01-02'}}, 'ABC123')[0]
+        fetched = {'activities-tracker-steps': [
+            {'dateTime': '2016-12-31', 'value': '31'},
+            {'dateTime': '2017-01-01', 'value': '1'},
+            {'dateTime': '2017-01-02', 'value': '2'}]}
+        stored = {('tracker-steps', '2016'): {'activities-tracker-steps': [
+            {'dateTime': '2016-12-30', 'value': '30'},
+            {'dateTime': '2016-12-31', 'value': '0'}]}}
+        fitbit_data = {}
+        store_slice(fitbit_data, data_slice, fetched, stored)
+        self.assertEqual(fitbit_data, {'tracker-steps': {
+            '2016': {'activities-tracker-steps': [
+                {'dateTime': '2016-12-30', 'value': '30'},
+                {'dateTime': '2016-12-31', 'value': '31'}]},
+            '2017': {'activities-tracker-steps': [
+                {'dateTime': '2017-01-01', 'value': '1'},
+                {'dateTime': '2017-01-02', 'value': '2'}]}}})
+
+    def test_merge_days(self):
+        stored = {'activities-steps': [
+            {'dateTime': '2017-01-01', 'value': '1'},
+            {'dateTime': '2017-01-02', 'value': '2'},
+            {'dateTime': '2017-01-03', 'value': '3'}]}
+        fetched = {'activities-steps': [
+            {'dateTime': '2017-01-02', 'value': '20'},
+            {'dateTime': '2017-01-04', 'value': '40'}]}
+        self.assertEqual(
+            merge_days(stored, fetched, '2017-01-02', '2017-01-04'),
+            {'activities-steps': [{'dateTime': '2017-01-01', 'value': '1'},
+                                  {'dateTime': '2017-01-02', 'value': '20'},
+                                  {'dateTime': '2017-01-04', 'value': '40'}]})
+
+
+class CheckpointsTestCase(TestCase):
+    """
+    Test the per-slice checkpoints kept for a member
+    """
+
+    def setUp(self):
+        oh_member = OpenHumansMember.create(oh_id='1234', access_token='a',
+                                            refresh_token='r', expires_in=36000)
+        oh_member.save()
+        self.fitbit_member = FitbitMember.objects.create(
+            user=oh_member, userid='ABC123', access_token='a',
+            refresh_token='r', expires_in='0', scope='', token_type='')
+        self.fitbit_data = {
+            'profile': {'encodedId': 'ABC123'},
+            'activities-overview': {'lifetime': {}},
+            'tracker-steps': {'2016': {'a': 1}, '2017': {'a': 2}},
+        }
+
+    def test_seed_leaves_out_last_present_period(self):
+        checkpoints = seed_checkpoints(self.fitbit_member,
+                                       iter_slices(self.fitbit_data))
+        self.assertIn(('tracker-steps', '2016'), checkpoints)
+        self.assertNotIn(('tracker-steps', '2017'), checkpoints)
+        self.assertEqual(complete_slices(checkpoints),
+                         {('tracker-steps', '2016')})
+
+    def test_changed_slices(self):
+        save_checkpoints(self.fitbit_member, self.fitbit_data,
+                         arrow.get('2017-12-01').datetime)
+        checkpoints = load_checkpoints(self.fitbit_member)
+        self.assertEqual(changed_slices(checkpoints, self.fitbit_data), [])
+        self.assertEqual(complete_slices(checkpoints),
+                         {('tracker-steps', '2016')})
+        update = {'tracker-steps': {'2017': {'a': 3}, '2018': {'a': 4}}}
+        self.assertEqual(sorted(changed_slices(checkpoints, update)),
+                         [('tracker-steps', '2017'), ('tracker-steps', '2018')])
+
+    def test_merged_slices_keep_fetched_at(self):
+        fetched_at = arrow.get('2017-12-01').datetime
+        save_checkpoints(self.fitbit_member, self.fitbit_data, fetched_at)
+        checkpoints = load_checkpoints(self.fitbit_member)
+        update = {'tracker-steps': {'2017': {'a': 3}, '2018': {'a': 4}}}
+        save_checkpoints(self.fitbit_member, update,
+                         arrow.get('2018-01-05').datetime,
+                         merged={('tracker-steps', '2017'):
+                                 checkpoints[('tracker-steps', '2017')],
+                                 ('tracker-steps', '2018'): None})
+        checkpoints = load_checkpoints(self.fitbit_member)
+        self.assertEqual(checkpoints[('tracker-steps', '2017')].fetched_at,
+                         fetched_at)
+        self.assertEqual(changed_slices(checkpoints, update),
+                         [('tracker-steps', '2018')])
+        self.assertNotIn(('tracker-steps', '2018'), checkpoints)
+
+
+class ArchiveTestCase(TestCase):
+    """
+    Test serializing and reading the archive stored on Open Humans
+    """
+
+    def setUp(self):
+        self.fitbit_data = {
+            'profile': {'encodedId': 'ABC123'},
+            'activities-overview': {'lifetime': {'total': {'steps': 1}}},
+            'tracker-steps': {
+                '2016': {'activities-tracker-steps': [
+                    {'dateTime': '2016-01-01', 'value': '1234'}]},
+                '2017': {'activities-tracker-steps': []}},
+            'heart': {},
+            'weight-log': {'2016-01': {'weight': [
+                {'date': '2016-01-01', 'source': 'API "scale" \\ {x}',
+                 'weight': 70.5, 'bmi': None, 'fat': True}]}},
+        }
+        self.archive = json.dumps(self.fitbit_data)
+
+    def test_streamed_json_matches_dumps(self):
+        out = io.StringIO()
+        write_archive(self.fitbit_data, out)
+        self.assertEqual(out.getvalue(), json.dumps(self.fitbit_data))
+
+    @mock.patch('datauploader.archive.CHUNK_SIZE', 7)
+    def test_read_slices_across_chunks(self):
+        self.assertEqual(
+            list(iter_archive_slices(io.StringIO(self.archive))),
+            list(iter_slices(self.fitbit_data)))
+        profile, index = read_archive_index(io.StringIO(self.archive))
+        self.assertEqual(profile, {'encodedId': 'ABC123'})
+        self.assertEqual(index['tracker-steps'], {'2016', '2017'})
+        self.assertEqual(index['heart'], set())
+
+    @mock.patch('datauploader.archive.CHUNK_SIZE', 7)
+    def test_merge_matches_merged_dumps(self):
+        update = {
+            'profile': {'encodedId': 'ABC123', 'height': 180},
+            'activities-overview': {'lifetime': {'total': {'steps': 2}}},
+            'tracker-steps': {'2017': {'activities-tracker-steps': [
+                {'dateTime': '2017-01-01', 'value': '1'}]}, '2018': {}},
+            'heart': {'2018': {'activities-heart': []}},
+            'tracker-calories': {'2018': {}},
+        }
+        out = io.StringIO()
+        merge_archive(io.StringIO(self.archive), update, out)
+        for name, value in update.items():
+            if name in ('profile', 'activities-overview'):
+                self.fitbit_data[name] = value
+            else:
+                self.fitbit_data.setdefault(name, {}).update(value)
+        self.assertEqual(out.getvalue(), json.dumps(self.fitbit_data))
+
+    def test_gzipped_archive_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp_directory:
+            path = os.path.join(tmp_directory, 'fitbit-data.json.gz')
+            with open_archive(path, 'w') as fh:
+                write_archive(self.fitbit_data, fh)
+            self.assertLess(os.path.getsize(path), len(self.archive))
+            with open_archive(path) as fh:
+                self.assertEqual(list(iter_archive_slices(fh)),
+                                 list(iter_slices(self.fitbit_data)))
+
+    def test_compressed_archive_is_preferred(self):
+        data_files = [
+            {'basename': 'notes.txt', 'metadata': {'tags': []}},
+            {'basename': 'fitbit-data.json', 'metadata': {'tags': ['Fitbit']}},
+            {'basename': 'fitbit-data.json.gz',
+             'metadata': {'tags': ['Fitbit']}},
+        ]
+        self.assertEqual(find_archive_file(data_files), data_files[2])
+        self.assertEqual(find_archive_file(data_files[:2]), data_files[1])
+        self.assertIsNone(find_archive_file(data_files[:1]))
+        # While a new version is uploaded, the newest is the archive
+        versions = [
+            {'id': 2, 'basename': 'fitbit-data-0123456789ab.json.gz',
+             'metadata': {'tags': ['Fitbit']}},
+            {'id': 3, 'basename': 'fitbit-data-ba9876543210.json.gz',
+             'metadata': {'tags': ['Fitbit']}},
+        ]
+        self.assertEqual(find_archive_file(data_files + versions), versions[1])
+        self.assertFalse(is_split_file(versions[0]))
+
+    @mock.patch('datauploader.tasks.upload_file_to_oh')
+    @mock.patch('datauploader.tasks.delete_oh_file_by_name')
+    @override_settings(FITBIT_ARCHIVE_FORMAT='json.gz')
+    def test_archive_is_swapped_only_when_changed(self, delete, upload):
+        calls = mock.Mock()
+        calls.attach_mock(upload, 'upload')
+        calls.attach_mock(delete, 'delete')
+        oh_member = OpenHumansMember.create(oh_id='1234', access_token='a',
+                                            refresh_token='r', expires_in=36000)
+        oh_member.save()
+        fitbit_member = FitbitMember.objects.create(
+            user=oh_member, userid='ABC123', access_token='a',
+            refresh_token='r', expires_in='28800', scope='', token_type='')
+        reset_upload_counts()
+        with tempfile.TemporaryDirectory() as tmp_directory:
+            existing = os.path.join(tmp_directory, 'existing.json')
+            with open(existing, 'w') as fh:
+                fh.write(self.archive)
+            replace_fitbit(fitbit_member, self.fitbit_data,
+                           existing_archive=existing)
+            uploaded = os.path.basename(upload.call_args[0][1])
+            self.assertRegex(uploaded, r'^fitbit-data-[0-9a-f]{12}\.json\.gz$')
+            # The old archive goes only once the new one is uploaded
+            self.assertEqual([name for name, _, _ in calls.mock_calls],
+                             ['upload', 'delete', 'delete'])
+            # Merging the same slices into it again changes nothing
+            replace_fitbit(fitbit_member, {'heart': {}},
+                           existing_archive=existing)
+            self.assertEqual(upload.call_count, 1)
+            replace_fitbit(fitbit_member, {'heart': {'2018-01': {}}},
+                           existing_archive=existing)
+            self.assertEqual(upload.call_count, 2)
+            deleted = [call[1]['filename']
+                       for call in delete.call_args_list[2:]]
+            self.assertIn(uploaded, deleted)
+            self.assertNotIn(os.path.basename(upload.call_args[0][1]),
+                             deleted)
+        self.assertEqual(upload_counts(), {'performed': 2, 'skipped': 1})
+
+
+class SplitLayoutTestCase(TestCase):
+    """
+    Test grouping slices into the files of the split layout
+    """
+
+    def test_split_slices(self):
+        fitbit_data = {
+            'profile': {'encodedId': 'ABC123'},
+            'tracker-steps': {'2016': {'a': 1}, '2017': {'a': 2}},
+            'heart': {'2016-01': {'b': 1}, '2016-02': {'b': 2},
+                      '2017-01': {'b': 3}},
+        }
+        self.assertEqual(split_slices(iter_slices(fitbit_data)), {
+            'fitbit-profile.json': ('profile', {'encodedId': 'ABC123'}),
+            'fitbit-tracker-steps-2016.json': ('tracker-steps',
+                                               {'2016': {'a': 1}}),
+            'fitbit-tracker-steps-2017.json': ('tracker-steps',
+                                               {'2017': {'a': 2}}),
+            'fitbit-heart-2016.json': ('heart', {'2016-01': {'b': 1},
+                                                 '2016-02': {'b': 2}}),
+            'fitbit-heart-2017.json': ('heart', {'2017-01': {'b': 3}}),
+        })
+        self.assertTrue(is_split_file(
+            {'basename': 'fitbit-heart-2016.json',
+             'metadata': {'tags': ['Fitbit', 'heart']}}))
+        self.assertFalse(is_split_file(
+            {'basename': 'fitbit-data.json',
+             'metadata': {'tags': ['Fitbit']}}))
+
+
+class SchedulerTestCase(TestCase):
+    """
+    Test choosing which pending syncs fit in the Fitbit budget
+    """
+
+    def test_plan_dispatch(self):
+        day = 24 * 3600
+        daily = PendingSync(1, 4 * day, 25)
+        older = PendingSync(2, 5 * day, 25)
+        backfill = PendingSync(3, 7 * day, 400)
+        pending = [daily, backfill, older]
+        # Backfills are charged at most the member's hourly limit
+        self.assertEqual(plan_dispatch(pending, 200), [older, daily, backfill])
+        self.assertEqual(plan_dispatch(pending, 199), [older, daily])
+        # Syncs waiting longer per request go first, and nothing overtakes
+        # one that doesn't fit
+        waited = PendingSync(3, 100 * day, 400)
+        self.assertEqual(plan_dispatch([daily, waited, older], 100), [])
+
+    def test_lost_resumes_are_pending(self):
+        now = arrow.now()
+        members = []
+        for n, resume_at in enumerate([now.shift(hours=1),
+                                       now.shift(minutes=-10),
+                                       now.shift(hours=-2)]):
+            oh_member = OpenHumansMember.create(
+                oh_id=str(n), access_token='a', refresh_token='r',
+                expires_in=36000)
+            oh_member.save()
+            fitbit_member = FitbitMember.objects.create(
+                user=oh_member, userid='ABC12{}'.format(n), access_token='a',
+                refresh_token='r', expires_in='28800', scope='',
+                token_type='', last_updated=now.shift(days=-7).datetime)
+            FitbitSyncState.objects.create(fitbit_member=fitbit_member,
+                                           resume_at=resume_at.datetime)
+            members.append(fitbit_member)
+        # Only the sync that should have resumed long ago is scheduled
+        self.assertEqual([sync.member_id for sync in pending_syncs(now)],
+                         [members[2].id])
+
+
+class StubTokenHandler(BaseHTTPRequestHandler):
+    """
+    Fitbit's token endpoint, refusing the refresh token 'revoked'
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        refresh_token = parse_qs(body.decode('utf-8'))['refresh_token'][0]
+        if refresh_token == 'revoked':
+            self.send_response(401)
+            self.end_headers()
+            return
+        response = json.dumps({
+            'access_token': 'new-access-' + refresh_token,
+            'refresh_token': 'new-' + refresh_token, 'expires_in': 28800,
+            'scope': 'activity', 'token_type': 'Bearer',
+            'user_id': 'USER-' + refresh_token}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class TokenRefreshTestCase(TestCase):
+    """
+    Test refreshing expiring tokens against a stub OAuth server
+    """
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubTokenHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.token_url = 'http://127.0.0.1:{}/oauth2/token'.format(
+            self.server.server_port)
+        expiries = {
+            'expired': arrow.now().shift(minutes=-5).datetime,
+            'unknown': None,
+            'fresh': arrow.now().shift(hours=5).datetime,
+            'revoked': arrow.now().shift(minutes=10).datetime,
+        }
+        for name, token_expires in expiries.items():
+            oh_member = OpenHumansMember.create(
+                oh_id=name, access_token='a', refresh_token='r',
+                expires_in=36000)
+            oh_member.save()
+            FitbitMember.objects.create(
+                user=oh_member, userid='USER-' + name, access_token='a',
+                refresh_token=name, expires_in='28800',
+                token_expires=token_expires, scope='', token_type='')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_refresh_expiring_tokens(self):
+        with override_settings(FITBIT_TOKEN_URL=self.token_url):
+            stats = refresh_expiring_tokens(3600, concurrency=2,
+                                            batch_size=1)
+        self.assertEqual((stats['selected'], stats['refreshed'],
+                          stats['failed']), (3, 2, 1))
+        for name in ['expired', 'unknown']:
+            fitbit_member = FitbitMember.objects.get(userid='USER-' + name)
+            self.assertEqual(fitbit_member.access_token, 'new-access-' + name)
+            self.assertEqual(fitbit_member.refresh_token, 'new-' + name)
+            self.assertGreater(arrow.get(fitbit_member.token_expires),
+                               arrow.now().shift(hours=7))
+        for name in ['fresh', 'revoked']:
+            fitbit_member = FitbitMember.objects.get(userid='USER-' + name)
+            self.assertEqual(fitbit_member.refresh_token, name)
+
+    def test_warm_token_needs_no_refresh(self):
+        fitbit_member = FitbitMember.objects.get(userid='USER-fresh')
+        # Nothing listens there
+        with override_settings(
+                FITBIT_TOKEN_URL='http://127.0.0.1:1/oauth2/token'):
+            self.assertEqual(fitbit_member.get_access_token(), 'a')
+
+
+class UploadTestCase(TestCase):
+    """
+    Test uploading files against a local stand-in for Open Humans and S3
+    """
+
+    def setUp(self):
+        self.stub = UploadStub(latency=0.05, refuse_puts=1)
+        self.oh_member = OpenHumansMember(
+            oh_id='1234', access_token='a',
+            token_expires=arrow.now().shift(hours=1).datetime)
+
+    def tearDown(self):
+        self.stub.shutdown()
+
+    def test_concurrent_uploads_with_retry(self):
+        with tempfile.TemporaryDirectory() as tmp_directory:
+            uploads = []
+            for i in range(5):
+                path = os.path.join(tmp_directory, 'file-{}.json'.format(i))
+                with open(path, 'wb') as fh:
+                    fh.write(b'x' * (i + 1) * 1000)
+                uploads.append((path, {'tags': ['Fitbit']}))
+            with override_settings(HTTP_BACKOFF_FACTOR=0,
+                                   **self.stub.settings()):
+                done = dict(upload_files(self.oh_member, uploads,
+                                         concurrency=2))
+            completed = self.stub.completed()
+            self.assertEqual(set(done.values()), set(completed))
+            for path, _ in uploads:
+                self.assertEqual(completed[done[path]]['filename'],
+                                 os.path.basename(path))
+                self.assertEqual(completed[done[path]]['size'],
+                                 os.path.getsize(path))
+        # The refused upload was started over with a new S3 URL
+        self.assertEqual(len(self.stub.files), 6)
+        self.assertEqual(self.stub.max_in_flight, 2)
+
+
+@override_settings(FITBIT_FETCH_CONCURRENCY=1)
+@mock.patch('datauploader.tasks.get_member_data')
+@mock.patch('datauploader.tasks.get_existing_fitbit', return_value=None)
+@mock.patch('datauploader.tasks.last_device_sync', return_value=None)
+@mock.patch('datauploader.tasks.replace_fitbit')
+@mock.patch('datauploader.tasks.fetch_fitbit_data.apply_async')
+@mock.patch('datauploader.tasks.get_fitbit_profile')
+class SyncTestCase(TestCase):
+    """
+    Test syncs that are resumed after a rate limit or skipped
+    """
+
+    def setUp(self):
+        oh_member = OpenHumansMember.create(oh_id='1234', access_token='a',
+                                            refresh_token='r', expires_in=36000)
+        oh_member.save()
+        self.fitbit_member = FitbitMember.objects.create(
+            user=oh_member, userid='ABC123', access_token='a',
+            refresh_token='r', expires_in='28800', scope='', token_type='',
+            token_expires=arrow.now().shift(hours=8).datetime,
+            last_device_sync='2018-01-01T10:00:00.000')
+        self.requested = []
+        self.allowed = 5
+        self.retry_at = time.time() + 120
+        self.profile = {
+            'encodedId': 'ABC123',
+            'memberSince': arrow.get().floor('year').format('YYYY-MM-DD')}
+
+    def get(self, url, headers, realms):
+        if len(self.requested) == self.allowed:
+            raise RequestsRespectfulRateLimitedError(
+                'Rate-limited', retry_at=self.retry_at)
+        self.requested.append(url)
+        response = mock.Mock()
+        response.json.return_value = {'series': [
+            {'dateTime': url.split('/')[-2], 'value': str(len(url))}]}
+        return response
+
+    def test_resume_after_rate_limit(self, get_fitbit_profile, apply_async,
+                                     replace_fitbit, *mocks):
+        get_fitbit_profile.return_value = self.profile
+        with mock.patch('datauploader.fetch.rr.get', side_effect=self.get):
+            fetch_fitbit_data(self.fitbit_member.id, 'a')
+            state = FitbitSyncState.objects.get(
+                fitbit_member=self.fitbit_member)
+            # What was fetched is kept and the sync is requeued for when
+            # the rate limit lifts, without uploading anything
+            pending = list(iter_slices(state.get_pending_data()))
+            # The profile and one slice per request made
+            self.assertEqual(len(pending), self.allowed + 1)
+            eta = arrow.get(self.retry_at).shift(seconds=1).datetime
+            self.assertEqual(state.resume_at, eta)
+            apply_async.assert_called_once_with(
+                args=[self.fitbit_member.id, 'a'], eta=eta)
+            replace_fitbit.assert_not_called()
+            first_run = list(self.requested)
+
+            self.allowed = None
+            fetch_fitbit_data(self.fitbit_member.id, 'a')
+        # Nothing fetched before the rate limit is fetched again
+        second_run = self.requested[len(first_run):]
+        self.assertTrue(second_run)
+        self.assertFalse(set(first_run) & set(second_run))
+        self.assertEqual(get_fitbit_profile.call_count, 1)
+        replace_fitbit.assert_called_once()
+        uploaded = replace_fitbit.call_args[0][1]
+        for name, key, data in pending:
+            self.assertEqual(uploaded[name][key] if key else uploaded[name],
+                             data)
+        state.refresh_from_db()
+        self.assertEqual(state.pending_data, '')
+        self.assertIsNone(state.resume_at)
+
+    @mock.patch('datauploader.tasks.release_sync')
+    def test_skip_without_tracker_sync(self, release_sync, get_fitbit_profile,
+                                       apply_async, replace_fitbit,
+                                       last_device_sync, *mocks):
+        last_device_sync.return_value = '2018-01-01T10:00:00.000'
+        with mock.patch('datauploader.fetch.rr.get', side_effect=self.get):
+            fetch_fitbit_data(self.fitbit_member.id, 'a')
+        # Only the devices were asked for, with the member's realm
+        self.assertEqual(last_device_sync.call_args[0][1],
+                         ['Fitbit', 'fitbit-1234'])
+        self.assertEqual(self.requested, [])
+        get_fitbit_profile.assert_not_called()
+        replace_fitbit.assert_not_called()
+        release_sync.assert_called_once_with(self.fitbit_member.id)
+        # The check counts as a sync, so the member isn't due again
+        self.fitbit_member.refresh_from_db()
+        self.assertGreater(self.fitbit_member.last_updated,
+                           arrow.now().shift(minutes=-1).datetime)
+        self.assertEqual(pending_syncs(arrow.now()), [])
+
+    def test_device_sync_recorded_once_complete(
+            self, get_fitbit_profile, apply_async, replace_fitbit,
+            last_device_sync, *mocks):
+        get_fitbit_profile.return_value = self.profile
+        last_device_sync.return_value = '2018-01-02T10:00:00.000'
+        with mock.patch('datauploader.fetch.rr.get', side_effect=self.get):
+            fetch_fitbit_data(self.fitbit_member.id, 'a')
+            self.fitbit_member.refresh_from_db()
+            self.assertEqual(self.fitbit_member.last_device_sync,
+                             '2018-01-01T10:00:00.000')
+            # The trackers synced again before the sync was resumed
+            last_device_sync.return_value = '2018-01-03T10:00:00.000'
+            self.allowed = None
+            fetch_fitbit_data(self.fitbit_member.id, 'a')
+        # A resumed sync isn't checked again, and records the sync time
+        # seen when it started
+        self.assertEqual(last_device_sync.call_count, 1)
+        self.fitbit_member.refresh_from_db()
+        self.assertEqual(self.fitbit_member.last_device_sync,
+                         '2018-01-02T10:00:00.000')
+
+    def test_devices_rate_limited(self, *mocks):
+        self.allowed = 0
+        with mock.patch('datauploader.fetch.rr.get', side_effect=self.get):
+            self.assertIsNone(last_device_sync({}, ['Fitbit']))
+        response = mock.Mock(status_code=200)
+        response.json.return_value = [
+            {'lastSyncTime': '2018-01-01T10:00:00.000'},
+            {'lastSyncTime': '2018-01-02T10:00:00.000'}, {}]
+        with mock.patch('datauploader.fetch.rr.get', return_value=response):
+            self.assertEqual(last_device_sync({}, ['Fitbit']),
+                             '2018-01-02T10:00:00.000')
+
+    def test_refreshed_days_keep_fetched_at(self, get_fitbit_profile,
+                                            apply_async, replace_fitbit,
+                                            *mocks):
+        today = arrow.get()
+        year, month = today.format('YYYY'), today.format('YYYY-MM')
+        fetched_at = today.shift(days=-20).datetime
+        save_checkpoints(self.fitbit_member, {'tracker-steps': {year: {}}},
+                         fetched_at)
+        # The year of steps is stored, the month of heart rate isn't
+        stored = {('tracker-steps', year): {'activities-tracker-steps': []}}
+        with tempfile.TemporaryDirectory() as tmp_directory:
+            existing = os.path.join(tmp_directory, 'existing.json')
+            with open(existing, 'w') as fh:
+                write_archive({'profile': self.profile,
+                               'tracker-steps': {year: {}}}, fh)
+            with mock.patch('datauploader.tasks.get_stored_slices',
+                            return_value=(stored, existing)), \
+                    mock.patch('datauploader.fetch.rr.get',
+                               side_effect=self.get):
+                refresh_days(self.fitbit_member,
+                             {'tracker-steps': {today.format('YYYY-MM-DD')},
+                              'heart': {today.format('YYYY-MM-DD')}})
+        replace_fitbit.assert_called_once()
+        checkpoints = load_checkpoints(self.fitbit_member)
+        # Only today was fetched for the year, the days before it since
+        # the last sync still have to be
+        steps = checkpoints[('tracker-steps', year)]
+        self.assertEqual(steps.fetched_at, fetched_at)
+        self.assertEqual(steps.content_hash, slice_hash(
+            replace_fitbit.call_args[0][1]['tracker-steps'][year]))
+        self.assertGreater(checkpoints[('heart', month)].fetched_at,
+                           fetched_at)
+
+    def test_missing_archive_is_fetched_again(self, get_fitbit_profile,
+                                              apply_async, replace_fitbit,
+                                              *mocks):
+        get_fitbit_profile.return_value = self.profile
+        self.allowed = None
+        # The checkpoints say 2016 is stored, but OH has no archive
+        save_checkpoints(self.fitbit_member, {'tracker-steps': {'2016': {}}},
+                         arrow.get('2017-06-01').datetime)
+        with mock.patch('datauploader.fetch.rr.get', side_effect=self.get), \
+                mock.patch('datauploader.tasks.fetch_fitbit_data.delay') \
+                as delay:
+            fetch_fitbit_data(self.fitbit_member.id, 'a')
+        # Nothing partial is uploaded, everything is fetched again instead
+        replace_fitbit.assert_not_called()
+        delay.assert_called_once_with(self.fitbit_member.id, 'a')
+        self.assertEqual(load_checkpoints(self.fitbit_member), {})
+        self.fitbit_member.refresh_from_db()
+        self.assertEqual(self.fitbit_member.last_device_sync, '')
+        self.assertEqual(self.fitbit_member.sync_state.pending_data, '')
+
+    def test_failed_resume_is_scheduled_again(self, get_fitbit_profile,
+                                              apply_async, replace_fitbit,
+                                              *mocks):
+        get_fitbit_profile.return_value = self.profile
+        with mock.patch('datauploader.fetch.rr.get', side_effect=self.get):
+            fetch_fitbit_data(self.fitbit_member.id, 'a')
+            self.assertEqual(pending_syncs(arrow.now()), [])
+            self.allowed = None
+            replace_fitbit.side_effect = IOError('Upload failed')
+            with self.assertRaises(IOError):
+                fetch_fitbit_data(self.fitbit_member.id, 'a')
+        # Nothing will resume it, so the scheduler's next sync does, with
+        # what was fetched
+        state = FitbitSyncState.objects.get(fitbit_member=self.fitbit_member)
+        self.assertIsNone(state.resume_at)
+        self.assertIn('profile', state.get_pending_data())
+        later = arrow.now().shift(hours=settings.FITBIT_SYNC_INTERVAL + 1)
+        self.assertEqual([sync.member_id for sync in pending_syncs(later)],
+                         [self.fitbit_member.id])
@@ -0,0 +1,119 @@
+"""
+Bulk refresh of Fitbit and Open Humans OAuth tokens.
+
+refresh_fitbit_tokens runs this periodically, ahead of expiry, so syncs
+find a valid token in the database and make no OAuth requests of their
+own. Only members whose access token expires within a window are
+selected, their refresh tokens are exchanged concurrently on the pooled
+session (bounded by FITBIT_TOKEN_REFRESH_CONCURRENCY), and the new tokens
+are written back in batches of one UPDATE each instead of a save() per
+member. Refresh tokens can only be used once, so every batch is written
+as soon as it is complete.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import arrow
+from django.conf import settings
+from django.db.models import Case, Q, Value, When
+from main.models import FitbitMember
+from open_humans.models import OpenHumansMember
+
+logger = logging.getLogger(__name__)
+
+TOKEN_FIELDS = {
+    FitbitMember: ['access_token', 'refresh_token', 'expires_in',
+                   'token_expires', 'scope', 'userid'],
+    OpenHumansMember: ['access_token', 'refresh_token', 'token_expires'],
+}
+
+
+def expiring_members(model, before):
+    """
+    List the members whose access token expires before the given time,
+    or whose expiry isn't known.
+    """
+    return list(model.objects.exclude(refresh_token='').filter(
+        Q(token_expires__lt=before.datetime) | Q(token_expires__isnull=True)
+    ).order_by('token_expires').only(model._meta.pk.name, 'refresh_token',
+                                     'token_expires'))
+
+
+def save_tokens(members):
+    """
+    Write the tokens of the given members, all of one model, back in a
+    single UPDATE.
+    """
+    if not members:
+        return
+    model = type(members[0])
+    model.objects.filter(
+        pk__in=[member.pk for member in members]
+    ).update(**{
+        field: Case(*[When(pk=member.pk,
+                           then=Value(getattr(member, field)))
+                      for member in members],
+                    output_field=model._meta.get_field(field))
+        for field in TOKEN_FIELDS[model]})
+
+
+def refresh_tokens(members, concurrency=None, batch_size=100):
+    """
+    Refresh the tokens of the given members, all of one model,
+    concurrently and save them. Returns the number of members refreshed
+    and of those that failed.
+    """
+    concurrency = concurrency or settings.FITBIT_TOKEN_REFRESH_CONCURRENCY
+    refreshed = 0
+    failed = 0
+    batch = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(member.request_token_refresh,
+                                   member.refresh_token): member
+                   for member in members}
+        try:
+            for future in as_completed(futures):
+                member = futures[future]
+                try:
+                    data = future.result()
+                    if data is not None:
+                        member.set_tokens(data)
+                except Exception as e:
+                    # Unreachable, or a malformed token response
+                    logger.warning('Could not refresh token of {}: {}'.format(
+                        member.pk, e))
+                    data = None
+                if data is None:
+                    failed += 1
+                    continue
+                batch.append(member)
+                if len(batch) >= batch_size:
+                    save_tokens(batch)
+                    refreshed += len(batch)
+                    batch = []
+        finally:
+            # Whatever was refreshed must be saved, the old tokens are gone
+            save_tokens(batch)
+    return refreshed + len(batch), failed
+
+
+def refresh_expiring_tokens(within, concurrency=None, batch_size=100):
+    """
+    Refresh every Fitbit and Open Humans token expiring within the given
+    number of seconds, soonest first. Returns counts of the selected,
+    refreshed and failed members and the seconds it took.
+    """
+    start = time.perf_counter()
+    before = arrow.now().shift(seconds=within)
+    stats = {'selected': 0, 'refreshed': 0, 'failed': 0}
+    for model in TOKEN_FIELDS:
+        members = expiring_members(model, before)
+        refreshed, failed = refresh_tokens(members, concurrency, batch_size)
+        stats['selected'] += len(members)
+        stats['refreshed'] += refreshed
+        stats['failed'] += failed
+    stats['seconds'] = time.perf_counter() - start
+    logger.info('Refreshed {refreshed} of {selected} expiring tokens '
+                '({failed} failed) in {seconds:.1f} s'.format(**stats))
+    return stats
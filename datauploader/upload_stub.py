@@ -0,0 +1,123 @@
+"""
+Local stand-in for the Open Humans direct upload API and the S3 bucket
+behind it, used by the tests and by the bench_upload command.
+
+It serves the three steps of upload_file_to_oh on one port: the upload
+request hands out an S3 URL on the same server, the PUT to it is read at
+a limited bandwidth per connection, and completing an upload only
+succeeds once its PUT did. Every request can be delayed by a fixed
+latency, and the first PUTs can be refused as if their URL had expired.
+"""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        time.sleep(server.latency)
+        fields = parse_qs(self.rfile.read(
+            int(self.headers['Content-Length'])).decode('utf-8'))
+        if self.path.startswith('/direct/'):
+            with server.lock:
+                server.next_id += 1
+                file_id = server.next_id
+                server.files[file_id] = {'filename': fields['filename'][0],
+                                         'size': None, 'complete': False}
+            self.reply(201, {'id': file_id, 'url': '{}/s3/{}'.format(
+                server.url, file_id)})
+        elif self.path.startswith('/complete/'):
+            dfile = server.files.get(int(fields['file_id'][0]))
+            if dfile is None or dfile['size'] is None:
+                self.reply(400, {'detail': 'Upload not found'})
+                return
+            dfile['complete'] = True
+            self.reply(200, {'status': 'ok'})
+        else:
+            self.reply(404, {})
+
+    def do_PUT(self):
+        server = self.server
+        match = re.match(r'^/s3/(\d+)$', self.path)
+        length = int(self.headers['Content-Length'])
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+            refuse = server.refuse_puts > 0
+            if refuse:
+                server.refuse_puts -= 1
+        try:
+            time.sleep(server.latency)
+            received = 0
+            while received < length:
+                chunk = self.rfile.read(min(CHUNK_SIZE, length - received))
+                if not chunk:
+                    break
+                received += len(chunk)
+                if server.bandwidth:
+                    time.sleep(len(chunk) / server.bandwidth)
+            if refuse or match is None:
+                self.reply(403, {})
+                return
+            server.files[int(match.group(1))]['size'] = received
+            self.reply(200, None)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def reply(self, status, body):
+        content = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class UploadStub(ThreadingHTTPServer):
+    """
+    The stand-in server, running in a thread until shutdown() is called.
+    latency is in seconds, bandwidth in bytes per second per PUT (0 for
+    unlimited).
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, bandwidth=0, refuse_puts=0):
+        super(UploadStub, self).__init__(('127.0.0.1', 0), UploadStubHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.refuse_puts = refuse_puts
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.files = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.url = 'http://127.0.0.1:{}'.format(self.server_port)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def settings(self):
+        """
+        Settings pointing the upload of upload_file_to_oh here.
+        """
+        return {'OH_DIRECT_UPLOAD': self.url + '/direct/',
+                'OH_DIRECT_UPLOAD_COMPLETE': self.url + '/complete/'}
+
+    def completed(self):
+        return {file_id: dfile for file_id, dfile in self.files.items()
+                if dfile['complete']}
+
+    def shutdown(self):
+        super(UploadStub, self).shutdown()
+        self.server_close()
@@ -0,0 +1,27 @@
+"""
+Counters of the uploads to Open Humans that syncs performed, and of those
+they skipped because the content was already there, kept in Redis across
+workers.
+"""
+from fitbit.settings import rr
+
+UPLOADS_KEY = 'fitbit-uploads:{}'
+
+
+def count_upload(performed):
+    rr.redis.incr(UPLOADS_KEY.format(
+        'performed' if performed else 'skipped'))
+
+
+def upload_counts():
+    """
+    Return {'performed': n, 'skipped': n} since the counters were reset.
+    """
+    performed, skipped = rr.redis.mget([UPLOADS_KEY.format('performed'),
+                                        UPLOADS_KEY.format('skipped')])
+    return {'performed': int(performed or 0), 'skipped': int(skipped or 0)}
+
+
+def reset_upload_counts():
+    rr.redis.delete(UPLOADS_KEY.format('performed'),
+                    UPLOADS_KEY.format('skipped'))
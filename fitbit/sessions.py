@@ -0,0 +1,117 @@
+"""
+Shared, connection-pooled HTTP sessions for Fitbit and Open Humans calls.
+
+Every process (gunicorn or celery worker) lazily gets its own
+requests.Session, so calls to the same host reuse kept-alive connections
+instead of doing a new TCP+TLS handshake each time. Sessions are never
+shared across a fork. Fitbit API requests are only retried when no
+connection could be made: each call counts against the rate limit, and
+RespectfulRequester only accounted for one. Requests that don't set a timeout get
+HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT, so a stalled upstream can't
+hold a worker indefinitely.
+"""
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_lock = threading.Lock()
+_process_session = {'pid': None, 'session': None}
+
+FITBIT_API_PREFIX = 'https://api.fitbit.com/'
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter applying a default (connect, read) timeout to requests
+    sent without one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.timeout = kwargs.pop('timeout', None)
+        super(TimeoutHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def make_adapter(retries):
+    return TimeoutHTTPAdapter(
+        pool_connections=settings.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+        max_retries=retries,
+        timeout=(settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+
+
+def make_session():
+    """
+    Create a session with a bounded connection pool that retries
+    idempotent requests on connection errors and 5xx responses, and
+    Fitbit API requests on connection errors only.
+    """
+    adapter = make_adapter(Retry(
+        total=settings.HTTP_MAX_RETRIES,
+        backoff_factor=settings.HTTP_BACKOFF_FACTOR,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False))
+    fitbit_adapter = make_adapter(Retry(
+        total=settings.HTTP_MAX_RETRIES,
+        read=0,
+        backoff_factor=settings.HTTP_BACKOFF_FACTOR,
+        raise_on_status=False))
+    new_session = requests.Session()
+    new_session.mount('https://', adapter)
+    new_session.mount('http://', adapter)
+    new_session.mount(FITBIT_API_PREFIX, fitbit_adapter)
+    return new_session
+
+
+def get_session():
+    """
+    Return the pooled session of the current process.
+    """
+    pid = os.getpid()
+    if _process_session['pid'] != pid:
+        with _lock:
+            if _process_session['pid'] != pid:
+                _process_session['session'] = make_session()
+                _process_session['pid'] = pid
+    return _process_session['session']
+
+
+def connection_stats():
+    """
+    Return, per host, how many requests the current process' session sent
+    and how many of them needed a new connection.
+    """
+    stats = {}
+    for adapter in set(get_session().adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            host = '{}://{}:{}'.format(key.key_scheme, key.key_host,
+                                       key.key_port or pool.port)
+            stats[host] = {
+                'requests': pool.num_requests,
+                'connections': pool.num_connections,
+                'reused': pool.num_requests - pool.num_connections,
+            }
+    return stats
+
+
+class SessionProxy(object):
+    """
+    Stand-in for the process' pooled session that can be imported at
+    module level, e.g. session.get(url).
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_session(), name)
+
+
+session = SessionProxy()
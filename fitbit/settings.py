@@ -14,6 +14,7 @@ import os
 import dj_database_url
 import logging
 from requests_respectful import RespectfulRequester
+from fitbit.sessions import session
 
 logger = logging.getLogger(__name__)
 
@@ -55,10 +56,63 @@ OH_API_BASE = OPENHUMANS_OH_BASE_URL + '/api/direct-sharing'
 OH_DIRECT_UPLOAD = OH_API_BASE + '/project/files/upload/direct/'
 OH_DIRECT_UPLOAD_COMPLETE = OH_API_BASE + '/project/files/upload/complete/'
 OH_DELETE_FILES = OH_API_BASE + '/project/files/delete/'
+# Seconds a member's file listing from Open Humans is cached at most
+OH_MEMBER_DATA_CACHE = int(os.getenv('OH_MEMBER_DATA_CACHE', 600))
+
+# Pooled HTTP sessions shared by all Fitbit and Open Humans calls
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 10))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 10))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.5))
+# Seconds to wait for a connection, and between bytes of a response
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+# Seconds after which a sign-up still waiting for its token exchange is
+# given up on
+SIGNUP_TIMEOUT = int(os.getenv('SIGNUP_TIMEOUT', 120))
 
 # Fitbit configuration
 FITBIT_CLIENT_ID=os.getenv('FITBIT_CLIENT_ID')
 FITBIT_CLIENT_SECRET=os.getenv('FITBIT_CLIENT_SECRET')
+FITBIT_TOKEN_URL = 'https://api.fitbit.com/oauth2/token'
+# Number of token refreshes the bulk refresh has in flight at once
+FITBIT_TOKEN_REFRESH_CONCURRENCY = int(
+    os.getenv('FITBIT_TOKEN_REFRESH_CONCURRENCY', 8))
+# Every FITBIT_TOKEN_REFRESH_EVERY seconds the Fitbit and Open Humans
+# tokens expiring within FITBIT_TOKEN_REFRESH_AHEAD seconds are refreshed,
+# so syncs never have to. Keep AHEAD well above EVERY.
+FITBIT_TOKEN_REFRESH_EVERY = int(os.getenv('FITBIT_TOKEN_REFRESH_EVERY', 900))
+FITBIT_TOKEN_REFRESH_AHEAD = int(
+    os.getenv('FITBIT_TOKEN_REFRESH_AHEAD', 3600))
+# Number of Fitbit requests a member's fetch has in flight at once
+FITBIT_FETCH_CONCURRENCY = int(os.getenv('FITBIT_FETCH_CONCURRENCY', 4))
+# Number of files a sync in the split layout uploads at once
+FITBIT_UPLOAD_CONCURRENCY = int(os.getenv('FITBIT_UPLOAD_CONCURRENCY', 4))
+# Format of the archive uploaded to Open Humans, 'json' or 'json.gz'.
+# Archives in either format are read.
+FITBIT_ARCHIVE_FORMAT = os.getenv('FITBIT_ARCHIVE_FORMAT', 'json')
+FITBIT_ARCHIVE_COMPRESSLEVEL = int(
+    os.getenv('FITBIT_ARCHIVE_COMPRESSLEVEL', 6))
+# 'single' keeps all data in one archive file on Open Humans. 'split'
+# keeps one file per endpoint and year and only re-uploads changed ones; a
+# member's single archive is split up on their first sync. There is no
+# way back from 'split' short of deleting the member's checkpoints.
+FITBIT_ARCHIVE_LAYOUT = os.getenv('FITBIT_ARCHIVE_LAYOUT', 'single')
+# Fitbit Subscriber receiving change notifications at /fitbit/notifications/
+# (optional). The verification code is the one shown when adding the
+# subscriber; notifications of a member are collected for
+# FITBIT_NOTIFICATION_DELAY seconds before their fetch runs.
+FITBIT_SUBSCRIBER_ID = os.getenv('FITBIT_SUBSCRIBER_ID', '')
+FITBIT_SUBSCRIBER_VERIFY_CODE = os.getenv('FITBIT_SUBSCRIBER_VERIFY_CODE', '')
+FITBIT_NOTIFICATION_DELAY = int(os.getenv('FITBIT_NOTIFICATION_DELAY', 60))
+# Members are synced once their last sync is FITBIT_SYNC_INTERVAL hours
+# old. Every FITBIT_SCHEDULE_EVERY seconds the scheduler starts as many of
+# those syncs as fit in the global Fitbit budget, keeping the
+# FITBIT_SCHEDULER_RESERVE fraction of it for notifications and new
+# members.
+FITBIT_SYNC_INTERVAL = int(os.getenv('FITBIT_SYNC_INTERVAL', 96))
+FITBIT_SCHEDULE_EVERY = int(os.getenv('FITBIT_SCHEDULE_EVERY', 600))
+FITBIT_SCHEDULER_RESERVE = float(os.getenv('FITBIT_SCHEDULER_RESERVE', 0.1))
 
 if REMOTE is True:
     from urllib.parse import urlparse
@@ -76,7 +130,7 @@ if REMOTE is True:
         safety_threshold=5)
 
 # Requests Respectful (rate limiting, waiting)
-rr = RespectfulRequester()
+rr = RespectfulRequester(session=session)
 rr.register_realm("Fitbit", max_requests=3600, timespan=3600)
 
 if REMOTE is False:
@@ -1,18 +1,98 @@
-from ohapi import api
 from django.conf import settings
+from datauploader.archive import find_archive_file
+from datauploader.split import is_split_file
+from fitbit.sessions import session
+from fitbit.settings import rr
+from urllib.parse import parse_qs, urlparse
 import arrow
-from datetime import timedelta
+import json
+from datetime import datetime, timedelta
 
-def get_fitbit_file(oh_member):
+MEMBER_DATA_KEY = 'oh-member-data:{}'
+# Cached download URLs are dropped this many seconds before they expire
+URL_EXPIRY_MARGIN = 60
+
+
+def oh_get_member_data(token):
+    """
+    Exchange OAuth2 token for member data.
+    """
+    req = session.get(
+        '{}/api/direct-sharing/project/exchange-member/'
+        .format(settings.OPENHUMANS_OH_BASE_URL),
+        params={'access_token': token}
+        )
+    if req.status_code == 200:
+        return req.json()
+    raise Exception('Status code {}'.format(req.status_code))
+
+
+def url_expiry(url):
+    """
+    When a signed S3 download URL expires, or None if it doesn't say.
+    """
+    query = parse_qs(urlparse(url).query)
+    try:
+        if 'X-Amz-Date' in query:
+            signed = datetime.strptime(query['X-Amz-Date'][0],
+                                       '%Y%m%dT%H%M%SZ')
+            return arrow.get(signed).shift(
+                seconds=int(query['X-Amz-Expires'][0]))
+        if 'Expires' in query:
+            return arrow.get(int(query['Expires'][0]))
+    except (KeyError, ValueError):
+        pass
+    return None
+
+
+def member_data_ttl(member_data, now):
+    """
+    Seconds the member data can be cached: OH_MEMBER_DATA_CACHE, or less
+    if a download URL in it expires before.
+    """
+    ttl = settings.OH_MEMBER_DATA_CACHE
+    for dfile in member_data.get('data', []):
+        expiry = url_expiry(dfile.get('download_url') or '')
+        if expiry is not None:
+            ttl = min(ttl, int((expiry - now).total_seconds()) -
+                      URL_EXPIRY_MARGIN)
+    return ttl
+
+
+def get_member_data(oh_member):
+    """
+    The member's data from the Open Humans member exchange, cached in
+    Redis until invalidated by a change to their files, for at most
+    member_data_ttl seconds.
+    """
+    key = MEMBER_DATA_KEY.format(oh_member.oh_id)
+    cached = rr.redis.get(key)
+    if cached is not None:
+        return json.loads(cached)
+    member_data = oh_get_member_data(oh_member.get_access_token())
+    ttl = member_data_ttl(member_data, arrow.now())
+    if ttl > 0:
+        rr.redis.set(key, json.dumps(member_data), ex=ttl)
+    return member_data
+
+
+def invalidate_member_data(oh_member):
+    rr.redis.delete(MEMBER_DATA_KEY.format(oh_member.oh_id))
+
+
+def get_fitbit_files(oh_member):
+    """
+    List the member's Fitbit files on Open Humans: the archive, or its
+    files in the split layout, ordered by name.
+    """
     try:
-        oh_access_token = oh_member.get_access_token(
-                                client_id=settings.OPENHUMANS_CLIENT_ID,
-                                client_secret=settings.OPENHUMANS_CLIENT_SECRET)
-        user_object = api.exchange_oauth2_member(oh_access_token)
-        for dfile in user_object['data']:
-            if 'Fitbit' in dfile['metadata']['tags']:
-                return dfile['download_url']
-        return ''
+        user_object = get_member_data(oh_member)
+        dfiles = [dfile for dfile in user_object['data']
+                  if is_split_file(dfile)]
+        archive = find_archive_file(user_object['data'])
+        if archive is not None:
+            dfiles.append(archive)
+        return sorted(dfiles, key=lambda dfile: dfile['basename'])
 
     except:
         return 'error'
@@ -0,0 +1,168 @@
+from django.core.management.base import BaseCommand
+from datauploader.archive import (iter_archive_slices, merge_archive,
+                                  open_archive, read_archive_index,
+                                  write_archive)
+from django.test.utils import override_settings
+from datauploader.fetch import PERIOD_FORMATS, fitbit_urls
+import arrow
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+
+def daily_values(name, days):
+    if name == 'heart':
+        return {'activities-heart': [
+            {'dateTime': day.format('YYYY-MM-DD'),
+             'value': {'customHeartRateZones': [],
+                       'heartRateZones': [
+                           {'caloriesOut': random.uniform(0, 2000),
+                            'max': high, 'min': low,
+                            'minutes': random.randint(0, 1440),
+                            'name': zone}
+                           for zone, low, high in [
+                               ('Out of Range', 30, 94),
+                               ('Fat Burn', 94, 132),
+                               ('Cardio', 132, 160),
+                               ('Peak', 160, 220)]],
+                       'restingHeartRate': random.randint(50, 80)}}
+            for day in days]}
+    if name == 'weight-log':
+        return {'weight': [
+            {'bmi': round(random.uniform(20, 30), 2),
+             'date': day.format('YYYY-MM-DD'),
+             'logId': random.randint(10 ** 12, 10 ** 13),
+             'source': 'API', 'time': '07:00:00',
+             'weight': round(random.uniform(60, 90), 1)}
+            for day in days]}
+    return {'activities-{}'.format(name): [
+        {'dateTime': day.format('YYYY-MM-DD'),
+         'value': str(random.randint(0, 20000))}
+        for day in days]}
+
+
+def synthetic_fitbit_data(years):
+    """
+    Build an archive shaped like the one of a member who has been syncing
+    every day for the given number of years.
+    """
+    random.seed(0)
+    end = arrow.get().floor('day')
+    start = end.shift(years=-years)
+    fitbit_data = {'profile': {'encodedId': 'SYNTH1',
+                               'memberSince': start.format('YYYY-MM-DD')}}
+    for url in fitbit_urls:
+        period = url['period']
+        if period is None:
+            fitbit_data[url['name']] = {'lifetime': {'total': {'steps': 1}}}
+            continue
+        fitbit_data[url['name']] = {}
+        for period_start in arrow.Arrow.range(period, start.floor(period),
+                                              end):
+            days = arrow.Arrow.range('day', max(period_start, start),
+                                     min(period_start.ceil(period), end))
+            key = period_start.format(PERIOD_FORMATS[period])
+            fitbit_data[url['name']][key] = daily_values(url['name'], days)
+    return fitbit_data
+
+
+def measure(func):
+    """
+    Return the seconds and peak bytes allocated by func().
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+class Command(BaseCommand):
+    help = ('Measure time and peak memory of serializing, loading and merging '
+            'the Fitbit archive of a synthetic member, and the size and time '
+            'of gzipping it')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years', type=int, default=8,
+                            help='Years of daily data of the member')
+
+    def handle(self, *args, **options):
+        fitbit_data = synthetic_fitbit_data(options['years'])
+        update = {name: dict(list(value.items())[-1:])
+                  for name, value in fitbit_data.items()}
+        tmp_directory = tempfile.mkdtemp()
+        out_file = os.path.join(tmp_directory, 'fitbit-data.json')
+        merged_file = os.path.join(tmp_directory, 'merged.json')
+        gz_file = os.path.join(tmp_directory, 'fitbit-data.json.gz')
+
+        def dumps():
+            with open(out_file, 'w') as json_file:
+                json_file.write(json.dumps(fitbit_data))
+
+        def streamed():
+            with open(out_file, 'w') as json_file:
+                write_archive(fitbit_data, json_file)
+
+        def load():
+            with open(out_file) as json_file:
+                json.load(json_file)
+
+        def index():
+            with open(out_file) as json_file:
+                read_archive_index(json_file)
+
+        def slices():
+            with open(out_file) as json_file:
+                for _ in iter_archive_slices(json_file):
+                    pass
+
+        def load_merge():
+            with open(out_file) as json_file:
+                existing = json.load(json_file)
+            for name, value in update.items():
+                existing[name].update(value)
+            with open(merged_file, 'w') as json_file:
+                write_archive(existing, json_file)
+
+        def streamed_merge():
+            with open(out_file) as json_file, \
+                    open(merged_file, 'w') as merged:
+                merge_archive(json_file, update, merged)
+
+        def gzipped(level):
+            def write():
+                with override_settings(FITBIT_ARCHIVE_COMPRESSLEVEL=level):
+                    with open_archive(gz_file, 'w') as json_file:
+                        write_archive(fitbit_data, json_file)
+            return write
+
+        def gzipped_slices():
+            with open_archive(gz_file) as json_file:
+                for _ in iter_archive_slices(json_file):
+                    pass
+
+        try:
+            for name, func, path in [
+                    ('json.dumps', dumps, out_file),
+                    ('write_archive', streamed, out_file),
+                    ('json.load', load, out_file),
+                    ('read_archive_index', index, out_file),
+                    ('iter_archive_slices', slices, out_file),
+                    ('load and merge', load_merge, merged_file),
+                    ('merge_archive', streamed_merge, merged_file),
+                    ('gzip level 1', gzipped(1), gz_file),
+                    ('gzip level 9', gzipped(9), gz_file),
+                    ('gzip level 6', gzipped(6), gz_file),
+                    ('gzip slices', gzipped_slices, gz_file)]:
+                elapsed, peak = measure(func)
+                print('{:>20}  {:8.2f} s  {:10.1f} MB peak  {:10.2f} MB '
+                      'file'.format(name, elapsed, peak / 2 ** 20,
+                                    os.path.getsize(path) / 2 ** 20))
+        finally:
+            shutil.rmtree(tmp_directory)
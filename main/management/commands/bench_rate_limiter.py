@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from fitbit.settings import rr
+from requests_respectful import RespectfulRequester
+import time
+import uuid
+
+
+class Command(BaseCommand):
+    help = ('Compare the per-request cost of the scan and sorted_set rate '
+            'limiter backends with a given number of unrelated keys in Redis')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keys', type=int, nargs='+',
+                            default=[10000, 100000],
+                            help='Number of filler keys to benchmark with')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Number of requests to time per backend')
+
+    def handle(self, *args, **options):
+        backend = RespectfulRequester._config()['backend']
+        bench_id = uuid.uuid4().hex
+        realms = ['bench-{}'.format(bench_id), 'bench-{}-member'.format(bench_id)]
+        filler = '{}:REQUEST:bench-filler-{}'.format(rr.redis_prefix, bench_id)
+        for realm in realms:
+            rr.register_realm(realm, max_requests=10 ** 9, timespan=3600)
+
+        try:
+            filled = 0
+            for keys in sorted(options['keys']):
+                pipe = rr.redis.pipeline(transaction=False)
+                for i in range(filled, keys):
+                    pipe.setex('{}:{}'.format(filler, i), 3600, i)
+                pipe.execute()
+                filled = keys
+
+                for name in ['scan', 'sorted_set']:
+                    RespectfulRequester.configure(backend=name)
+                    start = time.perf_counter()
+                    for _ in range(options['requests']):
+                        rr._acquire_realms(realms)
+                    elapsed = time.perf_counter() - start
+                    print('{:>8} keys  {:>10}  {:8.3f} ms/request'.format(
+                        keys, name, elapsed * 1000 / options['requests']))
+        finally:
+            RespectfulRequester.configure(backend=backend)
+            rr.unregister_realms(realms)
+            for key in rr.redis.scan_iter(match='{}:*'.format(filler),
+                                          count=10000):
+                rr.redis.delete(key)
@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand
+from fitbit.settings import rr
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests_respectful import RespectfulRequester, RespectfulRequest
+import requests
+import threading
+import time
+import uuid
+
+
+class NoContentHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class NoContentServer(ThreadingHTTPServer):
+    # The pooled session keeps its connection alive, so each connection
+    # gets a thread that mustn't keep shutdown() waiting
+    daemon_threads = True
+
+
+def per_call(func, calls):
+    func()
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls
+
+
+class Command(BaseCommand):
+    help = ('Measure the per-call overhead RespectfulRequester adds on top of '
+            'a plain requests call, against a local HTTP server')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500,
+                            help='Number of requests to time per variant')
+
+    def handle(self, *args, **options):
+        server = NoContentServer(('127.0.0.1', 0), NoContentHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+        realms = ['bench-{}'.format(uuid.uuid4().hex)]
+        rr.register_realm(realms[0], max_requests=10 ** 9, timespan=3600)
+        calls = options['requests']
+
+        def validate_lambda():
+            rr._validate_request_func(lambda: requests.get(url))
+
+        def validate_lambda_uncached():
+            # This is what every request used to pay
+            RespectfulRequester._validated_request_funcs.clear()
+            validate_lambda()
+
+        def legacy_get():
+            RespectfulRequester._validated_request_funcs.clear()
+            return rr.request(lambda: requests.get(url), realms=realms)
+
+        print('Request validation')
+        for name, func in [
+                ('lambda, source read per call', validate_lambda_uncached),
+                ('lambda, validated once', validate_lambda),
+                ('RespectfulRequest', lambda: RespectfulRequest('get', url))]:
+            print('{:>30}  {:8.1f} us/call'.format(
+                name, per_call(func, calls) * 10 ** 6))
+
+        print('Full request to {}'.format(url))
+        try:
+            baseline = per_call(lambda: requests.get(url), calls)
+            for name, func in [
+                    ('rr.get before', legacy_get),
+                    ('rr.get', lambda: rr.get(url, realms=realms))]:
+                cost = per_call(func, calls)
+                print('{:>30}  {:8.1f} us/call  {:+8.1f} us over '
+                      'requests.get'.format(name, cost * 10 ** 6,
+                                            (cost - baseline) * 10 ** 6))
+        finally:
+            rr.unregister_realms(realms)
+            server.shutdown()
+            server.server_close()
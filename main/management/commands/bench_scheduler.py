@@ -0,0 +1,212 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from datauploader.fetch import MEMBER_MAX_REQUESTS
+from datauploader.scheduler import PendingSync, charge, plan_dispatch
+from collections import deque
+import heapq
+import random
+import statistics
+
+HOUR = 3600
+GLOBAL_MAX_REQUESTS = 3600
+# Requests the limiter keeps unused in every realm
+SAFETY_THRESHOLD = 5
+
+
+class Window(object):
+    """
+    Sliding one-hour window of a rate limiter realm, in virtual time.
+    """
+
+    def __init__(self, max_requests):
+        self.max_requests = max_requests
+        self.times = deque()
+
+    def used(self, now):
+        while self.times and self.times[0] <= now - HOUR:
+            self.times.popleft()
+        return len(self.times)
+
+    def full(self, now):
+        return self.used(now) >= self.max_requests - SAFETY_THRESHOLD
+
+    def retry_at(self):
+        return self.times[0] + HOUR
+
+
+class Simulation(object):
+    """
+    Replay the syncs of a cohort of members against the global and
+    per-member realms, with tasks run one at a time per worker and
+    rate-limited syncs resuming when the realm has room again, as
+    fetch_fitbit_data does.
+    """
+
+    def __init__(self, costs, staleness, options):
+        self.costs = costs
+        self.staleness = staleness
+        self.remaining = list(costs)
+        self.rate = options['request_rate']
+        self.overhead = options['overhead']
+        self.background = options['background']
+        self.global_window = Window(GLOBAL_MAX_REQUESTS)
+        self.member_windows = [Window(MEMBER_MAX_REQUESTS) for _ in costs]
+        self.queue = []
+        self.sequence = 0
+        self.completed = {}
+        self.task_runs = 0
+        self.limited_runs = 0
+        self.background_sent = 0
+        self.background_refused = 0
+        self.next_background = 0.0
+        self.dispatched = {}
+        self.resuming = {}
+
+    def enqueue(self, eta, member):
+        self.sequence += 1
+        heapq.heappush(self.queue, (eta, self.sequence, member))
+
+    def request(self, now, member=None):
+        windows = [self.global_window]
+        if member is not None:
+            windows.append(self.member_windows[member])
+        for window in windows:
+            if window.full(now):
+                return window.retry_at()
+        for window in windows:
+            window.times.append(now)
+        return None
+
+    def send_background(self, until):
+        # Notifications and new members' syncs, spread evenly
+        if not self.background:
+            return
+        while self.next_background <= until:
+            if self.request(self.next_background) is None:
+                self.background_sent += 1
+            else:
+                self.background_refused += 1
+            self.next_background += HOUR / self.background
+
+    def run_task(self, now, member):
+        self.task_runs += 1
+        self.dispatched.pop(member, None)
+        self.resuming.pop(member, None)
+        now += self.overhead
+        while self.remaining[member]:
+            self.send_background(now)
+            retry_at = self.request(now, member)
+            if retry_at is not None:
+                self.limited_runs += 1
+                self.resuming[member] = retry_at + 1
+                self.enqueue(retry_at + 1, member)
+                return now
+            self.remaining[member] -= 1
+            now += 1.0 / self.rate
+        self.completed[member] = now
+        return now
+
+    def schedule(self, now):
+        self.send_background(now)
+        reserve = int(GLOBAL_MAX_REQUESTS * settings.FITBIT_SCHEDULER_RESERVE)
+        budget = (GLOBAL_MAX_REQUESTS - reserve -
+                  self.global_window.used(now) - sum(self.dispatched.values()))
+        pending = [PendingSync(member, self.staleness[member] + now, cost)
+                   for member, cost in enumerate(self.remaining)
+                   if cost and member not in self.completed and
+                   member not in self.dispatched and
+                   member not in self.resuming]
+        for sync in plan_dispatch(pending, budget) if budget > 0 else []:
+            self.dispatched[sync.member_id] = charge(sync.cost)
+            self.enqueue(now, sync.member_id)
+
+    def run(self, policy, workers, every, max_hours):
+        free = [0.0] * workers
+        next_run = 0.0
+        if policy == 'all':
+            for member in range(len(self.costs)):
+                self.enqueue(0.0, member)
+            next_run = float('inf')
+        while (len(self.completed) < len(self.costs) and
+               min(free) < max_hours * HOUR):
+            worker = free.index(min(free))
+            now = free[worker]
+            while next_run <= now:
+                self.schedule(next_run)
+                next_run += every
+            if self.queue and self.queue[0][0] <= now:
+                _, _, member = heapq.heappop(self.queue)
+                free[worker] = self.run_task(now, member)
+            else:
+                free[worker] = min(self.queue[0][0] if self.queue
+                                   else float('inf'), next_run)
+        self.send_background(max(self.completed.values(), default=0))
+
+
+def percentiles(values):
+    if not values:
+        return '{:>7}  {:>7}  {:>7}'.format('-', '-', '-')
+    values = sorted(values)
+    return '{:7.2f}  {:7.2f}  {:7.2f}'.format(
+        statistics.median(values) / HOUR,
+        values[int(len(values) * 0.95) - 1] / HOUR, values[-1] / HOUR)
+
+
+class Command(BaseCommand):
+    help = ('Simulate syncing a cohort of stale members against the Fitbit '
+            'rate limits, queueing them all at once or through the '
+            'scheduler, and report their completion times')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=500,
+                            help='Number of stale members')
+        parser.add_argument('--backfills', type=float, default=0.1,
+                            help='Fraction of members still to backfill')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Celery worker processes')
+        parser.add_argument('--request-rate', type=float, default=8,
+                            help='Fitbit requests per second of a task')
+        parser.add_argument('--overhead', type=float, default=5,
+                            help='Seconds of a task spent outside of Fitbit '
+                                 'requests')
+        parser.add_argument('--background', type=int, default=200,
+                            help='Requests per hour of notifications and '
+                                 'new members')
+        parser.add_argument('--max-hours', type=float, default=48)
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        costs = []
+        staleness = []
+        for _ in range(options['members']):
+            if random.random() < options['backfills']:
+                costs.append(random.randint(300, 500))
+                staleness.append(7 * 24 * HOUR)
+            else:
+                costs.append(random.randint(20, 30))
+                staleness.append(random.uniform(4, 5) * 24 * HOUR)
+        backfills = {member for member, cost in enumerate(costs) if cost > 100}
+
+        print('{} members, {} backfilling, {} requests; completion hours '
+              '(median, p95, max)'.format(len(costs), len(backfills),
+                                          sum(costs)))
+        print('{:>10}  {:>25}  {:>25}  {:>6}  {:>7}  {:>10}'.format(
+            'policy', 'daily syncs', 'backfills', 'runs', 'limited',
+            'bg refused'))
+        for policy in ['all', 'scheduler']:
+            simulation = Simulation(costs, staleness, options)
+            simulation.run(policy, options['workers'],
+                           settings.FITBIT_SCHEDULE_EVERY,
+                           options['max_hours'])
+            daily = [at for member, at in simulation.completed.items()
+                     if member not in backfills]
+            backfill = [at for member, at in simulation.completed.items()
+                        if member in backfills]
+            print('{:>10}  {}  {}  {:6d}  {:7d}  {:10d}'.format(
+                policy, percentiles(daily), percentiles(backfill),
+                simulation.task_runs, simulation.limited_runs,
+                simulation.background_refused))
+            unfinished = len(costs) - len(simulation.completed)
+            if unfinished:
+                print('{:>10}  {} members unfinished after {} hours'.format(
+                    '', unfinished, options['max_hours']))
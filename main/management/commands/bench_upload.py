@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from datauploader.tasks import upload_files
+from datauploader.upload_stub import UploadStub
+from open_humans.models import OpenHumansMember
+import arrow
+import os
+import shutil
+import tempfile
+import time
+
+MB = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = ('Upload a set of files to a local stand-in for Open Humans and '
+            'S3 one at a time and concurrently, and report the throughput')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=24,
+                            help='Number of files, as a split layout sync '
+                                 'of a few years uploads')
+        parser.add_argument('--size', type=float, default=1,
+                            help='Size of each file in MB')
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='Seconds each request to the stand-in takes '
+                                 'before any data moves')
+        parser.add_argument('--bandwidth', type=float, default=8,
+                            help='MB/s of a single upload connection')
+        parser.add_argument('--concurrency', type=int, nargs='+',
+                            default=[1, 2, 4, 8])
+
+    def handle(self, *args, **options):
+        # Never saved, its token doesn't expire during the benchmark
+        oh_member = OpenHumansMember(
+            oh_id='bench', access_token='bench',
+            token_expires=arrow.now().shift(days=1).datetime)
+        tmp_directory = tempfile.mkdtemp()
+        stub = UploadStub(latency=options['latency'],
+                          bandwidth=options['bandwidth'] * MB)
+        try:
+            uploads = []
+            for i in range(options['files']):
+                path = os.path.join(tmp_directory,
+                                    'fitbit-bench-{}.json'.format(i))
+                with open(path, 'wb') as fh:
+                    fh.write(os.urandom(int(options['size'] * MB)))
+                uploads.append((path, {'tags': ['Fitbit']}))
+            total = options['files'] * options['size']
+            print('{} files, {:.1f} MB, {:.0f} ms latency, {:.1f} MB/s per '
+                  'connection'.format(options['files'], total,
+                                      options['latency'] * 1000,
+                                      options['bandwidth']))
+            print('{:>11}  {:>8}  {:>8}'.format('concurrency', 'seconds',
+                                                'MB/s'))
+            with override_settings(**stub.settings()):
+                for concurrency in options['concurrency']:
+                    start = time.perf_counter()
+                    done = list(upload_files(oh_member, uploads, concurrency))
+                    seconds = time.perf_counter() - start
+                    assert len(done) == len(uploads)
+                    print('{:>11}  {:8.2f}  {:8.1f}'.format(
+                        concurrency, seconds, total / seconds))
+        finally:
+            stub.shutdown()
+            shutil.rmtree(tmp_directory)
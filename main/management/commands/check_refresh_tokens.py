@@ -1,11 +1,35 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from main.models import FitbitMember
+from datauploader.tokens import refresh_expiring_tokens
+
+# Far enough ahead to include every token
+ALL_TOKENS = 100 * 365 * 24 * 3600
 
 
 class Command(BaseCommand):
-    help = 'Update data for all users'
+    help = ('Refresh the Fitbit and Open Humans tokens that expire soon, '
+            'concurrently')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--within', type=int,
+                            default=settings.FITBIT_TOKEN_REFRESH_AHEAD,
+                            help='Refresh tokens expiring within this many '
+                                 'seconds')
+        parser.add_argument('--all', action='store_true',
+                            help='Refresh every token')
+        parser.add_argument('--concurrency', type=int,
+                            help='Refreshes in flight at once')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Members written back per UPDATE')
 
     def handle(self, *args, **options):
-        for fb in FitbitMember.objects.all():
-            print(fb.user.user.oh_member.oh_id)
-            fb._refresh_tokens()
+        stats = refresh_expiring_tokens(
+            ALL_TOKENS if options['all'] else options['within'],
+            concurrency=options['concurrency'],
+            batch_size=options['batch_size'])
+        print('Refreshed {} of {} tokens ({} failed) in {:.2f} s, '
+              '{:.1f} tokens/s'.format(
+                  stats['refreshed'], stats['selected'], stats['failed'],
+                  stats['seconds'],
+                  stats['selected'] / stats['seconds']
+                  if stats['seconds'] else 0))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from datauploader.notifications import signature
+import json
+import requests
+
+
+class Command(BaseCommand):
+    help = ('Post recorded Fitbit Subscriber notifications, signed with this '
+            'app\'s client secret, to a subscriber endpoint, e.g. a local '
+            'runserver')
+
+    def add_arguments(self, parser):
+        parser.add_argument('payload',
+                            help='JSON file with a list of notifications, '
+                                 'as Fitbit posts them')
+        parser.add_argument(
+            '--url', default='http://127.0.0.1:8000/fitbit/notifications/',
+            help='Subscriber endpoint to post to')
+        parser.add_argument('--times', type=int, default=1,
+                            help='Post the payload this many times, as '
+                                 'Fitbit does with bursts of notifications')
+
+    def handle(self, *args, **options):
+        with open(options['payload']) as fh:
+            body = json.dumps(json.load(fh)).encode('utf-8')
+        for _ in range(options['times']):
+            response = requests.post(
+                options['url'], data=body,
+                headers={'Content-Type': 'application/json',
+                         'X-Fitbit-Signature': signature(body)})
+            print('{} {}'.format(response.status_code, options['url']))
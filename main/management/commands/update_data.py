@@ -2,18 +2,30 @@ from django.core.management.base import BaseCommand
 from main.models import FitbitMember
 from open_humans.models import OpenHumansMember
 from main.views import fetch_fitbit_data
+from datauploader.scheduler import schedule_syncs
 from fitbit.settings import OPENHUMANS_CLIENT_ID, OPENHUMANS_CLIENT_SECRET
 import arrow
 from datetime import timedelta
 
 class Command(BaseCommand):
-    help = 'Update data for all users'
+    help = ('Update data for stale users, as many as fit in the Fitbit '
+            'budget (or all of them with --all)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Queue every stale user at once')
 
     def handle(self, *args, **options):
+        if not options['all']:
+            for sync in schedule_syncs():
+                print("running update for member {} ({} requests)".format(
+                    sync.member_id, sync.cost))
+            return
+
         fitbit_users = FitbitMember.objects.all()
         for user in fitbit_users:
             if user.last_updated < (arrow.now() - timedelta(days=4)):
                 print("running update for user {}".format(user.userid))
                 fetch_fitbit_data.delay(user.id, user.access_token)
             else:
-                print("didn't update {}".format(user.userid))
\ No newline at end of file
+                print("didn't update {}".format(user.userid))
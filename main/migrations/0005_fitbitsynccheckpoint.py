@@ -0,0 +1,29 @@
+# Generated by Django 2.1.7 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_auto_20180504_1722'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FitbitSyncCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endpoint', models.CharField(max_length=64)),
+                ('period', models.CharField(blank=True, max_length=16)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('fetched_at', models.DateTimeField()),
+                ('fitbit_member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='main.FitbitMember')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='fitbitsynccheckpoint',
+            unique_together={('fitbit_member', 'endpoint', 'period')},
+        ),
+    ]
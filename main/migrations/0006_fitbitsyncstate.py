@@ -0,0 +1,26 @@
+# Generated by Django 2.1.7 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_fitbitsynccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FitbitSyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(null=True)),
+                ('cursor_endpoint', models.IntegerField(null=True)),
+                ('cursor_period', models.CharField(blank=True, max_length=16)),
+                ('pending_data', models.TextField(blank=True)),
+                ('resume_at', models.DateTimeField(null=True)),
+                ('fitbit_member', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_state', to='main.FitbitMember')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.1.7 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_fitbitsyncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FitbitArchiveFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('basename', models.CharField(max_length=128)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('oh_file_id', models.IntegerField(null=True)),
+                ('uploaded_at', models.DateTimeField()),
+                ('fitbit_member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_files', to='main.FitbitMember')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='fitbitarchivefile',
+            unique_together={('fitbit_member', 'basename')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.7 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_fitbitarchivefile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fitbitmember',
+            name='last_device_sync',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='fitbitsyncstate',
+            name='device_sync',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.1.7 on 2026-10-18 12:00
+
+import arrow
+from django.db import migrations, models
+
+
+def set_token_expires(apps, schema_editor):
+    # expires_in held either the expiry, when the token was refreshed, or
+    # the raw seconds of the OAuth callback; those are left unknown so
+    # they get refreshed first
+    FitbitMember = apps.get_model('main', 'FitbitMember')
+    for fitbit_member in FitbitMember.objects.all():
+        if fitbit_member.expires_in.isdigit():
+            continue
+        try:
+            token_expires = arrow.get(fitbit_member.expires_in).datetime
+        except (arrow.parser.ParserError, TypeError, ValueError):
+            continue
+        FitbitMember.objects.filter(pk=fitbit_member.pk).update(
+            token_expires=token_expires)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_device_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fitbitmember',
+            name='token_expires',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(set_token_expires, migrations.RunPython.noop),
+    ]
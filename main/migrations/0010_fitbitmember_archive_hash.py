@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_fitbitmember_token_expires'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fitbitmember',
+            name='archive_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.1.7 on 2026-10-18 12:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_fitbitmember_archive_hash'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='fitbitsyncstate',
+            name='cursor_endpoint',
+        ),
+        migrations.RemoveField(
+            model_name='fitbitsyncstate',
+            name='cursor_period',
+        ),
+    ]
@@ -2,9 +2,14 @@ from django.db import models
 from django.conf import settings
 from open_humans.models import OpenHumansMember
 from datetime import timedelta
+import json
+import logging
+from fitbit.sessions import session
 import requests
 import arrow
 
+logger = logging.getLogger(__name__)
+
 
 class FitbitMember(models.Model):
     """
@@ -15,13 +20,19 @@ class FitbitMember(models.Model):
     userid = models.CharField(max_length=255, unique=True, null=True)
     access_token = models.CharField(max_length=512)
     refresh_token = models.CharField(max_length=512)
+    # Lifetime in seconds of the access token, as Fitbit reports it
     expires_in = models.CharField(max_length=512)
+    token_expires = models.DateTimeField(null=True)
     scope = models.CharField(max_length=512)
     token_type = models.CharField(max_length=512)
     last_updated = models.DateTimeField(
                             default=(arrow.now() - timedelta(days=7)).format())
     last_submitted = models.DateTimeField(
                             default=(arrow.now() - timedelta(days=7)).format())
+    # Latest tracker sync time Fitbit reported when the last sync completed
+    last_device_sync = models.CharField(max_length=32, blank=True)
+    # Digest of the single-file archive as last uploaded to Open Humans
+    archive_hash = models.CharField(max_length=64, blank=True)
 
     @staticmethod
     def get_expiration(expires_in):
@@ -34,8 +45,12 @@ class FitbitMember(models.Model):
         Return access token. Refresh first if necessary.
         """
         # Also refresh if nearly expired (less than 60s remaining).
+        # Tokens are kept fresh by refresh_fitbit_tokens, so this only
+        # refreshes when that is behind.
         delta = timedelta(seconds=60)
-        if arrow.get(self.expires_in) - delta < arrow.now():
+        if (self.token_expires is None or
+                arrow.get(self.token_expires) - delta < arrow.now()):
+            logger.info('Refreshing expired token of {}'.format(self.userid))
             self._refresh_tokens()
         return self.access_token
 
@@ -43,22 +58,108 @@ class FitbitMember(models.Model):
         """
         Refresh access token.
         """
-        print("calling refresh token method in class")
-        response = requests.post(
-            'https://api.fitbit.com/oauth2/token',
+        data = self.request_token_refresh(self.refresh_token)
+        if data is None:
+            return False
+        self.set_tokens(data)
+        self.save()
+        return True
+
+    @staticmethod
+    def request_token_refresh(refresh_token):
+        """
+        Exchange a refresh token for new tokens. Returns Fitbit's token
+        response, or None if it was refused.
+        """
+        response = session.post(
+            settings.FITBIT_TOKEN_URL,
             data={
                 'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token},
+                'refresh_token': refresh_token},
             auth=requests.auth.HTTPBasicAuth(
                 settings.FITBIT_CLIENT_ID, settings.FITBIT_CLIENT_SECRET))
-        print(response.text)
-        if response.status_code == 200:
-            data = response.json()
-            self.access_token = data['access_token']
-            self.refresh_token = data['refresh_token']
-            self.token_expires = self.get_expiration(data['expires_in'])
-            self.scope = data['scope']
-            self.userid = data['user_id']
-            self.save()
-            return True
-        return False
+        if response.status_code != 200:
+            logger.warning('Token refresh refused: status {}'.format(
+                response.status_code))
+            return None
+        return response.json()
+
+    def set_tokens(self, data):
+        """
+        Take the tokens of a token response, without saving.
+        """
+        self.access_token = data['access_token']
+        self.refresh_token = data['refresh_token']
+        self.expires_in = data['expires_in']
+        self.token_expires = self.get_expiration(data['expires_in'])
+        self.scope = data['scope']
+        self.userid = data['user_id']
+
+
+class FitbitSyncCheckpoint(models.Model):
+    """
+    Record what is stored on Open Humans for one period of one endpoint,
+    so a sync knows what is present without downloading the archive.
+    Endpoints without periods (and the profile) use an empty period.
+    """
+    fitbit_member = models.ForeignKey(FitbitMember,
+                                      related_name="checkpoints",
+                                      on_delete=models.CASCADE)
+    endpoint = models.CharField(max_length=64)
+    period = models.CharField(max_length=16, blank=True)
+    content_hash = models.CharField(max_length=64)
+    fetched_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('fitbit_member', 'endpoint', 'period')
+
+    def __str__(self):
+        return "<FitbitSyncCheckpoint(endpoint='{}', period='{}')>".format(
+            self.endpoint, self.period)
+
+
+class FitbitSyncState(models.Model):
+    """
+    Store a sync that was interrupted by a rate limit, so the next run
+    resumes where it stopped instead of starting over.
+    pending_data holds the slices fetched so far as JSON, in the same shape
+    as the archive.
+    """
+    fitbit_member = models.OneToOneField(FitbitMember,
+                                         related_name="sync_state",
+                                         on_delete=models.CASCADE)
+    started_at = models.DateTimeField(null=True)
+    pending_data = models.TextField(blank=True)
+    resume_at = models.DateTimeField(null=True)
+    # Tracker sync time seen when this sync started
+    device_sync = models.CharField(max_length=32, blank=True)
+
+    def get_pending_data(self):
+        return json.loads(self.pending_data) if self.pending_data else {}
+
+    def reset(self):
+        self.started_at = None
+        self.pending_data = ''
+        self.resume_at = None
+        self.device_sync = ''
+        self.save()
+
+
+class FitbitArchiveFile(models.Model):
+    """
+    Record a file of the split archive layout as uploaded to Open Humans,
+    so a sync only re-uploads the files whose content changed.
+    """
+    fitbit_member = models.ForeignKey(FitbitMember,
+                                      related_name="archive_files",
+                                      on_delete=models.CASCADE)
+    basename = models.CharField(max_length=128)
+    content_hash = models.CharField(max_length=64)
+    oh_file_id = models.IntegerField(null=True)
+    uploaded_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('fitbit_member', 'basename')
+
+    def __str__(self):
+        return "<FitbitArchiveFile(basename='{}')>".format(self.basename)
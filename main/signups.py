@@ -0,0 +1,187 @@
+"""
+OAuth sign-ups completed in the background.
+
+The views Open Humans and Fitbit redirect back to only record a pending
+sign-up and queue its code exchange, then show a page polling
+signup_status. The token exchange and the work after it (creating the
+members, queueing the first fetch) run in a Celery task on the signups
+queue, so web workers don't wait on either upstream. A sign-up belongs to
+the browser session that started it and its state is kept in Redis.
+"""
+import json
+import logging
+import time
+import uuid
+
+import requests
+from django.conf import settings
+from datauploader.notifications import subscribe
+from datauploader.tasks import fetch_fitbit_data
+from fitbit.sessions import session
+from fitbit.settings import rr
+from open_humans.models import OpenHumansMember
+
+from .helpers import oh_get_member_data
+from .models import FitbitMember
+
+logger = logging.getLogger(__name__)
+
+SIGNUP_KEY = 'signup:{}'
+# Sign-ups are forgotten after an hour either way
+SIGNUP_EXPIRES = 3600
+# Sign-ups a browser session can have waiting at once
+SESSION_SIGNUPS = 5
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def start_signup(request, kind):
+    """
+    Record a pending sign-up ('oh' or 'fitbit') for the request's session.
+    Returns its ID.
+    """
+    signup_id = uuid.uuid4().hex
+    rr.redis.set(SIGNUP_KEY.format(signup_id),
+                 json.dumps({'kind': kind, 'status': PENDING,
+                             'started': time.time()}),
+                 ex=SIGNUP_EXPIRES)
+    signups = request.session.get('signups', [])[-(SESSION_SIGNUPS - 1):]
+    request.session['signups'] = signups + [signup_id]
+    return signup_id
+
+
+def finish_signup(signup_id, status, **fields):
+    """
+    Set the outcome of a sign-up, with e.g. the oh_id of its member.
+    """
+    signup = get_signup(signup_id) or {}
+    signup.update(fields, status=status)
+    rr.redis.set(SIGNUP_KEY.format(signup_id), json.dumps(signup),
+                 ex=SIGNUP_EXPIRES)
+
+
+def get_signup(signup_id):
+    """
+    The sign-up's state, or None if there is no such sign-up. Sign-ups
+    pending for longer than SIGNUP_TIMEOUT are failed.
+    """
+    signup = rr.redis.get(SIGNUP_KEY.format(signup_id))
+    if signup is None:
+        return None
+    signup = json.loads(signup)
+    if (signup['status'] == PENDING and
+            time.time() - signup['started'] > settings.SIGNUP_TIMEOUT):
+        logger.warning('Sign-up {} timed out'.format(signup_id))
+        signup['status'] = FAILED
+    return signup
+
+
+def forget_signup(request, signup_id):
+    rr.redis.delete(SIGNUP_KEY.format(signup_id))
+    request.session['signups'] = [s for s in request.session.get('signups', [])
+                                  if s != signup_id]
+
+
+def oh_code_to_member(code):
+    """
+    Exchange code for token, use this to create and return OpenHumansMember.
+    If a matching OpenHumansMember exists, update and return it.
+    """
+    if settings.OPENHUMANS_CLIENT_SECRET and \
+       settings.OPENHUMANS_CLIENT_ID and code:
+        data = {
+            'grant_type': 'authorization_code',
+            'redirect_uri':
+            '{}/complete/oh'.format(settings.OPENHUMANS_APP_BASE_URL),
+            'code': code,
+        }
+        req = session.post(
+            '{}/oauth2/token/'.format(settings.OPENHUMANS_OH_BASE_URL),
+            data=data,
+            auth=requests.auth.HTTPBasicAuth(
+                settings.OPENHUMANS_CLIENT_ID,
+                settings.OPENHUMANS_CLIENT_SECRET
+            )
+        )
+        data = req.json()
+
+        if 'access_token' in data:
+            oh_id = oh_get_member_data(
+                data['access_token'])['project_member_id']
+            try:
+                oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
+                logger.debug('Member {} re-authorized.'.format(oh_id))
+                oh_member.access_token = data['access_token']
+                oh_member.refresh_token = data['refresh_token']
+                oh_member.token_expires = OpenHumansMember.get_expiration(
+                    data['expires_in'])
+            except OpenHumansMember.DoesNotExist:
+                oh_member = OpenHumansMember.create(
+                    oh_id=oh_id,
+                    access_token=data['access_token'],
+                    refresh_token=data['refresh_token'],
+                    expires_in=data['expires_in'])
+                logger.debug('Member {} created.'.format(oh_id))
+            oh_member.save()
+
+            return oh_member
+
+        elif 'error' in data:
+            logger.debug('Error in token exchange: {}'.format(data))
+        else:
+            logger.warning('Neither token nor error info in OH response!')
+    else:
+        logger.error('OH_CLIENT_SECRET or code are unavailable')
+    return None
+
+
+def fitbit_code_to_member(oh_member, code):
+    """
+    Exchange code for Fitbit tokens, store them as the member's
+    FitbitMember and queue its first fetch. Returns the FitbitMember, or
+    None if the exchange was refused.
+    """
+    # https://dev.fitbit.com/build/reference/web-api/oauth2/#access-token-request
+    payload = {'code': code, 'grant_type': 'authorization_code'}
+    r = session.post(settings.FITBIT_TOKEN_URL, payload,
+                     auth=requests.auth.HTTPBasicAuth(
+                         settings.FITBIT_CLIENT_ID,
+                         settings.FITBIT_CLIENT_SECRET))
+    rjson = r.json()
+    if r.status_code != 200 or 'access_token' not in rjson:
+        logger.debug('Error in Fitbit token exchange: {}'.format(rjson))
+        return None
+
+    # Save the user as a FitbitMember and store tokens
+    try:
+        fitbit_member = FitbitMember.objects.get(userid=rjson['user_id'])
+        fitbit_member.access_token = rjson['access_token']
+        fitbit_member.refresh_token = rjson['refresh_token']
+        fitbit_member.expires_in = rjson['expires_in']
+        fitbit_member.token_expires = FitbitMember.get_expiration(
+            rjson['expires_in'])
+        fitbit_member.scope = rjson['scope']
+        fitbit_member.token_type = rjson['token_type']
+        fitbit_member.save()
+    except FitbitMember.DoesNotExist:
+        fitbit_member, created = FitbitMember.objects.get_or_create(
+            user=oh_member,
+            userid=rjson['user_id'],
+            access_token=rjson['access_token'],
+            refresh_token=rjson['refresh_token'],
+            expires_in=rjson['expires_in'],
+            token_expires=FitbitMember.get_expiration(rjson['expires_in']),
+            scope=rjson['scope'],
+            token_type=rjson['token_type'])
+
+    # Fetch user's data from Fitbit (update the data if it already existed)
+    fetch_fitbit_data.delay(fitbit_member.id, rjson['access_token'])
+    # Later changes come in as notifications, if a subscriber is set up
+    try:
+        subscribe(fitbit_member, rjson['access_token'])
+    except Exception as e:
+        logger.warning('Could not subscribe {}: {}'.format(
+            fitbit_member.userid, e))
+    return fitbit_member
@@ -0,0 +1,42 @@
+import logging
+
+from celery import shared_task
+from open_humans.models import OpenHumansMember
+
+from .signups import (DONE, FAILED, finish_signup, fitbit_code_to_member,
+                      oh_code_to_member)
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def complete_oh_signup(signup_id, code):
+    """
+    Exchange the code Open Humans returned a member with for their
+    OpenHumansMember.
+    """
+    try:
+        oh_member = oh_code_to_member(code=code)
+    except Exception as e:
+        logger.warning('Open Humans sign-up {} failed: {}'.format(
+            signup_id, e))
+        oh_member = None
+    if oh_member is None:
+        finish_signup(signup_id, FAILED)
+    else:
+        finish_signup(signup_id, DONE, oh_id=oh_member.oh_id)
+
+
+@shared_task
+def complete_fitbit_signup(signup_id, oh_id, code):
+    """
+    Exchange the code Fitbit returned a member with for their Fitbit
+    tokens and start their first fetch.
+    """
+    try:
+        fitbit_member = fitbit_code_to_member(
+            OpenHumansMember.objects.get(oh_id=oh_id), code)
+    except Exception as e:
+        logger.warning('Fitbit sign-up {} failed: {}'.format(signup_id, e))
+        fitbit_member = None
+    finish_signup(signup_id, FAILED if fitbit_member is None else DONE)
@@ -1,7 +1,16 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
+from unittest import mock
 import vcr
+from datauploader import tasks
+from datauploader.notifications import (notified_days, pop_notifications,
+                                        signature)
 from open_humans.models import OpenHumansMember
 from django.conf import settings
+from main import tasks as main_tasks
+from main.helpers import (MEMBER_DATA_KEY, get_member_data,
+                          invalidate_member_data, url_expiry)
+from fitbit.settings import rr
+import arrow
 
 FILTERSET = [('access_token', 'ACCESSTOKEN')]
 
@@ -33,3 +42,133 @@ class LoginTestCase(TestCase):
     #     self.assertTemplateUsed(response, 'main/complete.html')
     #     self.assertEqual(1,
     #                      OpenHumansMember.objects.all().count())
+
+
+@override_settings(FITBIT_SUBSCRIBER_VERIFY_CODE='verifyme',
+                   FITBIT_CLIENT_SECRET='secret')
+class NotificationsTestCase(TestCase):
+    """
+    Test the Fitbit Subscriber endpoint with a recorded notification
+    """
+
+    def setUp(self):
+        with open('main/tests/fitbit_notifications.json', 'rb') as fh:
+            self.body = fh.read()
+        pop_notifications('228S74')
+
+    def tearDown(self):
+        pop_notifications('228S74')
+
+    def test_verify(self):
+        c = Client()
+        response = c.get('/fitbit/notifications/', {'verify': 'verifyme'})
+        self.assertEqual(response.status_code, 204)
+        response = c.get('/fitbit/notifications/', {'verify': 'wrong'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_bad_signature(self):
+        c = Client()
+        response = c.post('/fitbit/notifications/', self.body,
+                          content_type='application/json',
+                          HTTP_X_FITBIT_SIGNATURE='bm90IGl0')
+        self.assertEqual(response.status_code, 404)
+
+    @mock.patch.object(tasks.process_fitbit_notifications, 'apply_async')
+    def test_burst_is_coalesced(self, apply_async):
+        c = Client()
+        for _ in range(3):
+            response = c.post('/fitbit/notifications/', self.body,
+                              content_type='application/json',
+                              HTTP_X_FITBIT_SIGNATURE=signature(self.body))
+            self.assertEqual(response.status_code, 204)
+        apply_async.assert_called_once_with(args=['228S74'], countdown=60)
+        # foods has no endpoint we fetch, so it isn't kept
+        notifications = pop_notifications('228S74')
+        self.assertEqual(notifications, [('activities', '2026-10-17'),
+                                         ('sleep', '2026-10-17')])
+        days = notified_days(notifications)
+        self.assertEqual(days['heart'], {'2026-10-17'})
+        self.assertEqual(days['activities-overview'], {'2026-10-17'})
+        self.assertEqual(days['sleep-minutes'], {'2026-10-17'})
+        self.assertNotIn('weight', days)
+
+
+class MemberDataCacheTestCase(TestCase):
+    """
+    Test caching the member's file listing from Open Humans
+    """
+
+    def setUp(self):
+        self.oh_member = OpenHumansMember(
+            oh_id='1234', access_token='a',
+            token_expires=arrow.now().shift(hours=1).datetime)
+        invalidate_member_data(self.oh_member)
+
+    def tearDown(self):
+        invalidate_member_data(self.oh_member)
+
+    def test_url_expiry(self):
+        self.assertEqual(
+            url_expiry('https://s3/f.json?X-Amz-Date=20261018T120000Z'
+                       '&X-Amz-Expires=3600&X-Amz-Signature=x'),
+            arrow.get('2026-10-18T13:00:00+00:00'))
+        self.assertEqual(url_expiry('https://s3/f.json?Expires=1800000000'),
+                         arrow.get(1800000000))
+        self.assertIsNone(url_expiry('https://s3/f.json'))
+
+    @mock.patch('main.helpers.oh_get_member_data')
+    def test_cached_until_invalidated(self, oh_get_member_data):
+        expires = arrow.now().shift(minutes=5).timestamp
+        oh_get_member_data.return_value = {'data': [{
+            'basename': 'fitbit-data.json',
+            'download_url': 'https://s3/f.json?Expires={}'.format(expires),
+            'metadata': {'tags': ['Fitbit']}}]}
+        for _ in range(3):
+            self.assertEqual(get_member_data(self.oh_member),
+                             oh_get_member_data.return_value)
+        self.assertEqual(oh_get_member_data.call_count, 1)
+        # Gone a minute before the download URL expires
+        ttl = rr.redis.ttl(MEMBER_DATA_KEY.format('1234'))
+        self.assertTrue(230 <= ttl <= 240)
+        invalidate_member_data(self.oh_member)
+        get_member_data(self.oh_member)
+        self.assertEqual(oh_get_member_data.call_count, 2)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.'
+                                       'StaticFilesStorage',
+                   FITBIT_CLIENT_ID='fitbit')
+class SignupTestCase(TestCase):
+    """
+    Test completing an Open Humans sign-up in the background
+    """
+
+    @mock.patch.object(main_tasks.complete_oh_signup, 'delay')
+    @mock.patch('main.tasks.oh_code_to_member')
+    def test_complete_and_poll(self, oh_code_to_member, delay):
+        c = Client()
+        response = c.get('/complete/oh', {'code': 'abc'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'main/connecting.html')
+        signup_id, code = delay.call_args[0]
+        self.assertEqual(code, 'abc')
+        status_url = '/complete/status/{}'.format(signup_id)
+        self.assertEqual(c.get(status_url, {'format': 'json'}).json(),
+                         {'status': 'pending'})
+        # Only the session that started it can see it
+        self.assertRedirects(Client().get(status_url), '/',
+                             fetch_redirect_response=False)
+
+        oh_member = OpenHumansMember.create(oh_id='1234', access_token='a',
+                                            refresh_token='r', expires_in=36000)
+        oh_member.save()
+        oh_code_to_member.return_value = oh_member
+        main_tasks.complete_oh_signup(signup_id, code)
+        self.assertEqual(c.get(status_url, {'format': 'json'}).json(),
+                         {'status': 'done'})
+        response = c.get(status_url)
+        self.assertTemplateUsed(response, 'main/fitbit.html')
+        self.assertEqual(response.context['user'], oh_member.user)
+        # Used up
+        self.assertRedirects(c.get(status_url), '/',
+                             fetch_redirect_response=False)
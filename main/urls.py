@@ -6,9 +6,13 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('complete/oh', views.complete, name='complete'),
     path('complete/fitbit', views.complete_fitbit, name='complete_fitbit'),
+    path('complete/status/<slug:signup_id>', views.signup_status,
+         name='signup_status'),
     path('dashboard/', views.dashboard, name='dashboard'),
     path('update_data/', views.update_data, name='update_data'),
     path('remove_fitbit/', views.remove_fitbit, name='remove_fitbit'),
+    path('fitbit/notifications/', views.fitbit_notifications,
+         name='fitbit_notifications'),
     path('about/', views.about, name='about'),
     path('logout/', views.user_logout, name='logout'),
 ]
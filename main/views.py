@@ -1,7 +1,5 @@
 import logging
-import requests
 import os
-import base64
 import json
 import arrow
 
@@ -9,11 +7,19 @@ from django.contrib import messages
 from django.contrib.auth import login, logout
 from django.shortcuts import render, redirect
 from django.conf import settings
-from datauploader.tasks import fetch_fitbit_data
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from datauploader.archive import archive_filenames
+from datauploader.notifications import (receive_notifications, unsubscribe,
+                                        verify_signature)
+from datauploader.tasks import fetch_fitbit_data, delete_oh_file_by_name
 from urllib.parse import parse_qs
 from open_humans.models import OpenHumansMember
-from .models import FitbitMember
-from .helpers import get_fitbit_file, check_update
+from .helpers import get_fitbit_files, check_update
+from .signups import (DONE, FAILED, PENDING, forget_signup, get_signup,
+                      start_signup)
+from .tasks import complete_fitbit_signup, complete_oh_signup
 
 
 # Set up logging.
@@ -21,7 +27,6 @@ logger = logging.getLogger(__name__)
 
 # Fitbit settings
 fitbit_authorize_url = 'https://www.fitbit.com/oauth2/authorize'
-fitbit_token_url = 'https://api.fitbit.com/oauth2/token'
 
 
 def user_logout(request):
@@ -60,8 +65,8 @@ def dashboard(request):
     if request.user.is_authenticated:
         if hasattr(request.user.oh_member, 'fitbit_member'):
             fitbit_member = request.user.oh_member.fitbit_member
-            download_file = get_fitbit_file(request.user.oh_member)
-            if download_file == 'error':
+            download_files = get_fitbit_files(request.user.oh_member)
+            if download_files == 'error':
                 logout(request)
                 return redirect("/")
             auth_url = ''
@@ -69,13 +74,13 @@ def dashboard(request):
         else:
             allow_update = False
             fitbit_member = ''
-            download_file = ''
+            download_files = []
             auth_url = 'https://www.fitbit.com/oauth2/authorize?response_type=code&client_id='+settings.FITBIT_CLIENT_ID+'&scope=activity%20nutrition%20heartrate%20location%20nutrition%20profile%20settings%20sleep%20social%20weight'
 
         context = {
             'oh_member': request.user.oh_member,
             'fitbit_member': fitbit_member,
-            'download_file': download_file,
+            'download_files': download_files,
             'connect_url': auth_url,
             'allow_update': allow_update
         }
@@ -85,68 +90,57 @@ def dashboard(request):
 
 
 def complete_fitbit(request):
+    """
+    Receive user from Fitbit and queue the exchange of their code.
+    """
+    if not request.user.is_authenticated or 'code' not in request.GET:
+        return redirect('/')
+    signup_id = start_signup(request, 'fitbit')
+    complete_fitbit_signup.delay(signup_id, request.user.oh_member.oh_id,
+                                 request.GET['code'])
+    return render_signup(request, signup_id)
 
-    code = request.GET['code']
-
-    # Create Base64 encoded string of clientid:clientsecret for the headers for Fitbit
-    # https://dev.fitbit.com/build/reference/web-api/oauth2/#access-token-request
-    encode_fitbit_auth = str(settings.FITBIT_CLIENT_ID) + ":" + str(settings.FITBIT_CLIENT_SECRET)
-    print(encode_fitbit_auth)
-    b64header = base64.b64encode(encode_fitbit_auth.encode("UTF-8")).decode("UTF-8")
-    # Add the payload of code and grant_type. Construct headers
-    payload = {'code': code, 'grant_type': 'authorization_code'}
-    headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Authorization': 'Basic %s' % (b64header)}
-    # Make request for access token
-    r = requests.post(fitbit_token_url, payload, headers=headers)
-    # print(r.json())
-
-    rjson = r.json()
-
-    oh_id = request.user.oh_member.oh_id
-    oh_user = OpenHumansMember.objects.get(oh_id=oh_id)
 
-    # Save the user as a FitbitMember and store tokens
+@csrf_exempt
+def fitbit_notifications(request):
+    """
+    Fitbit Subscriber endpoint. A GET with ?verify= checks the endpoint is
+    ours; a POST carries signed change notifications, which are queued.
+    Fitbit expects a 204 within seconds and a 404 for anything not meant
+    for this app.
+    """
+    if request.method == 'GET':
+        code = request.GET.get('verify')
+        if code and code == settings.FITBIT_SUBSCRIBER_VERIFY_CODE:
+            return HttpResponse(status=204)
+        return HttpResponse(status=404)
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+    if not verify_signature(request.body,
+                            request.META.get('HTTP_X_FITBIT_SIGNATURE')):
+        logger.warning('Fitbit notification with a bad signature')
+        return HttpResponse(status=404)
     try:
-        fitbit_member = FitbitMember.objects.get(userid=rjson['user_id'])
-        fitbit_member.access_token = rjson['access_token']
-        fitbit_member.refresh_token = rjson['refresh_token']
-        fitbit_member.expires_in = rjson['expires_in']
-        fitbit_member.scope = rjson['scope']
-        fitbit_member.token_type = rjson['token_type']
-        fitbit_member.save()
-    except FitbitMember.DoesNotExist:
-        fitbit_member, created = FitbitMember.objects.get_or_create(
-            user=oh_user,
-            userid=rjson['user_id'],
-            access_token=rjson['access_token'],
-            refresh_token=rjson['refresh_token'],
-            expires_in=rjson['expires_in'],
-            scope=rjson['scope'],
-            token_type=rjson['token_type'])
-
-    # Fetch user's data from Fitbit (update the data if it already existed)
-    # print(fitbit_member)
-    alldata = fetch_fitbit_data.delay(fitbit_member.id, rjson['access_token'])
-
-    context = {'oh_proj_page': settings.OH_ACTIVITY_PAGE}
-
-    if fitbit_member:
-        messages.info(request, "Your Fitbit account has been connected, and your data has been queued to be fetched from Fitbit")
-        return redirect('/dashboard')
-
-    logger.debug('Invalid code exchange. User returned to starting page.')
-    messages.info(request, ("Something went wrong, please try connecting your "
-                            "Fitbit account again"))
-    return redirect('/dashboard')
+        payload = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        return HttpResponse(status=400)
+    if not isinstance(payload, list) or not all(
+            isinstance(notification, dict) for notification in payload):
+        return HttpResponse(status=400)
+    receive_notifications(payload)
+    return HttpResponse(status=204)
 
 
 def remove_fitbit(request):
     if request.method == "POST" and request.user.is_authenticated:
         try:
             oh_member = request.user.oh_member
-            api.delete_file(oh_member.access_token,
-                            oh_member.oh_id,
-                            file_basename="fitbit-data.json")
+            fitbit_member = oh_member.fitbit_member
+            filenames = archive_filenames(fitbit_member.archive_hash) + [
+                f.basename for f in fitbit_member.archive_files.all()]
+            for filename in filenames:
+                delete_oh_file_by_name(oh_member, filename=filename)
+            unsubscribe(fitbit_member)
             messages.info(request, "Your Fitbit account has been removed")
             fitbit_account = request.user.oh_member.fitbit_member
             fitbit_account.delete()
@@ -178,99 +172,59 @@ def update_data(request):
 
 def complete(request):
     """
-    Receive user from Open Humans. Store data, start upload.
+    Receive user from Open Humans and queue the exchange of their code,
+    which creates an OpenHumansMember and associated user account.
     """
     logger.debug("Received user returning from Open Humans.")
-    # Exchange code for token.
-    # This creates an OpenHumansMember and associated user account.
     code = request.GET.get('code', '')
-    oh_member = oh_code_to_member(code=code)
-
-    if oh_member:
-        # Log in the user.
-        user = oh_member.user
-        login(request, user,
-              backend='django.contrib.auth.backends.ModelBackend')
+    if not code:
+        logger.debug('No code. User returned to starting page.')
+        return redirect('/')
+    signup_id = start_signup(request, 'oh')
+    complete_oh_signup.delay(signup_id, code)
+    return render_signup(request, signup_id)
 
-        context = {'oh_id': oh_member.oh_id,
-                   'oh_proj_page': settings.OH_ACTIVITY_PAGE}
 
-        if not hasattr(oh_member, 'fitbitmember'):
-            auth_url = 'https://www.fitbit.com/oauth2/authorize?response_type=code&client_id='+settings.FITBIT_CLIENT_ID+'&scope=activity%20nutrition%20heartrate%20location%20nutrition%20profile%20settings%20sleep%20social%20weight'
-            context['auth_url'] = auth_url
-            return render(request, 'main/fitbit.html',
-                        context=context)
-
-        return redirect("/dashboard")
-
-    logger.debug('Invalid code exchange. User returned to starting page.')
-    return redirect('/')
+def render_signup(request, signup_id):
+    context = {'status_url': reverse('signup_status', args=[signup_id]),
+               'oh_proj_page': settings.OH_ACTIVITY_PAGE}
+    return render(request, 'main/connecting.html', context=context)
 
 
-def oh_code_to_member(code):
+def signup_status(request, signup_id):
     """
-    Exchange code for token, use this to create and return OpenHumansMember.
-    If a matching OpenHumansMember exists, update and return it.
+    Report a sign-up of this session as JSON with ?format=json. Otherwise
+    show the waiting page until it is over, then log the member in after
+    Open Humans, or take them to their dashboard after Fitbit.
     """
-    if settings.OPENHUMANS_CLIENT_SECRET and \
-       settings.OPENHUMANS_CLIENT_ID and code:
-        print('{}/complete/oh'.format(settings.OPENHUMANS_APP_BASE_URL))
-        data = {
-            'grant_type': 'authorization_code',
-            'redirect_uri':
-            '{}/complete/oh'.format(settings.OPENHUMANS_APP_BASE_URL),
-            'code': code,
-        }
-        req = requests.post(
-            '{}/oauth2/token/'.format(settings.OPENHUMANS_OH_BASE_URL),
-            data=data,
-            auth=requests.auth.HTTPBasicAuth(
-                settings.OPENHUMANS_CLIENT_ID,
-                settings.OPENHUMANS_CLIENT_SECRET
-            )
-        )
-        data = req.json()
-
-        if 'access_token' in data:
-            oh_id = oh_get_member_data(
-                data['access_token'])['project_member_id']
-            try:
-                oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
-                logger.debug('Member {} re-authorized.'.format(oh_id))
-                oh_member.access_token = data['access_token']
-                oh_member.refresh_token = data['refresh_token']
-                oh_member.token_expires = OpenHumansMember.get_expiration(
-                    data['expires_in'])
-            except OpenHumansMember.DoesNotExist:
-                oh_member = OpenHumansMember.create(
-                    oh_id=oh_id,
-                    access_token=data['access_token'],
-                    refresh_token=data['refresh_token'],
-                    expires_in=data['expires_in'])
-                logger.debug('Member {} created.'.format(oh_id))
-            oh_member.save()
-
-            return oh_member
-
-        elif 'error' in req.json():
-            logger.debug('Error in token exchange: {}'.format(req.json()))
+    if signup_id not in request.session.get('signups', []):
+        return redirect('/')
+    signup = get_signup(signup_id) or {'kind': 'oh', 'status': FAILED}
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'status': signup['status']})
+    if signup['status'] == PENDING:
+        return render_signup(request, signup_id)
+    forget_signup(request, signup_id)
+
+    if signup['kind'] == 'fitbit':
+        if signup['status'] == DONE:
+            messages.info(request, "Your Fitbit account has been connected, and your data has been queued to be fetched from Fitbit")
         else:
-            logger.warning('Neither token nor error info in OH response!')
-    else:
-        logger.error('OH_CLIENT_SECRET or code are unavailable')
-    return None
-
+            logger.debug('Invalid code exchange. User returned to dashboard.')
+            messages.info(request, ("Something went wrong, please try "
+                                    "connecting your Fitbit account again"))
+        return redirect('/dashboard')
 
-def oh_get_member_data(token):
-    """
-    Exchange OAuth2 token for member data.
-    """
-    req = requests.get(
-        '{}/api/direct-sharing/project/exchange-member/'
-        .format(settings.OPENHUMANS_OH_BASE_URL),
-        params={'access_token': token}
-        )
-    if req.status_code == 200:
-        return req.json()
-    raise Exception('Status code {}'.format(req.status_code))
-    return None
+    if signup['status'] != DONE:
+        logger.debug('Invalid code exchange. User returned to starting page.')
+        return redirect('/')
+    oh_member = OpenHumansMember.objects.get(oh_id=signup['oh_id'])
+    # Log in the user.
+    login(request, oh_member.user,
+          backend='django.contrib.auth.backends.ModelBackend')
+    if hasattr(oh_member, 'fitbit_member'):
+        return redirect("/dashboard")
+    context = {'oh_id': oh_member.oh_id,
+               'oh_proj_page': settings.OH_ACTIVITY_PAGE,
+               'auth_url': 'https://www.fitbit.com/oauth2/authorize?response_type=code&client_id='+settings.FITBIT_CLIENT_ID+'&scope=activity%20nutrition%20heartrate%20location%20nutrition%20profile%20settings%20sleep%20social%20weight'}
+    return render(request, 'main/fitbit.html', context=context)
@@ -5,6 +5,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
 import requests
+from fitbit.sessions import session
 
 OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
 OH_API_BASE = OH_BASE_URL + '/api/direct-sharing'
@@ -85,15 +86,34 @@ class OpenHumansMember(models.Model):
         """
         Refresh access token.
         """
-        response = requests.post(
+        data = self.request_token_refresh(self.refresh_token, client_id,
+                                          client_secret)
+        if data is not None:
+            self.set_tokens(data)
+            self.save()
+
+    @staticmethod
+    def request_token_refresh(refresh_token,
+                              client_id=settings.OPENHUMANS_CLIENT_ID,
+                              client_secret=settings.OPENHUMANS_CLIENT_SECRET):
+        """
+        Exchange a refresh token for new tokens. Returns the token response,
+        or None if it was refused.
+        """
+        response = session.post(
             'https://www.openhumans.org/oauth2/token/',
             data={
                 'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token},
+                'refresh_token': refresh_token},
             auth=requests.auth.HTTPBasicAuth(client_id, client_secret))
-        if response.status_code == 200:
-            data = response.json()
-            self.access_token = data['access_token']
-            self.refresh_token = data['refresh_token']
-            self.token_expires = self.get_expiration(data['expires_in'])
-            self.save()
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    def set_tokens(self, data):
+        """
+        Take the tokens of a token response, without saving.
+        """
+        self.access_token = data['access_token']
+        self.refresh_token = data['refresh_token']
+        self.token_expires = self.get_expiration(data['expires_in'])
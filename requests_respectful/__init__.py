@@ -12,5 +12,5 @@
 __author__ = "Nicholas Brochu"
 __version__ = "0.1.2"
 
-from .respectful_requester import RespectfulRequester
+from .respectful_requester import RespectfulRequester, RespectfulRequest
 from .exceptions import *
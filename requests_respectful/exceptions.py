@@ -4,7 +4,11 @@ class RequestsRespectfulError(Exception):
 
 
 class RequestsRespectfulRateLimitedError(Exception):
-    pass
+    def __init__(self, message=None, retry_at=None):
+        super(RequestsRespectfulRateLimitedError, self).__init__(message)
+
+        # Unix timestamp at which the request would be permitted, if known
+        self.retry_at = retry_at
 
 
 class RequestsRespectfulConfigError(Exception):
@@ -20,9 +20,14 @@ default_config = {
         "database": 0
     },
     "safety_threshold": 10,
-    "requests_module_name": "requests"
+    "requests_module_name": "requests",
+    "backend": "sorted_set",
+    "realm_cache_ttl": 30
 }
 
+# "sorted_set" keeps one sorted set per realm, "scan" is the legacy one-key-per-request backend
+backends = ["sorted_set", "scan"]
+
 try:
     with open("requests-respectful.config.yml", "r") as f:
         config = yaml.load(f)
@@ -43,6 +48,22 @@ try:
                 "'requests_module_name' key must be a string in 'requests-respectful.config.yml'"
             )
 
+    if "backend" not in config:
+        config["backend"] = default_config.get("backend")
+    else:
+        if config["backend"] not in backends:
+            raise RequestsRespectfulConfigError(
+                "'backend' key must be one of %s in 'requests-respectful.config.yml'" % ", ".join(backends)
+            )
+
+    if "realm_cache_ttl" not in config:
+        config["realm_cache_ttl"] = default_config.get("realm_cache_ttl")
+    else:
+        if type(config["realm_cache_ttl"]) != int or config["realm_cache_ttl"] < 0:
+            raise RequestsRespectfulConfigError(
+                "'realm_cache_ttl' key must be a positive integer in 'requests-respectful.config.yml'"
+            )
+
     if "redis" not in config:
         raise RequestsRespectfulConfigError("'redis' key is missing from 'requests-respectful.config.yml'")
 
@@ -1,5 +1,6 @@
-from .globals import default_config, config, redis
+from .globals import default_config, config, redis, backends
 from .exceptions import RequestsRespectfulError, RequestsRespectfulConfigError, RequestsRespectfulRateLimitedError, RequestsRespectfulRedisError
+from . import scripts
 
 from redis import StrictRedis, ConnectionError
 
@@ -12,16 +13,81 @@ import requests
 import warnings
 
 
+class RespectfulRequest(object):
+    """
+    A requests call described by its method, url and keyword arguments.
+    It is validated once when constructed, so performing it is just the requests call.
+    """
+
+    methods = ["delete", "get", "head", "options", "patch", "post", "put"]
+
+    # Names of the keyword arguments the requests functions also accept positionally after the url
+    positional_kwargs = {
+        "get": ["params"],
+        "patch": ["data"],
+        "post": ["data", "json"],
+        "put": ["data"]
+    }
+
+    __slots__ = ("method", "url", "kwargs")
+
+    def __init__(self, method, url=None, *args, **kwargs):
+        method = method.lower()
+
+        if method not in self.methods:
+            raise RequestsRespectfulError("'%s' isn't a supported request method" % method)
+
+        if not url:
+            raise RequestsRespectfulError("A request needs a url")
+
+        positional_kwargs = self.positional_kwargs.get(method, list())
+
+        if len(args) > len(positional_kwargs):
+            raise RequestsRespectfulError("Too many positional arguments for a '%s' request" % method)
+
+        for name, value in zip(positional_kwargs, args):
+            kwargs[name] = value
+
+        if method == "head":
+            # Same default as requests.head
+            kwargs.setdefault("allow_redirects", False)
+
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+
+    def __call__(self, session=None):
+        return (session or requests).request(self.method, self.url, **self.kwargs)
+
+    def __repr__(self):
+        return "<RespectfulRequest(method='%s', url='%s')>" % (self.method.upper(), self.url)
+
+
 class RespectfulRequester:
 
-    def __init__(self):
+    # Code objects of request lambdas that already passed validation
+    _validated_request_funcs = set()
+
+    def __init__(self, session=None):
         self.redis = redis
 
+        # Anything with a requests.Session compatible request(), used to perform RespectfulRequests
+        self.session = session
+
         try:
             self.redis.echo("Testing Connection")
         except ConnectionError:
             raise RequestsRespectfulRedisError("Could not establish a connection to the provided Redis server")
 
+        self._acquire_realms_script = self.redis.register_script(scripts.ACQUIRE_REALMS)
+        self._count_realm_script = self.redis.register_script(scripts.COUNT_REALM)
+
+        # Local copy of the realms' configuration, valid as long as the
+        # configuration version in Redis doesn't change
+        self._realm_cache = dict()
+        self._realm_cache_version = None
+        self._realm_cache_checked_at = 0
+
     def __getattr__(self, attr):
         if attr in ["delete", "get", "head", "options", "patch", "post", "put"]:
             return getattr(self, "_requests_proxy_%s" % attr)
@@ -37,20 +103,20 @@ class RespectfulRequester:
             warnings.warn("'realm' kwarg will be removed in favor of providing a 'realms' list starting in 0.3.0", DeprecationWarning)
             realms = [realm]
 
-        registered_realms = self.fetch_registered_realms()
+        realms = list(realms or list())
 
         for r in realms:
-            if r not in registered_realms:
-                raise RequestsRespectfulError("Realm '%s' hasn't been registered" % realm)
+            if self._realm_info(r) is None:
+                raise RequestsRespectfulError("Realm '%s' hasn't been registered" % r)
 
         if wait:
             while True:
                 try:
                     return self._perform_request(request_func, realms=realms)
-                except RequestsRespectfulRateLimitedError:
-                    pass
+                except RequestsRespectfulRateLimitedError as e:
+                    delay = 1 if e.retry_at is None else e.retry_at - time.time()
 
-                time.sleep(1)
+                time.sleep(min(max(delay, 0.01), 1))
         else:
             return self._perform_request(request_func, realms=realms)
 
@@ -60,9 +126,11 @@ class RespectfulRequester:
     def register_realm(self, realm, max_requests, timespan):
         redis_key = self._realm_redis_key(realm)
 
+        # Always checked in Redis, another process may have unregistered the realm
         if not self.redis.hexists(redis_key, "max_requests"):
             self.redis.hmset(redis_key, {"max_requests": max_requests, "timespan": timespan})
             self.redis.sadd("%s:REALMS" % self.redis_prefix, realm)
+            self._bump_realm_cache_version()
 
         return True
 
@@ -75,20 +143,32 @@ class RespectfulRequester:
     def update_realm(self, realm, **kwargs):
         redis_key = self._realm_redis_key(realm)
         updatable_keys = ["max_requests", "timespan"]
+        realm_info = self._realm_info(realm)
+        updated = False
 
         for updatable_key in updatable_keys:
             if updatable_key in kwargs and type(kwargs[updatable_key]) == int:
+                if realm_info is not None and realm_info[updatable_key] == kwargs[updatable_key]:
+                    continue
+
                 self.redis.hset(redis_key, updatable_key, kwargs[updatable_key])
+                updated = True
+
+        if updated:
+            self._bump_realm_cache_version()
 
         return True
 
     def unregister_realm(self, realm):
         self.redis.delete(self._realm_redis_key(realm))
+        self.redis.delete(self._realm_requests_redis_key(realm))
         self.redis.srem("%s:REALMS" % self.redis_prefix, realm)
 
         request_keys = self.redis.keys("%s:REQUEST:%s:*" % (self.redis_prefix, realm))
         [self.redis.delete(k) for k in request_keys]
 
+        self._bump_realm_cache_version()
+
         return True
 
     def unregister_realms(self, realms):
@@ -98,12 +178,13 @@ class RespectfulRequester:
         return True
 
     def realm_max_requests(self, realm):
-        realm_info = self._fetch_realm_info(realm)
-        return int(realm_info["max_requests".encode("utf-8")].decode("utf-8"))
+        return self._registered_realm_info(realm)["max_requests"]
 
     def realm_timespan(self, realm):
-        realm_info = self._fetch_realm_info(realm)
-        return int(realm_info["timespan".encode("utf-8")].decode("utf-8"))
+        return self._registered_realm_info(realm)["timespan"]
+
+    def realm_requests_in_timespan(self, realm):
+        return self._requests_in_timespan(realm)
 
     @classmethod
     def configure(cls, **kwargs):
@@ -146,6 +227,18 @@ class RespectfulRequester:
 
             config["requests_module_name"] = kwargs["requests_module_name"]
 
+        if "backend" in kwargs:
+            if kwargs["backend"] not in backends:
+                raise RequestsRespectfulConfigError("'backend' key must be one of %s" % ", ".join(backends))
+
+            config["backend"] = kwargs["backend"]
+
+        if "realm_cache_ttl" in kwargs:
+            if type(kwargs["realm_cache_ttl"]) != int or kwargs["realm_cache_ttl"] < 0:
+                raise RequestsRespectfulConfigError("'realm_cache_ttl' key must be a positive integer")
+
+            config["realm_cache_ttl"] = kwargs["realm_cache_ttl"]
+
         return config
 
     @classmethod
@@ -156,7 +249,56 @@ class RespectfulRequester:
         return config
 
     def _perform_request(self, request_func, realms=None):
-        self._validate_request_func(request_func)
+        if not isinstance(request_func, RespectfulRequest):
+            self._validate_request_func(request_func)
+
+        rate_limited_realms, retry_at = self._acquire_realms(realms)
+
+        if not len(rate_limited_realms):
+            if isinstance(request_func, RespectfulRequest):
+                return request_func(session=self.session)
+
+            return request_func()
+        else:
+            raise RequestsRespectfulRateLimitedError(
+                "Currently rate-limited on Realm(s): %s" % ", ".join(rate_limited_realms),
+                retry_at=retry_at
+            )
+
+    def _acquire_realms(self, realms):
+        """
+        Record a request in all of the realms, or in none of them if any is rate-limited.
+        Returns the rate-limited realms and the Unix timestamp at which the request would be permitted.
+        """
+        if not len(realms):
+            return list(), None
+
+        request_uuid = str(uuid.uuid4())
+
+        if config["backend"] == "sorted_set":
+            # Read before the configuration, so it can only be older than the configuration sent
+            version = self._realm_cache_version
+            keys = [self._realm_cache_version_redis_key()]
+            args = [version, config["safety_threshold"], request_uuid]
+
+            for realm in realms:
+                realm_info = self._registered_realm_info(realm)
+                keys.append(self._realm_requests_redis_key(realm))
+                args.extend([realm_info["max_requests"], realm_info["timespan"]])
+
+            reply = self._acquire_realms_script(keys=keys, args=args)
+
+            if reply[0] == -1:
+                # Another process changed the realms' configuration, reload it and try again
+                self._reset_realm_cache(int(reply[1]))
+                return self._acquire_realms(realms)
+
+            self._realm_cache_checked_at = time.time()
+
+            if reply[0]:
+                return list(), None
+
+            return [realms[n - 1] for n in reply[2:]], reply[1] / 1000.0
 
         rate_limited_realms = list()
 
@@ -164,19 +306,17 @@ class RespectfulRequester:
             if not self._can_perform_request(realm):
                 rate_limited_realms.append(realm)
 
-        if not len(rate_limited_realms):
-            for realm in realms:
-                request_uuid = str(uuid.uuid4())
+        if len(rate_limited_realms):
+            return rate_limited_realms, None
 
-                self.redis.setex(
-                    name="%s:REQUEST:%s:%s" % (self.redis_prefix, realm, request_uuid),
-                    time=self.realm_timespan(realm),
-                    value=request_uuid
-                )
+        for realm in realms:
+            self.redis.setex(
+                name="%s:REQUEST:%s:%s" % (self.redis_prefix, realm, request_uuid),
+                time=self.realm_timespan(realm),
+                value=request_uuid
+            )
 
-            return request_func()
-        else:
-            raise RequestsRespectfulRateLimitedError("Currently rate-limited on Realm(s): %s" % ", ".join(rate_limited_realms))
+        return list(), None
 
     def _realm_redis_key(self, realm):
         return "%s:REALMS:%s" % (self.redis_prefix, realm)
@@ -185,7 +325,71 @@ class RespectfulRequester:
         redis_key = self._realm_redis_key(realm)
         return self.redis.hgetall(redis_key)
 
+    def _realm_cache_version_redis_key(self):
+        return "%s:REALMS_VERSION" % self.redis_prefix
+
+    def _realm_info(self, realm):
+        """
+        Return the realm's configuration from the local cache, fetching it on a miss.
+        Returns None if the realm hasn't been registered.
+        """
+        if time.time() - self._realm_cache_checked_at > config["realm_cache_ttl"]:
+            version = int(self.redis.get(self._realm_cache_version_redis_key()) or 0)
+
+            if version != self._realm_cache_version:
+                self._reset_realm_cache(version)
+
+            self._realm_cache_checked_at = time.time()
+
+        # Another thread may swap the cache for an empty one at any time
+        realm_cache = self._realm_cache
+        realm_info = realm_cache.get(realm)
+
+        if realm_info is None:
+            fetched = self._fetch_realm_info(realm)
+
+            if not fetched:
+                return None
+
+            realm_info = {
+                "max_requests": int(fetched["max_requests".encode("utf-8")].decode("utf-8")),
+                "timespan": int(fetched["timespan".encode("utf-8")].decode("utf-8"))
+            }
+            realm_cache[realm] = realm_info
+
+        return realm_info
+
+    def _registered_realm_info(self, realm):
+        realm_info = self._realm_info(realm)
+
+        if realm_info is None:
+            raise RequestsRespectfulError("Realm '%s' hasn't been registered" % realm)
+
+        return realm_info
+
+    def _reset_realm_cache(self, version):
+        # The cache is emptied before the version changes, so whoever reads
+        # the new version only finds configuration fetched after it
+        self._realm_cache = dict()
+        self._realm_cache_version = version
+        self._realm_cache_checked_at = time.time()
+
+    def _bump_realm_cache_version(self):
+        self._reset_realm_cache(self.redis.incr(self._realm_cache_version_redis_key()))
+
+    def _realm_requests_redis_key(self, realm):
+        return "%s:REQUESTS:%s" % (self.redis_prefix, realm)
+
+    def _realm_request_limit(self, realm):
+        return self.realm_max_requests(realm) - config["safety_threshold"]
+
     def _requests_in_timespan(self, realm):
+        if config["backend"] == "sorted_set":
+            return self._count_realm_script(
+                keys=[self._realm_requests_redis_key(realm)],
+                args=[self.realm_timespan(realm) * 1000]
+            )
+
         return len(
             self.redis.scan(
                 cursor=0,
@@ -198,7 +402,7 @@ class RespectfulRequester:
         return self.redis.info().get("db%d" % config["redis"]["database"]).get("keys")
 
     def _can_perform_request(self, realm):
-        return self._requests_in_timespan(realm) < (self.realm_max_requests(realm) - config["safety_threshold"])
+        return self._requests_in_timespan(realm) < self._realm_request_limit(realm)
 
     # Requests proxy
     def _requests_proxy(self, method, *args, **kwargs):
@@ -214,7 +418,7 @@ class RespectfulRequester:
 
         wait = kwargs.pop("wait", False)
 
-        return self.request(lambda: getattr(requests, method)(*args, **kwargs), realms=realms, wait=wait)
+        return self.request(RespectfulRequest(method, *args, **kwargs), realms=realms, wait=wait)
 
     def _requests_proxy_delete(self, *args, **kwargs):
         return self._requests_proxy("delete", *args, **kwargs)
@@ -237,14 +441,23 @@ class RespectfulRequester:
     def _requests_proxy_put(self, *args, **kwargs):
         return self._requests_proxy("put", *args, **kwargs)
 
-    @staticmethod
-    def _validate_request_func(request_func):
+    @classmethod
+    def _validate_request_func(cls, request_func):
+        # Reading the source is expensive, so each lambda is only validated once
+        request_func_code = getattr(request_func, "__code__", None)
+
+        if request_func_code is not None and request_func_code in cls._validated_request_funcs:
+            return
+
         request_func_string = inspect.getsource(request_func)
         post_lambda_string = request_func_string.split(":")[1].strip()
 
         if not post_lambda_string.startswith(config["requests_module_name"]) and not post_lambda_string.startswith("getattr(requests"):
             raise RequestsRespectfulError("The request lambda can only contain a requests function call")
 
+        if request_func_code is not None:
+            cls._validated_request_funcs.add(request_func_code)
+
     @staticmethod
     def _config():
         return config
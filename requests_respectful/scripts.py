@@ -0,0 +1,100 @@
+"""
+    Lua scripts executed server-side by the sorted set limiter backend.
+
+    Every realm keeps a single sorted set of request ids scored by the time
+    (in milliseconds, taken from the Redis server clock) at which they were
+    performed, so checking a realm only touches that realm's key instead of
+    walking the whole keyspace.
+"""
+
+# KEYS[1] - realm configuration version
+# KEYS[n + 1] - sorted set of requests performed in the n-th realm
+# ARGV[1] - realm configuration version the caller's configuration belongs to
+# ARGV[2] - safety threshold
+# ARGV[3] - id of the request to record
+# ARGV[2n + 2], ARGV[2n + 3] - max requests and timespan (in seconds) of the n-th realm
+#
+# Records the request in every realm, or in none of them if any realm is
+# rate-limited. Returns {1, now} when the request was recorded, otherwise
+# {0, retry_at, n...} where retry_at is the earliest time (in milliseconds)
+# at which every realm has room again and n are the rate-limited realms.
+# Returns {-1, version} without recording anything when the caller's realm
+# configuration is out of date.
+ACQUIRE_REALMS = """
+local version = redis.call("GET", KEYS[1]) or "0"
+
+if version ~= ARGV[1] then
+    return {-1, version}
+end
+
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local threshold = tonumber(ARGV[2])
+local timespans = {}
+local rate_limited = {}
+local retry_at = now
+
+for n = 1, #KEYS - 1 do
+    local key = KEYS[n + 1]
+    local limit = tonumber(ARGV[2 * n + 2]) - threshold
+    local timespan = tonumber(ARGV[2 * n + 3]) * 1000
+    timespans[n] = timespan
+
+    redis.call("ZREMRANGEBYSCORE", key, "-inf", now - timespan)
+
+    local count = redis.call("ZCARD", key)
+
+    if count >= limit then
+        local frees_at = now + timespan
+
+        if limit > 0 then
+            local oldest = redis.call("ZRANGE", key, count - limit, count - limit, "WITHSCORES")
+            frees_at = tonumber(oldest[2]) + timespan
+        end
+
+        if frees_at > retry_at then
+            retry_at = frees_at
+        end
+
+        table.insert(rate_limited, n)
+    end
+end
+
+if #rate_limited > 0 then
+    local reply = {0, retry_at}
+
+    for _, n in ipairs(rate_limited) do
+        table.insert(reply, n)
+    end
+
+    return reply
+end
+
+for n = 1, #KEYS - 1 do
+    redis.call("ZADD", KEYS[n + 1], now, ARGV[3])
+    redis.call("PEXPIRE", KEYS[n + 1], timespans[n])
+end
+
+return {1, now}
+"""
+
+# KEYS[1] - sorted set of requests performed in the realm
+# ARGV[1] - realm timespan in milliseconds
+#
+# Returns the number of requests performed in the realm's current timespan.
+COUNT_REALM = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - tonumber(ARGV[1]))
+
+return redis.call("ZCARD", KEYS[1])
+"""
@@ -0,0 +1,115 @@
+from unittest import TestCase, mock
+import time
+
+from .globals import config
+from .respectful_requester import RespectfulRequest, RespectfulRequester
+
+
+class TestRequester(RespectfulRequester):
+    """
+    RespectfulRequester keeping its keys apart from the app's.
+    """
+
+    @property
+    def redis_prefix(self):
+        return "RespectfulRequesterTest"
+
+
+class SortedSetBackendTestCase(TestCase):
+    """
+    Test the sorted set backend's Lua scripts against the Redis server
+    """
+
+    def setUp(self):
+        self.requester = TestRequester()
+        # Leaves room for two requests in a realm of max_requests 12
+        self.threshold = config["safety_threshold"]
+        config["safety_threshold"] = 10
+
+    def tearDown(self):
+        config["safety_threshold"] = self.threshold
+        keys = self.requester.redis.keys("RespectfulRequesterTest:*")
+        if keys:
+            self.requester.redis.delete(*keys)
+
+    def test_sliding_window(self):
+        self.requester.register_realm("Short", max_requests=12, timespan=1)
+        self.assertEqual(self.requester._acquire_realms(["Short"]), ([], None))
+        time.sleep(0.5)
+        self.assertEqual(self.requester._acquire_realms(["Short"]), ([], None))
+        self.assertEqual(
+            self.requester._acquire_realms(["Short"])[0], ["Short"])
+        self.assertEqual(self.requester.realm_requests_in_timespan("Short"), 2)
+        # The first request leaves the window a second after it was made,
+        # the second one half a second later
+        time.sleep(0.6)
+        self.assertEqual(self.requester.realm_requests_in_timespan("Short"), 1)
+        self.assertEqual(self.requester._acquire_realms(["Short"]), ([], None))
+        self.assertEqual(
+            self.requester._acquire_realms(["Short"])[0], ["Short"])
+        # Nothing is left behind once the window is over
+        time.sleep(1.1)
+        self.assertFalse(self.requester.redis.exists(
+            self.requester._realm_requests_redis_key("Short")))
+
+    def test_all_or_none_across_realms(self):
+        self.requester.register_realm("Small", max_requests=12, timespan=60)
+        self.requester.register_realm("Large", max_requests=13, timespan=60)
+        started = time.time()
+        self.assertEqual(
+            self.requester._acquire_realms(["Small", "Large"]), ([], None))
+        self.assertEqual(
+            self.requester._acquire_realms(["Small", "Large"]), ([], None))
+        rate_limited, retry_at = self.requester._acquire_realms(
+            ["Small", "Large"])
+        self.assertEqual(rate_limited, ["Small"])
+        # The refused request isn't recorded in the realm that had room
+        self.assertEqual(self.requester.realm_requests_in_timespan("Large"), 2)
+        self.assertEqual(self.requester._acquire_realms(["Large"]), ([], None))
+        self.assertEqual(
+            self.requester._acquire_realms(["Small", "Large"])[0],
+            ["Small", "Large"])
+        # Room comes back when the oldest request leaves the window
+        self.assertAlmostEqual(retry_at, started + 60, delta=1)
+
+    def test_retry_at_is_the_latest_realm(self):
+        self.requester.register_realm("Minute", max_requests=12, timespan=60)
+        self.requester.register_realm("Hour", max_requests=12, timespan=3600)
+        started = time.time()
+        self.requester._acquire_realms(["Minute"])
+        self.requester._acquire_realms(["Minute", "Hour"])
+        self.requester._acquire_realms(["Hour"])
+        self.assertEqual(self.requester._acquire_realms(["Minute"])[0],
+                         ["Minute"])
+        rate_limited, retry_at = self.requester._acquire_realms(
+            ["Minute", "Hour"])
+        self.assertEqual(rate_limited, ["Minute", "Hour"])
+        self.assertAlmostEqual(retry_at, started + 3600, delta=1)
+
+    def test_stale_configuration_is_reloaded(self):
+        self.requester.register_realm("Shared", max_requests=13, timespan=60)
+        self.assertEqual(self.requester._acquire_realms(["Shared"]), ([], None))
+        # Another process lowers the limit to the one request already made
+        TestRequester().update_realm("Shared", max_requests=11)
+        self.assertEqual(self.requester.realm_max_requests("Shared"), 13)
+        # The script refuses the cached configuration, the retry uses the new one
+        self.assertEqual(
+            self.requester._acquire_realms(["Shared"])[0], ["Shared"])
+        self.assertEqual(self.requester.realm_max_requests("Shared"), 11)
+
+    def test_register_after_unregister_elsewhere(self):
+        self.requester.register_realm("Shared", max_requests=12, timespan=60)
+        self.assertEqual(self.requester.realm_timespan("Shared"), 60)
+        TestRequester().unregister_realm("Shared")
+        self.requester.register_realm("Shared", max_requests=12, timespan=60)
+        self.assertIn("Shared", self.requester.fetch_registered_realms())
+        self.assertEqual(self.requester._acquire_realms(["Shared"]), ([], None))
+
+    def test_request_without_realms(self):
+        session = mock.Mock()
+        requester = TestRequester(session=session)
+        self.assertEqual(requester._acquire_realms([]), ([], None))
+        response = requester.request(
+            RespectfulRequest("get", "https://example.com"), realms=[])
+        self.assertIs(response, session.request.return_value)
+        session.request.assert_called_once_with("get", "https://example.com")